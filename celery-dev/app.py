@@ -1,5 +1,33 @@
+import argparse
 
+POOLS = ('prefork', 'threads', 'gevent')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tier', choices=('interactive', 'bulk', 'webhook'), default=None,
+                        help='Воркер только для очередей одного класса')
+    parser.add_argument('--pool', choices=POOLS, default=None,
+                        help='Пул выполнения задач, по умолчанию WORKER_POOL')
+    parser.add_argument('--concurrency', type=int, default=None)
+    args = parser.parse_args()
+
+    # config импортирует kombu, поэтому WORKER_POOL читается без него
+    from os import getenv
+    from dotenv import load_dotenv
+    load_dotenv('.env')
+    pool = args.pool or getenv("WORKER_POOL", default='prefork')
+    if pool == 'gevent':
+        # До импорта приложения: сокеты, потоки и блокировки должны быть
+        # заменены раньше, чем их создадут requests, peewee и celery
+        from gevent import monkey
+        monkey.patch_all()
+        import database
+        database.use_gevent()
+
+# На уровне модуля: celery загружает приложение по -A app повторным
+# импортом этого файла как модуля app
 from appdir import app
 
 if __name__ == '__main__':
-    app.start(argv=["-A", "app", "worker", "--loglevel=INFO"])
+    from appdir.routing import worker_argv
+    app.start(argv=worker_argv(args.tier, pool, args.concurrency))
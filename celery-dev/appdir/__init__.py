@@ -1,37 +1,28 @@
 
 import json
 import logging
-import importlib
 from pathlib import Path
 
-import requests
 from celery import Celery
 
+from appdir import api, idempotency, manifest, metrics, resilience, routing
 from appdir.classes import *
+from appdir.reporting import reporter
+from appdir.serializer import encode_widget_session, merge_json
 from config import CeleryConfig
 
 config = CeleryConfig()
-app = Celery('celery')
+# Задачи могут быть объявлены через async def, см. appdir.aio
+app = Celery('celery', task_cls='appdir.aio:Task')
 app.config_from_object(config)
+app.user_options['worker'].add(routing.route_legacy_option)
+app.steps['consumer'].add(routing.LegacyRouter)
 
-application_path = Path('/code/applications')
-application_packages = [str(x)[6:].replace('/', '.')
-                        for x in application_path.glob('*/*')
-                        if x.is_dir() and not str(x.name).startswith("__")]
-app.autodiscover_tasks(packages=application_packages, related_name='action', force=True)
-application_catalogs = [x for x in application_path.glob('*/models.py') if x.is_file()]
-
-webhooks_path = Path('/code/webhooks')
-webhooks_packages = [str(x)[6:].replace('/', '.')
-                     for x in webhooks_path.glob('*/*')
-                     if x.is_dir() and not str(x.name).startswith("__")]
-
-webhook_catalogs = [x for x in webhooks_path.glob('*/models.py') if x.is_file()]
-for model_path in set().union(application_catalogs, webhook_catalogs):
-    model_pythonic_path = str(model_path)[6:].replace('/', '.')[:-3]
-    module = importlib.import_module(model_pythonic_path)
-
-app.autodiscover_tasks(packages=webhooks_packages, related_name='action', force=True)
+code_root = Path(app.conf.CODE_ROOT)
+import_report = manifest.ImportReport()
+application_packages, webhooks_packages = manifest.import_modules(app, code_root, import_report)
+if app.conf.IMPORT_REPORT:
+    print(import_report.format())
 
 webhook_tasks = []
 application_tasks = []
@@ -43,107 +34,201 @@ for code in app.tasks.keys():
     elif code.startswith("webhooks"):
         webhook_tasks.append(code)
         continue
-register_tasks = requests.post(f"{app.conf.API_URL}/register_tasks",
-                               data=json.dumps({"application_task_codes": application_tasks,
-                                                "webhook_task_codes": webhook_tasks}),
-                               headers=app.conf.api_headers,
-                               timeout=120)
-
-
-if register_tasks.status_code == 200:
-    data = register_tasks.json()['data']
-    info = f'''*** Регистрация задач ***
-    Незарегестрированные виджеты: {data['widget_not_found']}
-    Незарегестрированные вебхуки: {data['webhooks_not_found']}'''
-    print(info)
+task_manifest = manifest.build_manifest(application_tasks, webhook_tasks)
+
+if app.conf.TASK_REGISTRATION_MODE == 'async':
+    # Регистрация после запуска воркера и только при изменении манифеста
+    from celery.signals import worker_ready
+
+    @worker_ready.connect()
+    def worker_ready_handler(**kwargs):
+        if manifest.is_changed(task_manifest):
+            manifest.register_async(task_manifest)
+        else:
+            print('*** Регистрация задач: манифест не изменился ***')
 else:
-    raise SystemError('Celery not working!')
+    manifest.register(task_manifest)
 
 # signals
-from celery.signals import task_postrun, task_prerun
+from celery.signals import (task_postrun, task_prerun, worker_init, worker_ready,
+                            worker_process_init, worker_process_shutdown)
+
+from database import db
+from refcache import references
+
+metrics.registry.register("celery_db_pool_connections", "Database pool connections by state.",
+                          lambda: {state: value for state, value in db.pool_stats().items()
+                                   if state in ("in_use", "idle", "max")})
+metrics.registry.register("celery_db_pool_waits_total", "Checkouts that waited for a free connection.",
+                          lambda: {"waited": db.pool_stats()["wait_count"]}, type='counter')
+metrics.registry.register("celery_db_pool_wait_seconds_total", "Time spent waiting for a free connection.",
+                          lambda: {"waited": db.pool_stats()["wait_seconds"]}, type='counter')
+metrics.registry.register("celery_webhook_idempotency_total", "Webhook deliveries claimed, skipped as duplicates and released.",
+                          idempotency.guard.stats, type='counter')
+metrics.registry.register("celery_webhook_settings_cache_total", "Webhook settings cache hits, misses and evictions.",
+                          lambda: {state: value for state, value in settings_cache.stats().items()
+                                   if state != "size"}, type='counter')
+metrics.registry.register("celery_webhook_settings_cache_size", "Webhook settings cached in the process.",
+                          lambda: {"size": settings_cache.stats()["size"]})
+metrics.registry.register("celery_refcache_events_total", "Reference cache lookups, loads and invalidations.",
+                          references.stats, type='counter')
+metrics.registry.register("celery_api_breaker_state", "Processes by API endpoint circuit breaker state.",
+                          resilience.breaker_states)
+metrics.registry.register("celery_api_shed_total", "API calls failed fast by an open circuit and retries denied by the budget.",
+                          resilience.shed_counts, type='counter')
+
+# Пул prefork: задачи выполняются в дочерних процессах, по одной за раз
+_db_pool_forked = True
+
+@worker_init.connect()
+def metrics_worker_init_handler(**kwargs):
+    metrics.set_master()
+
+@worker_init.connect()
+def database_worker_init_handler(sender=None, **kwargs):
+    global _db_pool_forked
+    pool = getattr(sender, 'pool_cls', None)
+    pool_name = f"{getattr(pool, '__module__', '')}.{getattr(pool, '__name__', pool)}".lower()
+    threaded = any(name in pool_name for name in ('thread', 'gevent', 'eventlet'))
+    _db_pool_forked = 'prefork' in pool_name
+    db.configure_pool(getattr(sender, 'concurrency', 1) if threaded else 1)
+    if threaded:
+        api.configure(getattr(sender, 'concurrency', 1))
+    if app.conf.IDEMPOTENCY_ENABLED:
+        try:
+            idempotency.install()
+        except Exception:
+            logging.critical("Idempotency table is not available!")
+
+@worker_ready.connect()
+def metrics_worker_ready_handler(**kwargs):
+    metrics.exporter.start()
+    if not _db_pool_forked:
+        db.prewarm()
+        references.start(timeout=0)
+
+@worker_process_init.connect()
+def worker_process_init_handler(**kwargs):
+    api.reset_session()
+    db.reset_after_fork()
+    db.prewarm()
+    # Слушатель подключается в фоне, до подключения запросы идут в БД
+    references.start(timeout=0)
+    metrics.exporter.start_dumper()
+
+@worker_process_shutdown.connect()
+def worker_process_shutdown_handler(**kwargs):
+    reporter.flush(timeout=app.conf.LIFECYCLE_SHUTDOWN_TIMEOUT)
+    metrics.discard()
 
 def change_session_status(widget_session_guid: str,
                           state: str,
                           action_type: str,
                           headers: dict,
-                          response: Response):
+                          response: Response,
+                          sync: bool = False):
 
     data = {
         "widget_session_guid": widget_session_guid,
-        "widget_session": response.widget_session.get_json(),
         "state": state,
         "action_type": action_type,
         "retval": {
             "status": response.status.value
             }
         }
+    with metrics.span("serialization"):
+        delta = None
+        if app.conf.WIDGET_SESSION_DELTA:
+            delta = response.widget_session.get_delta()
+            data["widget_session_mode"] = "delta" if delta is not None else "full"
+        if delta is not None:
+            widget_session = json.dumps(delta).encode()
+        else:
+            widget_session = encode_widget_session(response.widget_session)
 
-    r = requests.post(f"{app.conf.API_URL}/change_session_status",
-        data=json.dumps(data),
-        headers=headers,
-        timeout=5)
-    if r.status_code != 200:
-        logging.critical("API not working!")
+    send = reporter.send_sync if sync else reporter.submit
+    send("change_session_status", widget_session_guid,
+         merge_json(json.dumps(data).encode(), widget_session=widget_session),
+         headers=headers)
     return None
 
-def update_user_request(user_request_guid: str, state: str, headers: dict):
+def update_user_request(user_request_guid: str, state: str, headers: dict,
+                        sync: bool = False, widget_session_guid: str = None):
     data = {
         "user_request_guid": user_request_guid,
         "state": state
         }
 
-    request = requests.post(f"{app.conf.API_URL}/update_user_request",
-        data=json.dumps(data),
-        headers=headers,
-        timeout=5)
-
-    if request.status_code != 200:
-        logging.critical("API not working!")
-
-    user_request = request.json()['data']
+    # С widget_session_guid запрос не обгоняет поставленный ранее статус сессии
+    key = (user_request_guid, widget_session_guid) if widget_session_guid else user_request_guid
+    send = reporter.send_sync if sync else reporter.submit
+    user_request = send("update_user_request", key,
+                        json.dumps(data).encode(), headers=headers)
 
     return user_request
 
-def update_webhook_request(webhook_request_guid: str, state: str, headers: dict):
+def update_webhook_request(webhook_request_guid: str, state: str, headers: dict,
+                           sync: bool = False):
     data = {
         "webhook_request_guid": webhook_request_guid,
         "state": state
         }
 
-    request = requests.post(f"{app.conf.API_URL}/update_webhook_request",
-        data=json.dumps(data),
-        headers=headers,
-        timeout=5)
-
-    if request.status_code != 200:
-        logging.critical("API not working!")
-
-    webhook_request = request.json()['data']
+    send = reporter.send_sync if sync else reporter.submit
+    webhook_request = send("update_webhook_request", webhook_request_guid,
+                           json.dumps(data).encode(), headers=headers)
 
     return webhook_request
 
+# Приёмники сигналов вызываются в порядке подключения: замер задачи
+# начинается до task_prerun_handler и заканчивается после task_postrun_handler
+@task_prerun.connect()
+def metrics_task_prerun_handler(sender=None, **kwargs):
+    metrics.task_started(sender.name)
+    # Соединение берётся из пула при первом запросе задачи
+    db.task_started()
+
+# kwargs['kwargs'] - аргументы этого запроса, у каждого запроса свой словарь,
+# поэтому дополнять его безопасно и в пулах threads/gevent
 @task_prerun.connect()
 def task_prerun_handler(sender=None, task=None, *args, **kwargs):
     task_type = sender.name.split('.')[0]
     if task_type == 'applications':
+        if app.conf.WIDGET_SESSION_PREFETCH:
+            # Сессия запрашивается в фоне, пока отправляется "started" и
+            # выполняется начало задачи; WidgetSession(guid=...) в задаче
+            # получает готовый ответ без второго запроса
+            WidgetSession.prefetch(kwargs['kwargs']['widget_session_guid'])
         user_request = update_user_request(
             user_request_guid=kwargs['kwargs']['user_request_guid'],
             state="started",
             headers=app.conf.api_headers
             )
     elif task_type == 'webhooks':
+        # Задаче нужны данные вебхука, поэтому "started" отправляется синхронно
         webhook_request = update_webhook_request(
             webhook_request_guid=kwargs['kwargs']['webhook_request_guid'],
             state="started",
-            headers=app.conf.api_headers
+            headers=app.conf.api_headers,
+            sync=True
         )
 
         kwargs['kwargs']['webhook_request'] = webhook_request
 
+@task_prerun.connect()
+def metrics_task_body_handler(**kwargs):
+    metrics.task_body_started()
+
+@task_postrun.connect()
+def metrics_task_postrun_handler(**kwargs):
+    metrics.task_body_finished()
+
 @task_postrun.connect()
 def task_postrun_handler(sender=None, state=None, **kwargs):
-    task_type, action_type = sender.name.split('.')[0], sender.name.split('.')[-1]
+    task_type, action_type = sender.name.split('.')[0], routing.action_type(sender.name)
     if sender is not None and task_type == 'applications':
+        # Невостребованный ответ не переходит к следующей задаче потока
+        WidgetSession.discard_prefetch()
         response = kwargs['retval']
         if response is None or not isinstance(response, Response):
             raise TypeError("The return value of the task must be <Response>")
@@ -158,7 +243,8 @@ def task_postrun_handler(sender=None, state=None, **kwargs):
         update_user_request(
             user_request_guid=kwargs['kwargs']['user_request_guid'],
             state=state.lower(),
-            headers=app.conf.api_headers
+            headers=app.conf.api_headers,
+            widget_session_guid=kwargs['kwargs']['widget_session_guid']
         )
     elif task_type == 'webhooks':
         response = kwargs['retval']
@@ -167,3 +253,8 @@ def task_postrun_handler(sender=None, state=None, **kwargs):
             state="success",
             headers=app.conf.api_headers
         )
+
+@task_postrun.connect()
+def metrics_task_finished_handler(**kwargs):
+    db.task_finished()
+    metrics.task_finished()
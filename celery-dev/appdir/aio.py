@@ -0,0 +1,98 @@
+
+import os
+import asyncio
+import inspect
+import threading
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+
+from celery import Task as BaseTask
+
+from database import db
+from config import CeleryConfig
+config = CeleryConfig()
+
+# Задачи async def. Действие приложения можно объявить корутиной и
+# совместить ожидание ввода-вывода через asyncio.gather:
+#
+#   @shared_task
+#   async def init(**kwargs):
+#       ws, rows = await asyncio.gather(
+#           WidgetSession.load(kwargs['widget_session_guid']),
+#           aio.run_db(queries.active_orders, limit=50))
+#       ...
+#       return Response(ws, status=Status.SUCCESS)
+#
+# Корутина выполняется до конца в цикле событий потока воркера (в prefork -
+# один цикл на процесс, в threads/gevent - на поток), поэтому task_prerun,
+# task_postrun, подтверждение и результат - как у синхронной задачи.
+# Блокирующие вызовы (requests, psycopg2) выполняются в пуле цикла из
+# ASYNC_IO_THREADS потоков: api.post_async, WidgetSession.load, run_db,
+# asyncio.to_thread. run_db берёт соединение из пула БД на время вызова:
+# транзакция на несколько вызовов невозможна, а одновременных запросов не
+# больше размера пула (DB_POOL_OVERFLOW).
+
+_local = threading.local()
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    loop = getattr(_local, 'loop', None)
+    if loop is None or loop.is_closed():
+        loop = _local.loop = asyncio.new_event_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=config.ASYNC_IO_THREADS,
+                                                     thread_name_prefix='aio'))
+    return loop
+
+
+def run_coroutine(coro):
+    loop = get_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        # Корутины, запущенные задачей и не дождавшиеся её завершения,
+        # отменяются, чтобы не выполняться во время следующей задачи
+        pending = asyncio.all_tasks(loop)
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+
+
+def _scoped(fn, *args, **kwargs):
+    with db.task_scope():
+        return fn(*args, **kwargs)
+
+
+async def run_db(fn, *args, **kwargs):
+    # fn должна выполнить запрос сама (list(query), .get() и т.п.): ленивый
+    # запрос peewee, возвращённый из потока, выполнится уже без соединения
+    return await asyncio.to_thread(_scoped, fn, *args, **kwargs)
+
+
+def _blocking(fun):
+    @wraps(fun)
+    def wrapper(*args, **kwargs):
+        return run_coroutine(fun(*args, **kwargs))
+    return wrapper
+
+
+class Task(BaseTask):
+    # Базовый класс задач приложения (task_cls): run, объявленный через
+    # async def, при создании класса задачи заменяется синхронной обёрткой
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        run = cls.__dict__.get('run')
+        fun = getattr(run, '__func__', run)
+        if inspect.iscoroutinefunction(fun):
+            cls.run = staticmethod(_blocking(fun)) if isinstance(run, staticmethod) else _blocking(fun)
+
+
+def _reset():
+    # Цикл и потоки его пула не переживают fork
+    global _local
+    _local = threading.local()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset)
@@ -0,0 +1,119 @@
+
+import os
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from appdir import metrics, resilience
+from config import CeleryConfig
+config = CeleryConfig()
+
+# Одна сессия на процесс, общая для потоков и гринлетов: пул соединений
+# urllib3 потокобезопасен, а изменяемого состояния у сессии нет - заголовки
+# задаются при создании, cookies не сохраняются. В пулах threads/gevent
+# размер пула соединений не меньше числа одновременных задач, см. configure().
+_lock = threading.Lock()
+_session = None
+_executor = None
+_pool_maxsize = config.API_POOL_MAXSIZE
+_pool_block = config.API_POOL_BLOCK
+
+
+def _build_session() -> requests.Session:
+    s = requests.Session()
+    # Повторы - в resilience, с бюджетом и с учётом автомата
+    adapter = HTTPAdapter(pool_connections=config.API_POOL_CONNECTIONS,
+                          pool_maxsize=_pool_maxsize,
+                          pool_block=_pool_block,
+                          max_retries=0)
+    s.mount(f'{config.API_URL}', adapter)
+    s.headers.update(config.api_headers)
+    s.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return s
+
+
+def configure(concurrency: int):
+    # Пул threads/gevent: каждой одновременной задаче и фоновым потокам
+    # (reporter, регистрация) - своё соединение, сверх этого запросы ждут
+    # освобождения соединения, а не открывают новые
+    global _pool_maxsize, _pool_block
+    with _lock:
+        _pool_maxsize = max(config.API_POOL_MAXSIZE, concurrency + 2)
+        _pool_block = True
+    close_session()
+
+
+def get_session() -> requests.Session:
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    # Фоновых потоков не больше, чем соединений в пуле сессии
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=_pool_maxsize,
+                                               thread_name_prefix='api')
+    return _executor
+
+
+def reset_session():
+    # Соединения, унаследованные от родителя после fork, использовать нельзя:
+    # сокеты общие с родительским процессом. Потоки пула после fork не живут.
+    global _lock, _session, _executor
+    _lock = threading.Lock()
+    _session = None
+    _executor = None
+
+
+def close_session():
+    global _session, _executor
+    with _lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+        _executor = None
+
+
+def post(path: str, data=None, json=None, headers=None, timeout=None) -> requests.Response:
+    # timeout - верхняя граница, фактический таймаут подстраивается под
+    # задержку пути; при открытом автомате - CircuitOpenError без запроса
+    with metrics.span(f"api:{path}"):
+        return resilience.endpoint(path).call(
+            get_session().post,
+            url=f"{config.API_URL}{path}",
+            data=data,
+            json=json,
+            headers=headers,
+            timeout=timeout if timeout is not None else config.API_TIMEOUT
+        )
+
+
+def post_background(path: str, data=None, json=None, headers=None, timeout=None) -> Future:
+    # Запрос в фоновом потоке, пока вызывающий занят другим; замеры
+    # попадают в текущую задачу
+    return _get_executor().submit(contextvars.copy_context().run, post, path,
+                                  data=data, json=json, headers=headers, timeout=timeout)
+
+
+async def post_async(path: str, data=None, json=None, headers=None, timeout=None) -> requests.Response:
+    # Для задач async def: запрос выполняется в пуле потоков цикла событий,
+    # цикл в это время выполняет другие корутины задачи
+    return await asyncio.to_thread(post, path, data=data, json=json, headers=headers, timeout=timeout)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_session)
@@ -0,0 +1,309 @@
+
+import json
+import logging
+import threading
+from functools import wraps
+from collections import defaultdict
+
+from billiard.einfo import ExceptionInfo
+from celery import Task, current_app, shared_task
+from celery.utils.imports import symbol_by_name
+from celery.worker.strategy import hybrid_to_proto2, proto1_to_proto2
+
+from appdir import metrics
+from appdir.idempotency import guard, webhook_key
+from appdir.classes import Webhook
+from appdir.reporting import reporter
+from database import db
+from config import CeleryConfig
+config = CeleryConfig()
+
+logger = logging.getLogger(__name__)
+
+# Пакетная обработка вебхуков. Обработчик получает список Webhook одной
+# пары (app_guid, account_guid) и возвращает список результатов в том же
+# порядке; исключение в списке результатов - ошибка этого вебхука:
+#
+#   @webhook_batch(max_size=100, max_wait=0.05)
+#   def order_handler(webhooks: list) -> list:
+#       ...
+#
+# При WEBHOOK_BATCHING сообщения задачи копятся в главном процессе воркера
+# до max_size штук или max_wait секунд по ключу (app_guid, account_guid)
+# из аргументов сообщения (если отправитель их передаёт) и выполняются в
+# пуле одним вызовом: переходы "started" - одной пачкой, обработчик - раз
+# на группу (с atomic=True - в одной транзакции, чтобы массовые записи
+# группы фиксировались вместе), итоговые состояния - через reporter. Если
+# обработчик падает на всей группе, вебхуки группы обрабатываются по
+# одному, чтобы ошибка одного не помечала ошибочными остальные.
+# Без WEBHOOK_BATCHING задача обычная: один вебхук на задачу.
+# С idempotent (IDEMPOTENCY_ENABLED) повторные доставки вебхука
+# подтверждаются как "success" без вызова обработчика, см. idempotency.
+
+
+class WebhookBatchTask(Task):
+    handler = None
+    atomic = False
+    idempotent = config.IDEMPOTENCY_ENABLED
+    max_size = config.WEBHOOK_BATCH_SIZE
+    max_wait = config.WEBHOOK_BATCH_INTERVAL
+
+    def run_batch(self, requests: list) -> dict:
+        # requests: [(task_id, kwargs)] -> {webhook_request_guid: состояние}
+        metrics.task_started(self.name)
+        db.task_started()
+        try:
+            return self._run_batch(requests)
+        finally:
+            db.task_finished()
+            metrics.task_finished()
+
+    def _run_batch(self, requests: list) -> dict:
+        guids = [kwargs['webhook_request_guid'] for _, kwargs in requests]
+        started = reporter.send_batch_sync(
+            [("update_webhook_request", guid,
+              json.dumps({"webhook_request_guid": guid, "state": "started"}).encode())
+             for guid in guids],
+            headers=config.api_headers)
+
+        states = {}
+        keys, duplicates = self._claim([(guid, webhook_request)
+                                        for guid, webhook_request in zip(guids, started)
+                                        if webhook_request])
+        groups = defaultdict(list)
+        for guid, webhook_request in zip(guids, started):
+            if not webhook_request:
+                states[guid] = "failure"
+                continue
+            if guid in duplicates:
+                states[guid] = "success"
+                continue
+            try:
+                webhook = Webhook(**webhook_request)
+            except Exception:
+                logger.exception("Webhook %s cannot be loaded", guid)
+                states[guid] = "failure"
+                continue
+            groups[(webhook.app_guid, webhook.account_guid)].append((guid, webhook))
+
+        metrics.task_body_started()
+        try:
+            for group in groups.values():
+                states.update(self._run_group(group))
+        finally:
+            metrics.task_body_finished()
+        self._complete([keys[guid] for guid, state in states.items()
+                        if state == "success" and guid in keys])
+        self._release([keys[guid] for guid, state in states.items()
+                       if state == "failure" and guid in keys])
+
+        for guid in guids:
+            reporter.submit("update_webhook_request", guid,
+                            json.dumps({"webhook_request_guid": guid,
+                                        "state": states[guid]}).encode(),
+                            headers=config.api_headers)
+        return states
+
+    def _claim(self, webhook_requests) -> tuple:
+        # -> ({guid: ключ захваченных}, {guid дублей})
+        if not self.idempotent:
+            return {}, set()
+        try:
+            webhook_requests = [(guid, webhook_key(webhook_request))
+                                for guid, webhook_request in webhook_requests]
+            found = guard.claim([key for _, key in webhook_requests])
+        except Exception:
+            logger.warning("Idempotency check failed, processing without it", exc_info=True)
+            return {}, set()
+        keys, duplicates = {}, set()
+        for (guid, key), duplicate in zip(webhook_requests, found):
+            if duplicate:
+                duplicates.add(guid)
+            else:
+                keys[guid] = key
+        return keys, duplicates
+
+    def _complete(self, keys: list):
+        # Не отмеченный ключ снова захватывается после аренды: лишняя
+        # обработка безопаснее потерянной
+        try:
+            guard.complete(keys)
+        except Exception:
+            logger.warning("Idempotency completion failed", exc_info=True)
+
+    def _release(self, keys: list):
+        try:
+            guard.release(keys)
+        except Exception:
+            logger.warning("Idempotency release failed", exc_info=True)
+
+    def _run_group(self, group: list) -> dict:
+        try:
+            results = self._call([webhook for _, webhook in group])
+        except Exception:
+            if len(group) == 1:
+                logger.exception("Webhook %s failed", group[0][0])
+                return {group[0][0]: "failure"}
+            logger.warning("Webhook batch of %s failed, retrying one by one", len(group),
+                           exc_info=True)
+            states = {}
+            for item in group:
+                states.update(self._run_group([item]))
+            return states
+        states = {}
+        for (guid, _), result in zip(group, results):
+            if isinstance(result, Exception):
+                logger.error("Webhook %s failed: %r", guid, result)
+                states[guid] = "failure"
+            else:
+                states[guid] = "success"
+        return states
+
+    def _call(self, webhooks: list) -> list:
+        if self.atomic:
+            with db.atomic():
+                results = self.handler(webhooks)
+        else:
+            results = self.handler(webhooks)
+        if results is None:
+            results = [None] * len(webhooks)
+        if len(results) != len(webhooks):
+            raise ValueError("Batch handler must return a result for every webhook")
+        return results
+
+
+def _report_failure(requests: list) -> dict:
+    # Сообщения пачки уже подтверждены: без итогового состояния вебхуки
+    # остались бы в "started"
+    states = {}
+    for _, kwargs in requests:
+        guid = kwargs['webhook_request_guid']
+        states[guid] = "failure"
+        reporter.submit("update_webhook_request", guid,
+                        json.dumps({"webhook_request_guid": guid, "state": "failure"}).encode(),
+                        headers=config.api_headers)
+    return states
+
+
+def _run_batch(task_name: str, requests: list) -> dict:
+    try:
+        return current_app.tasks[task_name].run_batch(requests)
+    except Exception:
+        logger.exception("Webhook batch of %s (%s) failed", len(requests), task_name)
+        return _report_failure(requests)
+
+
+def strategy(task, app, consumer, **kwargs):
+    # Стратегия главного процесса воркера: сообщения не уходят в пул по
+    # одному, а копятся в буфере. Пока сообщение в буфере, оно не
+    # подтверждено, поэтому лимит prefetch на время ожидания поднимается,
+    # как для задач с ETA.
+    hostname = consumer.hostname
+    connection_errors = consumer.connection_errors
+    eventer = consumer.event_dispatcher
+    timer = consumer.timer
+    Request = symbol_by_name(task.Request)
+    revoked_tasks = consumer.controller.state.revoked
+    buffers = {}
+    timers = {}
+    # flush по max_wait вызывается из потока таймера, по max_size - из
+    # потока consumer
+    lock = threading.Lock()
+
+    def flush(key):
+        with lock:
+            requests = buffers.pop(key, None)
+            entry = timers.pop(key, None)
+        if entry is not None:
+            entry.cancel()
+        if not requests:
+            return
+
+        def on_accepted(pid, time_accepted):
+            if not task.acks_late:
+                for request in requests:
+                    request.acknowledge()
+
+        def on_return(result):
+            if isinstance(result, ExceptionInfo):
+                # Процесс пула погиб посреди пачки: ошибки самой пачки
+                # _run_batch обрабатывает внутри
+                logger.error("Webhook batch of %s (%s) was lost: %r",
+                             len(requests), task.name, result.exception)
+                _report_failure(batch)
+            if task.acks_late:
+                for request in requests:
+                    request.acknowledge()
+
+        batch = [(request.task_id, request.kwargs) for request in requests]
+        consumer.pool.apply_async(_run_batch,
+                                  args=(task.name, batch),
+                                  accept_callback=on_accepted,
+                                  callback=on_return,
+                                  error_callback=on_return)
+        for _ in requests:
+            consumer.qos.decrement_eventually()
+
+    def task_message_handler(message, body, ack, reject, callbacks, **kw):
+        if body is None and 'args' not in message.payload:
+            body, headers, decoded, utc = (
+                message.body, message.headers, False, app.uses_utc_timezone(),
+            )
+        elif 'args' in message.payload:
+            body, headers, decoded, utc = hybrid_to_proto2(message, message.payload)
+        else:
+            body, headers, decoded, utc = proto1_to_proto2(message, body)
+
+        request = Request(
+            message,
+            on_ack=ack, on_reject=reject, app=app, hostname=hostname,
+            eventer=eventer, task=task, connection_errors=connection_errors,
+            body=body, headers=headers, decoded=decoded, utc=utc,
+        )
+        if (request.expires or request.task_id in revoked_tasks) and request.revoked():
+            return
+        if callbacks:
+            [callback(request) for callback in callbacks]
+
+        key = (request.kwargs.get('app_guid'), request.kwargs.get('account_guid'))
+        consumer.qos.increment_eventually()
+        with lock:
+            buffer = buffers.setdefault(key, [])
+            buffer.append(request)
+            full = len(buffer) >= task.max_size
+            if not full and key not in timers:
+                timers[key] = timer.call_after(task.max_wait, flush, (key,))
+        if full:
+            flush(key)
+
+    return task_message_handler
+
+
+def webhook_batch(max_size: int = None, max_wait: float = None, batching: bool = None, **options):
+    def decorator(handler):
+        @wraps(handler)
+        def run(self, **kwargs):
+            # Один вебхук: webhook_request получен в task_prerun_handler
+            guid = kwargs['webhook_request_guid']
+            keys, duplicates = self._claim([(guid, kwargs['webhook_request'])])
+            if duplicates:
+                return None
+            try:
+                result, = self._call([Webhook(**kwargs['webhook_request'])])
+                if isinstance(result, Exception):
+                    raise result
+            except Exception:
+                self._release(list(keys.values()))
+                raise
+            self._complete(list(keys.values()))
+            return result
+
+        attrs = dict(options, handler=staticmethod(handler))
+        if max_size is not None:
+            attrs['max_size'] = max_size
+        if max_wait is not None:
+            attrs['max_wait'] = max_wait
+        if config.WEBHOOK_BATCHING if batching is None else batching:
+            attrs['Strategy'] = 'appdir.batching:strategy'
+        return shared_task(base=WebhookBatchTask, bind=True, **attrs)(run)
+    return decorator
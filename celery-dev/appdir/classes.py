@@ -1,16 +1,29 @@
 
+import os
+import copy
+import asyncio
 import logging
 from datetime import date
 from enum import Enum
+from contextvars import ContextVar
 
 import requests
-from requests.adapters import HTTPAdapter, Retry
 
+from appdir import api, metrics
+from appdir.cache import TTLCache
+from appdir.pagination import KeysetPaginator
 from config import CeleryConfig
 config = CeleryConfig()
 API_TOKEN = config.API_TOKEN
 API_URL = config.API_URL
 
+# Настройки вебхуков по (app_guid, account_guid)
+settings_cache = TTLCache(ttl=config.WEBHOOK_SETTINGS_TTL,
+                          maxsize=config.WEBHOOK_SETTINGS_CACHE_SIZE)
+
+# Запрос сессии виджета, начатый в task_prerun: (guid, Future ответа API)
+_prefetched = ContextVar('widget_session_prefetch', default=None)
+
 class Status(Enum):
     NOTHING = 'nothing'
     STARTED = 'started'
@@ -21,44 +34,373 @@ class Status(Enum):
     FAILURE = 'failure'
     REVOKED = 'revoked'
 
-class Item:
+class TrackedList(list):
+    # Список, который сообщает владельцу об изменении своего содержимого
+    __slots__ = ("_owner", "_field")
+
+    def __init__(self, iterable=(), owner=None, field: str = None) -> None:
+        super().__init__(iterable)
+        self._owner = owner
+        self._field = field
+
+    def _changed(self):
+        if self._owner is not None:
+            self._owner._list_changed(self._field)
+
+def _tracked_mutator(name: str, base: type = list):
+    method = getattr(base, name)
+
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self._changed()
+        return result
+    wrapper.__name__ = name
+    return wrapper
+
+for _name in ('append', 'extend', 'insert', 'remove', 'pop', 'clear', 'sort',
+              'reverse', '__setitem__', '__delitem__', '__iadd__', '__imul__'):
+    setattr(TrackedList, _name, _tracked_mutator(_name))
+
+class TrackedDict(dict):
+    # Словарь-значение поля (describe и т.п.): изменение на месте помечает
+    # поле владельца изменённым. Вложенные словари и списки становятся
+    # отслеживаемыми при обращении к ним по ключу
+    __slots__ = ("_owner", "_field")
+
+    def __init__(self, mapping=(), owner=None, field: str = None) -> None:
+        super().__init__(mapping)
+        self._owner = owner
+        self._field = field
+
+    def _changed(self):
+        if self._owner is not None:
+            self._owner._list_changed(self._field)
+
+    def __getitem__(self, key):
+        return self._nested(key, dict.__getitem__(self, key))
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        return self._nested(key, dict.__getitem__(self, key))
+
+    def _nested(self, key, value):
+        if type(value) is dict or type(value) is list:
+            value = _track_value(value, self._owner, self._field)
+            dict.__setitem__(self, key, value)
+        return value
+
+for _name in ('__setitem__', '__delitem__', 'update', 'pop', 'popitem', 'clear',
+              'setdefault', '__ior__'):
+    setattr(TrackedDict, _name, _tracked_mutator(_name, dict))
+
+class TrackedValueList(TrackedList):
+    # Список-значение поля: как TrackedDict, вложенные словари и списки
+    # отслеживаются при обращении по индексу и при обходе
+    __slots__ = ()
+
+    def __getitem__(self, index):
+        value = list.__getitem__(self, index)
+        if type(value) is dict or type(value) is list:
+            value = _track_value(value, self._owner, self._field)
+            list.__setitem__(self, index, value)
+        return value
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+def _track_value(value, owner, field: str):
+    if type(value) is dict:
+        return TrackedDict(value, owner=owner, field=field)
+    if type(value) is list:
+        return TrackedValueList(value, owner=owner, field=field)
+    return value
+
+class Tracked:
+    # Отслеживание полей, изменённых после гидратации из API.
+    # _json_aliases сопоставляет атрибут с полем в get_json().
+    # Словари и списки в атрибутах _tracked_values отслеживаются и при
+    # изменении на месте (item.describe['count'] = ...)
+    __slots__ = ()
+    _json_aliases = {}
+    _tracked_lists = ()
+    _tracked_values = ()
+
+    def __setattr__(self, name, value):
+        if name in self._tracked_lists and type(value) is list:
+            value = TrackedList(value, owner=self, field=name)
+        elif name in self._tracked_values and getattr(self, '_dirty', None) is not None:
+            value = _track_value(value, self, name)
+        object.__setattr__(self, name, value)
+        if name in self._tracked_lists:
+            self._list_changed(name)
+        elif getattr(self, '_dirty', None) is not None:
+            self._mark_dirty(name)
+
+    def _list_changed(self, name: str):
+        # Вызывается и при замене, и при изменении списка на месте
+        self._mark_dirty(name)
+
+    def _start_tracking(self, owner=None):
+        object.__setattr__(self, '_dirty', set())
+        object.__setattr__(self, '_owner', owner)
+        for name in self._tracked_lists:
+            value = getattr(self, name, None)
+            if type(value) is list:
+                object.__setattr__(self, name, TrackedList(value, owner=self, field=name))
+        for name in self._tracked_values:
+            value = getattr(self, name, None)
+            if type(value) is dict or type(value) is list:
+                object.__setattr__(self, name, _track_value(value, self, name))
+
+    def _mark_dirty(self, name: str):
+        if getattr(self, '_dirty', None) is None:
+            return
+        field = name.lstrip('_')
+        self._dirty.add(self._json_aliases.get(field, field))
+        if self._owner is not None:
+            self._owner._child_dirty(self)
+
+    def _child_dirty(self, child):
+        pass
+
+    @property
+    def dirty_fields(self) -> set:
+        return getattr(self, '_dirty', None) or set()
+
+    @property
+    def is_tracked(self) -> bool:
+        return getattr(self, '_dirty', None) is not None
+
+    def mark_clean(self):
+        if self.is_tracked:
+            self._dirty.clear()
+
+class Item(Tracked):
+    # __slots__: в списках и деревьях бывают десятки тысяч элементов.
+    # До гидратации присваивания идут прямо в слоты, без Tracked.__setattr__:
+    # _start_tracking переключает объект на подкласс _tracked с ним
+    __slots__ = ("_id", "value", "checked", "style", "description", "describe",
+                 "_dirty", "_owner")
+    _fields = ("id", "value", "checked", "style", "description", "describe")
+    _tracked_values = ("value", "describe")
+    __setattr__ = object.__setattr__
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        if '_untracked' not in vars(cls):
+            _add_tracked_class(cls)
 
     def __init__(self, **kwargs) -> None:
-        self.id = kwargs.get('id', None)
+        self._id = kwargs.get('id', None)
         self.value = kwargs['value']
         self.checked = kwargs['checked']
         self.style = kwargs['style']
         self.description = kwargs.get('description', None)
         self.describe = kwargs.get('describe', None)
+        self._dirty = None
+        self._owner = None
+
+    @property
+    def id(self):
+        return self._id
+
+    @id.setter
+    def id(self, value):
+        self._id = value
+        _items_changed(self._owner)
+
+    def _start_tracking(self, owner=None):
+        object.__setattr__(self, '__class__', self._tracked)
+        super()._start_tracking(owner)
 
     def __str__(self) -> str:
         return f'<{self.__class__.__name__}: {self.value}>'
 
     def __repr__(self) -> str:
-        return f'<{self.__class__.__name__}: {self.__dict__}>'
+        return f'<{self.__class__.__name__}: {self.get_json()}>'
 
     def get_json(self):
-        return self.__dict__
+        return {
+            "id": self.id,
+            "value": self.value,
+            "checked": self.checked,
+            "style": self.style,
+            "description": self.description,
+            "describe": self.describe,
+        }
 
-class TreeItem(Item):
+    def get_delta(self):
+        return {field: getattr(self, field) for field in self.dirty_fields if field in self._fields}
 
-    def __init__(self, **kwargs) -> None:
-        super().__init__(**kwargs)
+def _add_tracked_class(cls):
+    # Подкласс с тем же именем и слотами, на который объект переключается
+    # при включении отслеживания
+    cls._tracked = type(cls.__name__, (cls,), {
+        '__slots__': (), '__module__': cls.__module__, '__qualname__': cls.__qualname__,
+        '__setattr__': Tracked.__setattr__, '_untracked': cls})
+    cls._untracked = cls
+
+_add_tracked_class(Item)
+
+def _has_raw(kwargs: dict) -> bool:
+    children = kwargs.get("children")
+    return isinstance(children, list) and len(children) > 0
+
+class TreeItem(Item):
+    # Дерево строится, отслеживается и сериализуется обходом со стеком, без
+    # рекурсии. В ленивом режиме потомки свёрнутых узлов (expand=False) не
+    # создаются: сырые данные лежат в _raw_children до обращения к children
+    __slots__ = ("expand", "_children", "_raw_children", "_lazy", "_has_children")
+    _fields = ("id", "value", "checked", "style", "expand", "children")
+    # has_children выводится только в ленивом режиме: без него формат прежний
+    _lazy_fields = ("id", "value", "checked", "style", "expand", "has_children", "children")
+    _tracked_lists = ("children",)
+    _tracked_values = ("value",)
+
+    def __init__(self, lazy: bool = False, **kwargs) -> None:
+        self._init_node(kwargs, lazy)
+        if lazy and not self.expand and _has_raw(kwargs):
+            object.__setattr__(self, '_raw_children', kwargs["children"])
+        else:
+            self._build_children(kwargs.get("children"), self._children)
+
+    def _init_node(self, kwargs: dict, lazy: bool):
+        Item.__init__(self, **kwargs)
         self.expand = kwargs.get("expand", False)
-        self.children = ([TreeItem(**kwd) for kwd in kwargs.get("children")]
-                         if isinstance(kwargs.get("children"), list) else [])
+        self._children = []
+        self._raw_children = None
+        self._lazy = lazy
+        self._has_children = kwargs.get("has_children", False)
+
+    def _build_children(self, raw_children, target: list):
+        # target - список, в который складываются потомки self; сам self
+        # разворачивается всегда, решение о ленивости принимается для потомков.
+        # Потомки создаются неотслеживаемыми, отслеживание включает вызывающий
+        cls = self._untracked
+        stack = [(raw_children, target)]
+        while stack:
+            raw, children = stack.pop()
+            if not isinstance(raw, list):
+                continue
+            for kwargs in raw:
+                child = cls.__new__(cls)
+                child._init_node(kwargs, self._lazy)
+                children.append(child)
+                if self._lazy and not child.expand:
+                    # Пустой список не откладывается: иначе узел считается
+                    # неподгруженным и expand_item не дойдёт до provider
+                    if _has_raw(kwargs):
+                        object.__setattr__(child, '_raw_children', kwargs["children"])
+                else:
+                    stack.append((kwargs.get("children"), child._children))
 
-    def get_json(self):
-        return {
+    @property
+    def children(self) -> list:
+        if self._raw_children is not None:
+            self._load_children()
+        if type(self._children) is list:
+            # До гидратации потомки - обычный список; изменения снаружи
+            # должны сбрасывать индекс id контрола
+            object.__setattr__(self, '_children', TrackedList(self._children, owner=self,
+                                                              field="children"))
+        return self._children
+
+    @children.setter
+    def children(self, value: list):
+        object.__setattr__(self, '_raw_children', None)
+        object.__setattr__(self, '_children', value)
+        _items_changed(self._owner)
+
+    def _load_children(self):
+        # Подгрузка отложенных потомков - не изменение, в dirty не попадает
+        raw = self._raw_children
+        object.__setattr__(self, '_raw_children', None)
+        children = []
+        self._build_children(raw, children)
+        if self._dirty is not None:
+            for child in children:
+                child._start_tracking(self._owner)
+            children = TrackedList(children, owner=self, field="children")
+        object.__setattr__(self, '_children', children)
+
+    @property
+    def has_children(self) -> bool:
+        return bool(self._children or self._raw_children or self._has_children)
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._raw_children is None
+
+    def _loaded_children(self) -> list:
+        return self._children
+
+    def _start_tracking(self, owner=None):
+        init = object.__setattr__
+        stack = [self]
+        while stack:
+            item = stack.pop()
+            init(item, '__class__', item._tracked)
+            init(item, '_dirty', set())
+            init(item, '_owner', owner)
+            if type(item.value) is dict or type(item.value) is list:
+                init(item, 'value', _track_value(item.value, item, 'value'))
+            if type(item._children) is list:
+                init(item, '_children', TrackedList(item._children, owner=item, field="children"))
+            stack.extend(item._children)
+
+    def _list_changed(self, name: str):
+        if name == "children":
+            _items_changed(self._owner)
+        super()._list_changed(name)
+
+    def _node_json(self) -> dict:
+        node_json = {
             "id": self.id,
             "value": self.value,
             "checked": self.checked,
             "style": self.style,
             "expand": self.expand,
-            "children": [item.get_json() for item in self.children],
         }
+        if self._lazy:
+            node_json["has_children"] = self.has_children
+        return node_json
 
-class BaseControl:
+    def get_json(self):
+        root = self._node_json()
+        stack = [(root, self)]
+        while stack:
+            node_json, item = stack.pop()
+            if item._raw_children is not None:
+                # Неподгруженное поддерево возвращается как пришло из API
+                node_json["children"] = item._raw_children
+                continue
+            node_json["children"] = children = []
+            for child in item._children:
+                child_json = child._node_json()
+                children.append(child_json)
+                stack.append((child_json, child))
+        return root
+
+    def get_delta(self):
+        delta = super().get_delta()
+        if "children" in delta:
+            delta["children"] = [item.get_json() for item in self._children]
+        return delta
+
+class BaseControl(Tracked):
+    _fields = ("guid", "name", "code", "description", "describe", "alert", "alert_style",
+               "order", "hide", "disabled", "type", "style")
+    _json_aliases = {"show_filter": "describe", "header": "describe", "columns": "describe",
+                     "rows": "describe", "pages": "describe"}
+    # Атрибуты, из которых берутся поля get_json(); поля из _json_computed
+    # берутся через _delta_value()
+    _json_attrs = {"guid": "_guid", "name": "_name", "code": "_code", "describe": "_describe",
+                   "order": "_order", "type": "_type"}
+    _json_computed = ()
+    _tracked_lists = ("items",)
+    _tracked_values = ("_describe", "value", "default_value")
 
     def __init__(self, **kwargs) -> None:
         self._guid = kwargs['guid']
@@ -94,7 +436,43 @@ class BaseControl:
         return f'<{self.__class__.__name__}: {self.name}>'
 
     def __repr__(self) -> str:
-        return f'<{self.__class__.__name__}: {self.__dict__}>'
+        return f'<{self.__class__.__name__}: {self.name}>'
+
+    def _start_tracking(self, owner=None):
+        super()._start_tracking(owner)
+        object.__setattr__(self, '_dirty_items', set())
+        for item in getattr(self, 'items', ()):
+            item._start_tracking(self)
+
+    def _child_dirty(self, child):
+        self._dirty_items.add(child)
+        if self._owner is not None:
+            self._owner._child_dirty(self)
+
+    def mark_clean(self):
+        super().mark_clean()
+        if self.is_tracked:
+            for item in self._dirty_items:
+                item.mark_clean()
+            self._dirty_items.clear()
+
+    def _delta_value(self, field: str):
+        if field == "describe":
+            return self._describe
+        if field == "items":
+            return [item.get_json() for item in self.items]
+        return getattr(self, field)
+
+    def get_delta(self):
+        delta = {field: self._delta_value(field)
+                 for field in self.dirty_fields if field in self._fields}
+        if "items" not in delta and getattr(self, '_dirty_items', None):
+            if any(item.id is None for item in self._dirty_items):
+                delta["items"] = self._delta_value("items")
+            else:
+                delta["items_delta"] = {item.id: item.get_delta()
+                                        for item in self._dirty_items}
+        return delta
 
     def get_json(self):
         return {
@@ -112,7 +490,50 @@ class BaseControl:
                 "style": self.style
             }
 
+_item_version = 0
+
+def _items_changed(owner):
+    # Изменились id или состав элементов. Элементы без владельца (контрол
+    # ещё не гидратирован) не знают своего контрола: тогда сбрасываются
+    # индексы всех контролов через общую версию
+    global _item_version
+    if owner is not None:
+        owner._invalidate_item_index()
+    else:
+        _item_version += 1
+
+class ItemsControl(BaseControl):
+    # Контрол со списком элементов и индексом id -> элемент
+    _item_class = Item
+
+    def _list_changed(self, name: str):
+        if name == "items":
+            self._invalidate_item_index()
+        super()._list_changed(name)
+
+    def _invalidate_item_index(self):
+        object.__setattr__(self, '_item_index', None)
+
+    def _iter_items(self):
+        return iter(self.items)
+
+    def _build_item_index(self) -> dict:
+        index = {}
+        for item in self._iter_items():
+            if item.id is not None:
+                index.setdefault(item.id, item)
+        return index
+
+    def get_item(self, id):
+        index = getattr(self, '_item_index', None)
+        if index is None or self._item_index_version != _item_version:
+            object.__setattr__(self, '_item_index_version', _item_version)
+            index = self._build_item_index()
+            object.__setattr__(self, '_item_index', index)
+        return index.get(id)
+
 class TextBox(BaseControl):
+    _fields = BaseControl._fields + ("value", "default_value")
 
     def __init__(self, **kwargs) -> None:
         super().__init__(**kwargs)
@@ -129,6 +550,8 @@ class TextBox(BaseControl):
 # TODO проверка на datetime тип и преобразование в нормализованный вид
 # TODO протестить на рабочей
 class Calendar(BaseControl):
+    _fields = BaseControl._fields + ("value", "default_value")
+    _json_computed = ("value",)
 
     def __init__(self, **kwargs) -> None:
         super().__init__(**kwargs)
@@ -136,6 +559,11 @@ class Calendar(BaseControl):
         self.value = date.fromisoformat(kwargs['value']) if isinstance(kwargs['value'], str) else None
         self.default_value = kwargs['default_value']
 
+    def _delta_value(self, field: str):
+        if field == "value":
+            return self.value.isoformat() if self.value is not None else None
+        return super()._delta_value(field)
+
     def get_json(self):
         upper_json = super().get_json()
         return upper_json | {
@@ -143,7 +571,8 @@ class Calendar(BaseControl):
             "default_value": self.default_value
         }
 
-class CheckBoxList(BaseControl):
+class CheckBoxList(ItemsControl):
+    _fields = BaseControl._fields + ("value", "default_value", "items")
 
     def __init__(self, **kwargs) -> None:
         super().__init__(**kwargs)
@@ -169,7 +598,8 @@ class CheckBoxList(BaseControl):
             "items": [item.get_json() for item in self.items]
         }
 
-class DropDownList(BaseControl):
+class DropDownList(ItemsControl):
+    _fields = BaseControl._fields + ("value", "default_value", "items")
 
     def __init__(self, **kwargs) -> None:
         super().__init__(**kwargs)
@@ -200,7 +630,8 @@ class Button(BaseControl):
     def __init__(self, **kwargs) -> None:
         super().__init__(**kwargs)
 
-class GroupList(BaseControl):
+class GroupList(ItemsControl):
+    _fields = BaseControl._fields + ("items",)
     # TODO переделать структуру контролла и описать стрктуру describe
     def __init__(self, **kwargs) -> None:
         super().__init__(**kwargs)
@@ -222,11 +653,60 @@ class GroupList(BaseControl):
             "items": [item.get_json() for item in self.items]
         }
 
-class TreeView(BaseControl):
+class TreeView(ItemsControl):
+    _fields = BaseControl._fields + ("items",)
+    _item_class = TreeItem
 
     def __init__(self, **kwargs) -> None:
         super().__init__(**kwargs)
-        self.items = [TreeItem(**item) for item in kwargs.get('items', [])]
+        # describe.lazy: потомки свёрнутых узлов подгружаются через expand_item()
+        self._lazy = self._describe.get("lazy", config.TREE_VIEW_LAZY)
+        self.items = [TreeItem(lazy=self._lazy, **item) for item in kwargs.get('items', [])]
+        self.provider = None
+
+    def _iter_items(self):
+        # Только загруженные узлы: отложенные поддеревья не разворачиваются
+        stack = list(reversed(self.items))
+        while stack:
+            item = stack.pop()
+            yield item
+            stack.extend(reversed(item._loaded_children()))
+
+    def _load_path(self, id) -> bool:
+        # Подгружает свёрнутый узел, в сырых потомках которого есть id
+        for node in self._iter_items():
+            if node._raw_children is not None and _raw_contains(node._raw_children, id):
+                node._load_children()
+                self._invalidate_item_index()
+                return True
+        return False
+
+    def get_item(self, id):
+        item = super().get_item(id)
+        while item is None and self._load_path(id):
+            item = super().get_item(id)
+        return item
+
+    def set_provider(self, provider):
+        # provider(item) -> список словарей или TreeItem - потомки узла
+        object.__setattr__(self, 'provider', provider)
+
+    def expand_item(self, id) -> TreeItem:
+        item = self.get_item(id)
+        if item is None:
+            raise KeyError(id)
+        if not item.is_loaded:
+            item._load_children()
+        elif not item._loaded_children() and self.provider is not None:
+            children = [child if isinstance(child, TreeItem) else TreeItem(lazy=self._lazy, **child)
+                        for child in self.provider(item)]
+            if item.is_tracked:
+                for child in children:
+                    child._start_tracking(item._owner)
+            item.children = children
+        item.expand = True
+        self._invalidate_item_index()
+        return item
 
     def get_json(self):
         upper_json = super().get_json()
@@ -234,14 +714,42 @@ class TreeView(BaseControl):
             "items": [item.get_json() for item in self.items]
         }
 
+def _raw_contains(raw_children: list, id) -> bool:
+    stack = [raw_children]
+    while stack:
+        raw = stack.pop()
+        if not isinstance(raw, list):
+            continue
+        for node in raw:
+            if node.get('id') == id:
+                return True
+            stack.append(node.get('children'))
+    return False
+
+def query_provider(query, parent_field, to_item):
+    # Провайдер потомков из запроса peewee: query.where(parent_field == item.id),
+    # to_item(row) -> словарь для TreeItem
+    def provider(item: TreeItem) -> list:
+        return [to_item(row) for row in query.where(parent_field == item.id)]
+    return provider
+
 class DataView(BaseControl):
 
     def __init__(self, **kwargs) -> None:
         super().__init__(**kwargs)
         self._columns = self._describe.get("columns", [])
         self._rows = self._describe.get("rows", [])
-        # FIXME поменять логику страниц у контролла !!!
-        self._pages = []
+        # После load_page: {"page_size": ..., "next": курсор, "prev": курсор}
+        self._pages = self._describe.get("pages", [])
+        self._paginator = None
+
+    def _start_tracking(self, owner=None):
+        super()._start_tracking(owner)
+        # columns, rows и pages - те же объекты, что и в отслеживаемом describe
+        init = object.__setattr__
+        for name in ("columns", "rows", "pages"):
+            if name in self._describe:
+                init(self, f'_{name}', self._describe[name])
 
     @property
     def columns(self):
@@ -249,8 +757,8 @@ class DataView(BaseControl):
 
     @columns.setter
     def columns(self, value: list):
-        self._columns = value
         self._describe['columns'] = value
+        self._columns = self._describe['columns']
 
     @property
     def rows(self):
@@ -258,17 +766,42 @@ class DataView(BaseControl):
 
     @rows.setter
     def rows(self, value: list):
-        self._rows = value
         self._describe['rows'] = value
+        self._rows = self._describe['rows']
 
     @property
     def pages(self):
         return self._pages
 
     @pages.setter
-    def pages(self, value: list):
-        self._pages = value
+    def pages(self, value):
         self._describe['pages'] = value
+        self._pages = self._describe['pages']
+
+    def bind(self, query, columns: dict, key: str, page_size: int = None):
+        # columns: код колонки -> поле peewee, key - уникальная колонка.
+        # Например: bind(Retaildemand.select(), {"id": Retaildemand.id,
+        #                "code": Retaildemand.code}, key="id")
+        page_size = page_size or self._describe.get("page_size") or config.DATA_VIEW_PAGE_SIZE
+        self._paginator = KeysetPaginator(query, columns, key, int(page_size))
+        if not self._columns:
+            self.columns = [{"code": name} for name in columns]
+        return self
+
+    def load_page(self, cursor: str = None) -> list:
+        # Курсор, сортировка и фильтры приходят с фронта в describe:
+        # {"cursor": ..., "sort": [{"column": ..., "desc": ...}],
+        #  "filters": [{"column": ..., "op": "eq", "value": ...}]}
+        if self._paginator is None:
+            raise ValueError("DataView is not bound to a query")
+        page = self._paginator.page(
+            cursor=cursor if cursor is not None else self._describe.get("cursor"),
+            sort=self._describe.get("sort"),
+            filters=self._describe.get("filters")
+        )
+        self.rows = page["rows"]
+        self.pages = page["pages"]
+        return self.rows
 
     def get_json(self):
         # TODO: дописать логику get_json()
@@ -282,6 +815,7 @@ class FileDownload(BaseControl):
         self.file_id = kwargs['url']
 
 class Alert(BaseControl):
+    _fields = BaseControl._fields + ("value", "default_value")
 
     def __init__(self, **kwargs) -> None:
         super().__init__(**kwargs)
@@ -306,6 +840,7 @@ class Alert(BaseControl):
         }
 
 class Comment(BaseControl):
+    _fields = BaseControl._fields + ("value", "default_value")
 
     def __init__(self, **kwargs) -> None:
         super().__init__(**kwargs)
@@ -333,7 +868,84 @@ _control_types = {
     "comment": Comment
 }
 
-class StepSession:
+class LazyList:
+    # Сырые словари из API, которые превращаются в объекты при первом
+    # обращении, с индексами по code и guid. Пока список целиком не
+    # запрошен, индексы указывают на позиции в сырых данных.
+
+    def __init__(self, raw, factory, owner: Tracked, field: str) -> None:
+        self._raw = list(raw) if raw is not None else []
+        self._factory = factory
+        self._owner = owner
+        self._field = field
+        self._materialized = {}
+        self._list = None
+        self._indexes = None
+
+    def __len__(self) -> int:
+        return len(self._list) if self._list is not None else len(self._raw)
+
+    def at(self, index: int):
+        if self._list is not None:
+            return self._list[index]
+        obj = self._materialized.get(index)
+        if obj is None:
+            with metrics.span("hydration"):
+                obj = self._materialized[index] = self._factory(self._raw[index])
+        return obj
+
+    def all(self) -> TrackedList:
+        if self._list is None:
+            self._list = TrackedList((self.at(index) for index in range(len(self._raw))),
+                                     owner=self._owner, field=self._field)
+        return self._list
+
+    def materialized(self):
+        if self._list is not None:
+            return [obj for obj in self._list if obj is not None]
+        return list(self._materialized.values())
+
+    def invalidate(self):
+        self._indexes = None
+
+    def _build_indexes(self) -> dict:
+        by_code, by_guid = {}, {}
+        if self._list is not None:
+            for index, obj in enumerate(self._list):
+                if obj is not None:
+                    by_code.setdefault(obj.code, index)
+                    by_guid.setdefault(obj.guid, index)
+        else:
+            for index, raw in enumerate(self._raw):
+                by_code.setdefault(raw['code'], index)
+                by_guid.setdefault(raw['guid'], index)
+        return {"code": by_code, "guid": by_guid}
+
+    def find(self, key: str, value):
+        if self._indexes is None:
+            self._indexes = self._build_indexes()
+        index = self._indexes[key].get(value)
+        return self.at(index) if index is not None else None
+
+    def entries(self):
+        # (guid, объект или None, сырой словарь или None)
+        if self._list is not None:
+            for obj in self._list:
+                if obj is not None:
+                    yield obj.guid, obj, None
+        else:
+            materialized = self._materialized
+            for index, raw in enumerate(self._raw):
+                yield raw['guid'], materialized.get(index), raw
+
+    def get_json(self, raw_json=None) -> dict:
+        return {guid: (obj.get_json() if obj is not None
+                       else raw_json(raw) if raw_json is not None else raw)
+                for guid, obj, raw in self.entries()}
+
+class StepSession(Tracked):
+    # Контролы хранятся сырыми словарями из API и создаются при первом
+    # обращении; нетронутые контролы уходят в get_json() как есть
 
     def __init__(self, guid: str, name: str, code: str,
                  description: str|None, controls=None) -> None:
@@ -341,8 +953,7 @@ class StepSession:
         self._name = name
         self._code = code
         self._description = description
-        self._controls = [_control_types[control['type']](**control)
-                          for control in controls] if controls is not None else []
+        self._controls = LazyList(controls, self._make_control, owner=self, field="controls")
 
     @property
     def guid(self):
@@ -362,7 +973,17 @@ class StepSession:
 
     @property
     def controls(self):
-        return self._controls
+        return self._controls.all()
+
+    def _make_control(self, raw: dict):
+        control = _control_types[raw['type']](**raw)
+        if self.is_tracked:
+            control._start_tracking(self)
+        return control
+
+    def _list_changed(self, name: str):
+        self._controls.invalidate()
+        super()._list_changed(name)
 
     def __str__(self) -> str:
         return f'<StepSession: {self.name}>'
@@ -370,52 +991,143 @@ class StepSession:
     def __repr__(self) -> str:
         return f'<StepSession: {self.name}>'
 
+    def _start_tracking(self, owner=None):
+        super()._start_tracking(owner)
+        object.__setattr__(self, '_dirty_controls', set())
+        for control in self._controls.materialized():
+            control._start_tracking(self)
+
+    def _child_dirty(self, child):
+        self._dirty_controls.add(child)
+        if self._owner is not None:
+            self._owner._child_dirty(self)
+
+    def mark_clean(self):
+        super().mark_clean()
+        if self.is_tracked:
+            for control in self._dirty_controls:
+                control.mark_clean()
+            self._dirty_controls.clear()
+
     def get_json(self):
         return {
                 "guid": self._guid,
                 "name": self._name,
                 "code": self._code,
                 "description": self._description,
-                "controls": {control.guid: control.get_json() for control in self.controls if control is not None}
+                "controls": self._controls.get_json()
         }
 
-    def get_control(self, code: str):
-        found_control = next(filter(lambda x: x.code == code, self.controls), None)
-        return found_control
+    def get_delta(self):
+        # None - изменилась структура шага, нужен полный снимок
+        if not self.is_tracked or "controls" in self.dirty_fields:
+            return None
+        return {
+            "controls": {control.guid: control.get_delta() for control in self._dirty_controls}
+        }
 
-class WidgetSession:
+    def get_control(self, code: str):
+        return self._controls.find('code', code)
+
+    def get_control_by_guid(self, guid: str):
+        return self._controls.find('guid', guid)
+
+    def add_control(self, control: BaseControl):
+        self.controls.append(control)
+
+    def replace_control(self, control: BaseControl):
+        controls = self.controls
+        for index, current in enumerate(controls):
+            if current is not None and current.guid == control.guid:
+                controls[index] = control
+                return
+        raise KeyError(control.guid)
+
+def _raw_step_json(step: dict) -> dict:
+    return {
+        "guid": step['guid'],
+        "name": step['name'],
+        "code": step['code'],
+        "description": step['description'],
+        "controls": {control['guid']: control for control in step['controls'] or ()}
+    }
+
+class WidgetSession(Tracked):
+    # Шаги создаются при первом обращении (get_step, get_current_step, steps)
+    _fields = ("guid", "current_step", "code", "name", "status", "description", "async_execute")
 
     def __init__(self, guid: str) -> None:
         self._guid = guid
         self.get_widget_session()
 
+    @staticmethod
+    def prefetch(guid: str):
+        # Ответ забирает первый WidgetSession(guid) или load(guid) в задаче
+        _prefetched.set((guid, api.post_background(
+            "/celery/get_widget_session",
+            json={"guid": guid},
+            timeout=1
+        )))
+
+    @staticmethod
+    def discard_prefetch():
+        _prefetched.set(None)
+
+    @staticmethod
+    def _take_prefetched(guid: str):
+        prefetched = _prefetched.get()
+        if prefetched is None or prefetched[0] != guid:
+            return None
+        _prefetched.set(None)
+        return prefetched[1]
+
+    @classmethod
+    async def load(cls, guid: str) -> 'WidgetSession':
+        # Для задач async def: ожидание API не блокирует цикл событий
+        self = cls.__new__(cls)
+        self._guid = guid
+        prefetched = cls._take_prefetched(guid)
+        if prefetched is not None:
+            request = await asyncio.wrap_future(prefetched)
+        else:
+            request = await api.post_async(
+                "/celery/get_widget_session",
+                json={"guid": guid},
+                timeout=1
+            )
+        self._receive(request)
+        return self
+
     def get_widget_session(self):
-        s = requests.Session()
-        retry_strategy = Retry(
-            total=5,
-            backoff_factor=0.1,
-            status_forcelist=[500,502,503,504]
+        prefetched = self._take_prefetched(self.guid)
+        if prefetched is not None:
+            request = prefetched.result()
+        else:
+            request = api.post(
+                "/celery/get_widget_session",
+                json={"guid": self.guid},
+                timeout=1
             )
-        s.mount(f'{API_URL}', HTTPAdapter(max_retries=retry_strategy))
-        request = s.post(
-            url=f"{API_URL}/celery/get_widget_session",
-            json={"guid": self.guid},
-            headers={"Authorization": f"Bearer {API_TOKEN}"},
-            timeout=1
-        )
+        self._receive(request)
 
+    def _receive(self, request):
         if request.status_code != requests.codes.ok:
             # TODO обсудить логгирование критических ошибок
             logging.critical("API not working!")
             raise SystemError('API not working!')
 
-        data = request.json()
+        with metrics.span("hydration"):
+            data = request.json()
 
-        if data['code'] != 0:
-            raise ValueError(data['msg'])
+            if data['code'] != 0:
+                raise ValueError(data['msg'])
 
-        widget_session_data = data['data']["widget"]
-        steps_data = data['data']['steps']
+            self._load(data['data'])
+
+    def _load(self, data: dict):
+        object.__setattr__(self, '_dirty', None)
+        widget_session_data = data["widget"]
+        steps_data = data['steps']
 
         self.current_step = widget_session_data['current_step']
         # self.next_step = widget_session_data['next_step']
@@ -428,13 +1140,40 @@ class WidgetSession:
         self._settings = widget_session_data.get('settings', {})
         self.expand_data = widget_session_data['expand_data']
 
-        self._steps = [StepSession(
-            guid=step['guid'],
-            name=step['name'],
-            code=step['code'],
-            description=step['description'],
-            controls=step['controls']
-        ) for step in steps_data]
+        self._steps = LazyList(steps_data, self._make_step, owner=self, field="steps")
+        self._start_tracking()
+
+    def _make_step(self, raw: dict) -> StepSession:
+        step = StepSession(
+            guid=raw['guid'],
+            name=raw['name'],
+            code=raw['code'],
+            description=raw['description'],
+            controls=raw['controls']
+        )
+        if self.is_tracked:
+            step._start_tracking(self)
+        return step
+
+    def _list_changed(self, name: str):
+        self._steps.invalidate()
+        super()._list_changed(name)
+
+    def _start_tracking(self, owner=None):
+        super()._start_tracking(owner)
+        object.__setattr__(self, '_dirty_steps', set())
+        for step in self._steps.materialized():
+            step._start_tracking(self)
+
+    def _child_dirty(self, child):
+        self._dirty_steps.add(child)
+
+    def mark_clean(self):
+        super().mark_clean()
+        if self.is_tracked:
+            for step in self._dirty_steps:
+                step.mark_clean()
+            self._dirty_steps.clear()
 
     @property
     def guid(self):
@@ -466,7 +1205,7 @@ class WidgetSession:
 
     @property
     def steps(self):
-        return self._steps
+        return self._steps.all()
 
     @property
     def settings(self):
@@ -491,16 +1230,47 @@ class WidgetSession:
                 "description": self._description,
                 "async_execute": self._async_execute
             },
-            "steps": {step.guid: step.get_json() for step in self._steps} if self._steps is not None else {}
+            "steps": self._steps.get_json(_raw_step_json)
+        }
+
+    def get_delta(self):
+        # Только изменённые с момента загрузки поля, контролы и элементы.
+        # None - изменилась структура сессии, нужен полный снимок get_json()
+        if not self.is_tracked or "steps" in self.dirty_fields:
+            return None
+        steps = {}
+        for step in self._dirty_steps:
+            step_delta = step.get_delta()
+            if step_delta is None:
+                return None
+            steps[step.guid] = step_delta
+        widget = {"guid": self._guid}
+        widget.update({field: getattr(self, field)
+                       for field in self.dirty_fields if field in self._fields})
+        return {
+            "widget": widget,
+            "steps": steps
         }
 
     def get_step(self, code: str) -> StepSession:
-        found_step = next(filter(lambda x: x.code == code, self.steps), None)
-        return found_step
+        return self._steps.find('code', code)
+
+    def get_step_by_guid(self, guid: str) -> StepSession:
+        return self._steps.find('guid', guid)
 
     def get_current_step(self) -> StepSession:
-        found_step = next(filter(lambda x: x.guid == self.current_step, self.steps), None)
-        return found_step
+        return self._steps.find('guid', self.current_step)
+
+    def add_step(self, step: StepSession):
+        self.steps.append(step)
+
+    def replace_step(self, step: StepSession):
+        steps = self.steps
+        for index, current in enumerate(steps):
+            if current.guid == step.guid:
+                steps[index] = step
+                return
+        raise KeyError(step.guid)
 
 class Response:
 
@@ -522,19 +1292,29 @@ class Webhook:
         self.data = kwargs['data']
         self.settings = self._get_settings()
 
+    @classmethod
+    async def load(cls, **kwargs) -> 'Webhook':
+        # Для задач async def: настройки загружаются в пуле потоков цикла
+        return await asyncio.to_thread(cls, **kwargs)
+
     def _get_settings(self) -> dict:
-        s = requests.Session()
-        retry_strategy = Retry(
-            total=5,
-            backoff_factor=0.1,
-            status_forcelist=[500,502,503,504]
-            )
-        s.mount(f'{API_URL}', HTTPAdapter(max_retries=retry_strategy))
-        request = s.post(
-            url=f"{API_URL}/celery/get_settings",
+        # Копия: изменения настроек в обработчике не должны попасть в кэш
+        # и в следующие вебхуки
+        return copy.deepcopy(settings_cache.get_or_load((self.app_guid, self.account_guid),
+                                                        self._fetch_settings))
+
+    @staticmethod
+    def invalidate_settings(app_guid: str = None, account_guid: str = None):
+        if app_guid is None and account_guid is None:
+            settings_cache.invalidate()
+        else:
+            settings_cache.invalidate((app_guid, account_guid))
+
+    def _fetch_settings(self) -> dict:
+        request = api.post(
+            "/celery/get_settings",
             json={"app_guid": self.app_guid,
                   "account_guid": self.account_guid},
-            headers={"Authorization": f"Bearer {API_TOKEN}"},
             timeout=1
         )
         if request.status_code != requests.codes.ok:
@@ -550,3 +1330,6 @@ class Webhook:
 
     def __repr__(self) -> str:
         return f'<Webhook: {self.requestId}>'
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=settings_cache._reset)
@@ -0,0 +1,198 @@
+
+import os
+import math
+import time
+import hashlib
+import logging
+import threading
+
+from peewee import CharField, DateTimeField, Model
+
+from appdir.cache import TTLCache
+from database import db
+from config import CeleryConfig
+config = CeleryConfig()
+
+logger = logging.getLogger(__name__)
+
+# Защита от повторной доставки вебхуков. Ключ - account_guid и requestId
+# (или guid) вебхука. Источник истины - таблица webhook_idempotency:
+# ключи захватываются одним INSERT ... ON CONFLICT на пачку со статусом
+# processing и короткой арендой IDEMPOTENCY_LEASE; после успешной обработки
+# ключ получает статус done на IDEMPOTENCY_TTL. Дубль - ключ done или ключ
+# с неистёкшей арендой: если воркер погиб посреди обработки, аренда истекает
+# и повторная доставка обрабатывается заново. Ключи done, отмеченные этим
+# процессом, отсекаются локально без запроса в БД: фильтр Блума отвечает
+# "точно не видели", набор последних ключей подтверждает дубль. Если
+# обработка не удалась, захват снимается сразу.
+
+
+class IdempotencyKey(Model):
+    key = CharField(max_length=255, primary_key=True)
+    status = CharField(max_length=16, default='processing')
+    expires = DateTimeField(index=True)
+
+    class Meta:
+        database = db
+        table_name = 'webhook_idempotency'
+
+
+class BloomFilter:
+
+    def __init__(self, capacity: int, error_rate: float) -> None:
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+
+def webhook_key(webhook_request: dict) -> str:
+    return f"{webhook_request.get('account_guid')}:{webhook_request.get('requestId') or webhook_request['guid']}"
+
+
+def install():
+    db.connect(reuse_if_open=True)
+    try:
+        IdempotencyKey.create_table(safe=True)
+    finally:
+        db.close()
+
+
+class IdempotencyGuard:
+
+    def __init__(self,
+                 ttl: float = config.IDEMPOTENCY_TTL,
+                 lease: float = config.IDEMPOTENCY_LEASE,
+                 capacity: int = config.IDEMPOTENCY_BLOOM_CAPACITY,
+                 error_rate: float = config.IDEMPOTENCY_BLOOM_ERROR_RATE,
+                 recent_size: int = config.IDEMPOTENCY_RECENT_SIZE) -> None:
+        self.ttl = ttl
+        self.lease = lease
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.recent_size = recent_size
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._bloom = BloomFilter(self.capacity, self.error_rate)
+        self._bloom_started = time.monotonic()
+        self._recent = TTLCache(ttl=self.ttl, maxsize=self.recent_size)
+        self._cleaned = time.monotonic()
+        self.skipped_local = 0
+        self.skipped_database = 0
+        self.claimed = 0
+        self.completed = 0
+        self.released = 0
+
+    def _remember(self, keys):
+        with self._lock:
+            # Из фильтра Блума нельзя удалять: он пересоздаётся, когда
+            # заполнен или старше TTL
+            if (self._bloom.count + len(keys) > self.capacity
+                    or time.monotonic() - self._bloom_started > self.ttl):
+                self._bloom = BloomFilter(self.capacity, self.error_rate)
+                self._bloom_started = time.monotonic()
+            for key in keys:
+                self._bloom.add(key)
+        for key in keys:
+            self._recent.set(key, True)
+
+    def _seen(self, key: str) -> bool:
+        return key in self._bloom and self._recent.get(key, False)
+
+    def claim(self, keys: list) -> list:
+        # Для каждого ключа: True - дубль, False - ключ захвачен этим процессом
+        # на время аренды. Повтор ключа в том же списке - дубль первого вхождения.
+        # Истёкшая аренда и истёкший done захватываются заново.
+        pending = list(dict.fromkeys(key for key in keys if not self._seen(key)))
+        claimed = set()
+        if pending:
+            cursor = db.execute_sql('''
+            INSERT INTO webhook_idempotency (key, status, expires)
+            SELECT key, 'processing', now() + %s * interval '1 second' FROM unnest(%s::text[]) AS key
+            ON CONFLICT (key) DO UPDATE SET status = EXCLUDED.status, expires = EXCLUDED.expires
+                WHERE webhook_idempotency.expires < now()
+            RETURNING key''', (self.lease, pending))
+            claimed = {row[0] for row in cursor.fetchall()}
+            self.claimed += len(claimed)
+            self._cleanup()
+        pending = set(pending)
+        first = set()
+        duplicates = []
+        for key in keys:
+            duplicate = key not in claimed or key in first
+            first.add(key)
+            duplicates.append(duplicate)
+            if not duplicate:
+                continue
+            if key in pending and key not in claimed:
+                self.skipped_database += 1
+            else:
+                self.skipped_local += 1
+        return duplicates
+
+    def complete(self, keys: list):
+        # Обработка успешна: ключ - дубль на IDEMPOTENCY_TTL. Локально
+        # запоминаются только такие ключи
+        if not keys:
+            return
+        db.execute_sql('''
+        UPDATE webhook_idempotency SET status = 'done', expires = now() + %s * interval '1 second'
+        WHERE key = ANY(%s) AND status = 'processing'
+        ''', (self.ttl, list(keys)))
+        self._remember(keys)
+        self.completed += len(keys)
+
+    def release(self, keys: list):
+        if not keys:
+            return
+        db.execute_sql("DELETE FROM webhook_idempotency WHERE key = ANY(%s) AND status = 'processing'",
+                       (list(keys),))
+        for key in keys:
+            self._recent.invalidate(key)
+        self.released += len(keys)
+
+    def _cleanup(self):
+        # Истёкшие ключи удаляются порциями не чаще IDEMPOTENCY_CLEANUP_INTERVAL
+        if time.monotonic() - self._cleaned < config.IDEMPOTENCY_CLEANUP_INTERVAL:
+            return
+        self._cleaned = time.monotonic()
+        try:
+            db.execute_sql('''
+            DELETE FROM webhook_idempotency WHERE key IN (
+                SELECT key FROM webhook_idempotency WHERE expires < now() LIMIT 10000)''')
+        except Exception:
+            logger.warning("Idempotency cleanup failed", exc_info=True)
+
+    def stats(self) -> dict:
+        return {
+            "skipped_local": self.skipped_local,
+            "skipped_database": self.skipped_database,
+            "claimed": self.claimed,
+            "completed": self.completed,
+            "released": self.released,
+        }
+
+
+guard = IdempotencyGuard()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=guard._reset)
@@ -0,0 +1,157 @@
+
+import sys
+import json
+import time
+import hashlib
+import logging
+import threading
+import importlib
+from pathlib import Path
+
+from appdir import api
+from config import CeleryConfig
+config = CeleryConfig()
+
+logger = logging.getLogger(__name__)
+
+# Манифест задач: коды задач и хэши содержимого их модулей. Регистрация
+# на API повторяется, только если манифест изменился с последней успешной
+# регистрации (дайджест хранится в TASK_MANIFEST_PATH).
+
+
+class ImportReport:
+    # Время импорта модулей при старте воркера
+
+    def __init__(self) -> None:
+        self.entries = []
+
+    def measure(self, name: str, func, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.entries.append((name, time.perf_counter() - start))
+
+    @property
+    def total(self) -> float:
+        return sum(duration for _, duration in self.entries)
+
+    def format(self, limit: int = 20) -> str:
+        lines = [f'*** Импорт модулей: {self.total * 1000:.1f} мс ***']
+        for name, duration in sorted(self.entries, key=lambda entry: -entry[1])[:limit]:
+            lines.append(f'    {duration * 1000:8.1f} мс  {name}')
+        return '\n'.join(lines)
+
+
+def packages(path: Path, code_root: Path) -> list:
+    return ['.'.join(x.relative_to(code_root).parts)
+            for x in path.glob('*/*')
+            if x.is_dir() and not str(x.name).startswith("__")]
+
+
+def catalogs(path: Path, code_root: Path) -> list:
+    return ['.'.join(x.relative_to(code_root).with_suffix('').parts)
+            for x in path.glob('*/models.py') if x.is_file()]
+
+
+def import_modules(app, code_root: Path, report: ImportReport) -> tuple:
+    # Порядок как раньше: action приложений, models, action вебхуков
+    application_path = code_root / 'applications'
+    webhooks_path = code_root / 'webhooks'
+    application_packages = packages(application_path, code_root)
+    webhooks_packages = packages(webhooks_path, code_root)
+
+    for package in application_packages:
+        report.measure(f'{package}.action', app.autodiscover_tasks,
+                       packages=[package], related_name='action', force=True)
+    for module in sorted(set(catalogs(application_path, code_root)
+                             + catalogs(webhooks_path, code_root))):
+        report.measure(module, importlib.import_module, module)
+    for package in webhooks_packages:
+        report.measure(f'{package}.action', app.autodiscover_tasks,
+                       packages=[package], related_name='action', force=True)
+    return application_packages, webhooks_packages
+
+
+def _file_hash(filename: str) -> str:
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def build_manifest(application_tasks: list, webhook_tasks: list) -> dict:
+    modules = {}
+    for name, module in list(sys.modules.items()):
+        filename = getattr(module, '__file__', None)
+        if filename and name.split('.')[0] in ('applications', 'webhooks'):
+            modules[name] = _file_hash(filename)
+    manifest = {
+        "application_task_codes": sorted(application_tasks),
+        "webhook_task_codes": sorted(webhook_tasks),
+        "modules": dict(sorted(modules.items())),
+        "api_url": config.API_URL,
+    }
+    manifest["digest"] = hashlib.sha1(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+    return manifest
+
+
+def load_cached(path: str = config.TASK_MANIFEST_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save(manifest: dict, path: str = config.TASK_MANIFEST_PATH):
+    target = Path(path)
+    try:
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_name(target.name + '.tmp')
+        tmp.write_text(json.dumps(manifest))
+        tmp.replace(target)
+    except OSError:
+        logger.warning("Task manifest %s is not writable", path)
+
+
+def is_changed(manifest: dict, path: str = config.TASK_MANIFEST_PATH) -> bool:
+    cached = load_cached(path)
+    return cached is None or cached.get("digest") != manifest["digest"]
+
+
+def register(manifest: dict, timeout: float = 120) -> dict:
+    register_tasks = api.post("/register_tasks",
+                              data=json.dumps({"application_task_codes": manifest["application_task_codes"],
+                                               "webhook_task_codes": manifest["webhook_task_codes"]}),
+                              headers=config.api_headers,
+                              timeout=timeout)
+    if register_tasks.status_code != 200:
+        logging.critical("API not working!")
+        raise SystemError('Celery not working!')
+    data = register_tasks.json()['data']
+    print(f'''*** Регистрация задач ***
+    Незарегестрированные виджеты: {data['widget_not_found']}
+    Незарегестрированные вебхуки: {data['webhooks_not_found']}''')
+    save(manifest)
+    return data
+
+
+def register_async(manifest: dict,
+                   retries: int = config.TASK_REGISTRATION_RETRIES,
+                   backoff: float = config.TASK_REGISTRATION_BACKOFF) -> threading.Thread:
+    # Регистрация в фоне: воркер уже принимает задачи, ошибки API не
+    # останавливают запуск, попытки повторяются с экспоненциальной паузой
+    def run():
+        for attempt in range(retries + 1):
+            try:
+                register(manifest, timeout=config.API_TIMEOUT)
+                return
+            except Exception:
+                logger.warning("Task registration failed (attempt %s of %s)",
+                               attempt + 1, retries + 1, exc_info=True)
+            if attempt < retries:
+                time.sleep(backoff * 2 ** attempt)
+        logging.critical("API not working!")
+
+    thread = threading.Thread(target=run, name='task-registration', daemon=True)
+    thread.start()
+    return thread
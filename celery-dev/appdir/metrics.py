@@ -0,0 +1,361 @@
+
+import os
+import json
+import time
+import atexit
+import bisect
+import shutil
+import logging
+import threading
+from pathlib import Path
+from contextvars import ContextVar
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from config import CeleryConfig
+config = CeleryConfig()
+
+logger = logging.getLogger(__name__)
+
+# Гистограммы времени по участкам горячего пути (API, гидратация,
+# сериализация, БД, тело задачи) в разрезе задач. Внутри задачи время
+# участков суммируется и попадает в гистограмму один раз при завершении
+# задачи, вне задач (фоновые потоки) - при каждом замере.
+# Процессы prefork сбрасывают снимки в METRICS_DIR/<pid главного процесса>,
+# чтобы воркеры на одном хосте не смешивали снимки; главный процесс
+# объединяет их и отдаёт в формате Prometheus по HTTP (METRICS_PORT)
+# и/или пишет в METRICS_FILE (textfile collector node_exporter).
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Registry:
+
+    def __init__(self, buckets: tuple = BUCKETS) -> None:
+        self.buckets = buckets
+        # Значения, которые считываются в момент снимка: name -> (тип, описание, функция)
+        self._collectors = {}
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        # (span, task) -> [счётчики по корзинам + переполнение, сумма]
+        self._series = {}
+
+    def observe(self, span: str, task: str, seconds: float):
+        index = bisect.bisect_left(self.buckets, seconds)
+        key = (span, task or "")
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += seconds
+
+    def register(self, name: str, description: str, collect, type: str = 'gauge'):
+        # collect() -> {значение метки state: число}
+        self._collectors[name] = (type, description, collect)
+
+    def _collect(self) -> list:
+        values = []
+        for name, (type, description, collect) in self._collectors.items():
+            try:
+                current = collect()
+            except Exception:
+                logger.warning("Metric collector %s failed", name, exc_info=True)
+                continue
+            for state, value in current.items():
+                values.append([name, type, description, state, value])
+        return values
+
+    def snapshot(self) -> dict:
+        values = self._collect()
+        with self._lock:
+            return {"buckets": list(self.buckets),
+                    "series": [[span, task, list(counts), total]
+                               for (span, task), (counts, total) in self._series.items()],
+                    "values": values}
+
+
+registry = Registry()
+
+
+class _TaskMetrics:
+    __slots__ = ("name", "started", "body_started", "spans", "token")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.started = time.perf_counter()
+        self.body_started = None
+        self.spans = defaultdict(float)
+        self.token = None
+
+
+_current = ContextVar('metrics_task', default=None)
+
+
+class span:
+    __slots__ = ("name", "started")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.started
+        current = _current.get()
+        if current is not None:
+            current.spans[self.name] += elapsed
+        elif config.METRICS_ENABLED:
+            registry.observe(self.name, None, elapsed)
+        return False
+
+
+def timed(name: str):
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__wrapped__ = func
+        return wrapper
+    return decorator
+
+
+def task_started(name: str):
+    if not config.METRICS_ENABLED:
+        return
+    current = _TaskMetrics(name)
+    current.token = _current.set(current)
+
+
+def task_body_started():
+    current = _current.get()
+    if current is not None:
+        current.body_started = time.perf_counter()
+
+
+def task_body_finished():
+    current = _current.get()
+    if current is not None and current.body_started is not None:
+        current.spans["body"] += time.perf_counter() - current.body_started
+
+
+def task_finished():
+    current = _current.get()
+    if current is None:
+        return
+    try:
+        _current.reset(current.token)
+    except ValueError:
+        _current.set(None)
+    for name, seconds in current.spans.items():
+        registry.observe(name, current.name, seconds)
+    registry.observe("task", current.name, time.perf_counter() - current.started)
+
+
+def merge(snapshots: list) -> dict:
+    # Гистограммы и значения процессов складываются
+    series = {}
+    values = {}
+    buckets = list(BUCKETS)
+    for snapshot in snapshots:
+        if snapshot.get("buckets") != buckets:
+            continue
+        for name, task, counts, total in snapshot["series"]:
+            current = series.get((name, task))
+            if current is None:
+                series[(name, task)] = [list(counts), total]
+            else:
+                current[0] = [a + b for a, b in zip(current[0], counts)]
+                current[1] += total
+        for name, type, description, state, value in snapshot.get("values", ()):
+            key = (name, type, description, state)
+            values[key] = values.get(key, 0) + value
+    return {"buckets": buckets,
+            "series": [[name, task, counts, total] for (name, task), (counts, total) in series.items()],
+            "values": [list(key) + [value] for key, value in values.items()]}
+
+
+def _label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render(snapshot: dict) -> str:
+    lines = ['# HELP celery_span_seconds Time spent in task hot-path spans.',
+             '# TYPE celery_span_seconds histogram']
+    bounds = [repr(float(bound)) for bound in snapshot["buckets"]] + ['+Inf']
+    for name, task, counts, total in sorted(snapshot["series"]):
+        labels = f'task="{_label(task)}",span="{_label(name)}"'
+        cumulative = 0
+        for bound, count in zip(bounds, counts):
+            cumulative += count
+            lines.append(f'celery_span_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'celery_span_seconds_sum{{{labels}}} {total!r}')
+        lines.append(f'celery_span_seconds_count{{{labels}}} {cumulative}')
+    described = set()
+    for name, type, description, state, value in sorted(snapshot.get("values", ())):
+        if name not in described:
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {type}')
+            described.add(name)
+        lines.append(f'{name}{{state="{_label(str(state))}"}} {value!r}')
+    return '\n'.join(lines) + '\n'
+
+
+def _exporting() -> bool:
+    return config.METRICS_ENABLED and bool(config.METRICS_PORT or config.METRICS_FILE)
+
+
+def _write(path: Path, text: str):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    tmp.write_text(text)
+    tmp.replace(path)
+
+
+_discarded = False
+# pid главного процесса воркера, дочерние процессы наследуют его при fork
+_master = os.getpid()
+
+
+def set_master():
+    # Вызывается в главном процессе до запуска пула (после --detach pid другой)
+    global _master
+    _master = os.getpid()
+
+
+def _snapshots() -> Path:
+    return Path(config.METRICS_DIR) / str(_master)
+
+
+def dump():
+    # Снимок текущего процесса для объединения в главном процессе
+    if _discarded:
+        return
+    try:
+        _write(_snapshots() / f'{os.getpid()}.json', json.dumps(registry.snapshot()))
+    except OSError:
+        logger.warning("Metrics snapshot is not writable", exc_info=True)
+
+
+def discard():
+    # Процесс завершается: его снимок удаляется, иначе значения мёртвого
+    # процесса (соединения пула, состояния автоматов) продолжат суммироваться
+    global _discarded
+    _discarded = True
+    (_snapshots() / f'{os.getpid()}.json').unlink(missing_ok=True)
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect() -> str:
+    snapshots = [registry.snapshot()]
+    own = f'{os.getpid()}.json'
+    # Живой процесс обновляет снимок каждые METRICS_INTERVAL секунд
+    stale = time.time() - 3 * config.METRICS_INTERVAL
+    for path in _snapshots().glob('*.json'):
+        if path.name == own:
+            continue
+        try:
+            if not _alive(int(path.stem)):
+                path.unlink(missing_ok=True)
+                continue
+            if path.stat().st_mtime < stale:
+                continue
+            snapshots.append(json.loads(path.read_text()))
+        except (OSError, ValueError):
+            continue
+    return render(merge(snapshots))
+
+
+class _Exporter:
+
+    def __init__(self) -> None:
+        self._reset()
+
+    def _reset(self):
+        self._dumper = None
+        self._server = None
+        self._writer = None
+
+    def start_dumper(self):
+        if not _exporting() or self._dumper is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(config.METRICS_INTERVAL)
+                dump()
+
+        self._dumper = threading.Thread(target=run, name='metrics-dump', daemon=True)
+        self._dumper.start()
+        atexit.register(dump)
+
+    def start(self):
+        # Главный процесс воркера: каталоги остановленных воркеров удаляются
+        if not _exporting() or self._server is not None or self._writer is not None:
+            return
+        for path in Path(config.METRICS_DIR).glob('*'):
+            if path.is_dir() and path.name.isdigit() and not _alive(int(path.name)):
+                shutil.rmtree(path, ignore_errors=True)
+        if config.METRICS_PORT:
+            class Handler(BaseHTTPRequestHandler):
+
+                def log_message(self, *args):
+                    pass
+
+                def do_GET(self):
+                    body = collect().encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+            try:
+                self._server = ThreadingHTTPServer(('0.0.0.0', config.METRICS_PORT), Handler)
+            except OSError:
+                logger.warning("Metrics port %s is not available", config.METRICS_PORT)
+            else:
+                self._server.daemon_threads = True
+                threading.Thread(target=self._server.serve_forever,
+                                 name='metrics-http', daemon=True).start()
+        if config.METRICS_FILE:
+            def run():
+                while True:
+                    try:
+                        _write(Path(config.METRICS_FILE), collect())
+                    except OSError:
+                        logger.warning("Metrics file is not writable", exc_info=True)
+                    time.sleep(config.METRICS_INTERVAL)
+
+            self._writer = threading.Thread(target=run, name='metrics-file', daemon=True)
+            self._writer.start()
+        self.start_dumper()
+
+
+exporter = _Exporter()
+
+
+def _after_fork():
+    global _discarded
+    _discarded = False
+    registry._reset()
+    exporter._reset()
+    _current.set(None)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,161 @@
+
+import json
+import uuid
+import base64
+import datetime
+import decimal
+from functools import reduce
+import operator
+
+from peewee import Tuple
+
+# Постраничная выборка по ключу (keyset/seek): вместо OFFSET страница
+# продолжается с последнего ключа предыдущей, поэтому стоимость запроса не
+# зависит от номера страницы и размера таблицы. Сортировка и фильтры
+# выполняются в Postgres.
+
+FILTER_OPERATORS = {
+    "eq": operator.eq,
+    "ne": operator.ne,
+    "lt": operator.lt,
+    "lte": operator.le,
+    "gt": operator.gt,
+    "gte": operator.ge,
+    "in": lambda field, value: field.in_(value),
+    "contains": lambda field, value: field.contains(value),
+}
+
+
+def json_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    return value
+
+
+def _cursor_value(value):
+    # str(datetime) понимают и Postgres, и DateTimeField.python_value
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return str(value)
+    return json_value(value)
+
+
+def encode_cursor(values: list, direction: str) -> str:
+    data = json.dumps({"k": [_cursor_value(value) for value in values], "d": direction},
+                      separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return data["k"], data["d"]
+    except (ValueError, KeyError, TypeError):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+
+
+class KeysetPaginator:
+
+    def __init__(self, query, columns: dict, key: str, page_size: int = 50) -> None:
+        # columns: имя колонки -> поле peewee; key - уникальная колонка,
+        # которая добавляется последней в сортировку для однозначности
+        if key not in columns:
+            raise ValueError(f"Key column {key!r} must be one of columns")
+        self.query = query
+        self.columns = columns
+        self.key = key
+        self.page_size = page_size
+
+    def _python_value(self, name: str, value):
+        python_value = getattr(self.columns[name], 'python_value', None)
+        return python_value(value) if python_value is not None and value is not None else value
+
+    def _order(self, sort: list) -> list:
+        order = []
+        for column in sort or ():
+            name = column["column"]
+            if name not in self.columns:
+                raise ValueError(f"Unknown sort column {name!r}")
+            if all(name != n for n, _ in order):
+                order.append((name, bool(column.get("desc", False))))
+            if name == self.key:
+                # Ключ уникален: колонки после него порядок не меняют
+                return order
+        key_desc = order[0][1] if order else False
+        order.append((self.key, key_desc))
+        return order
+
+    def _filters(self, filters: list):
+        conditions = []
+        for item in filters or ():
+            name, op = item["column"], item.get("op", "eq")
+            if name not in self.columns:
+                raise ValueError(f"Unknown filter column {name!r}")
+            if op not in FILTER_OPERATORS:
+                raise ValueError(f"Unknown filter operator {op!r}")
+            conditions.append(FILTER_OPERATORS[op](self.columns[name], item["value"]))
+        return conditions
+
+    def _seek(self, order: list, values: list, forward: bool):
+        fields = [self.columns[name] for name, _ in order]
+        directions = {desc for _, desc in order}
+        if len(directions) == 1:
+            # Одно направление сортировки: сравнение строк, его покрывает
+            # составной индекс по колонкам сортировки
+            ascending = (not directions.pop()) == forward
+            left, right = Tuple(*fields), Tuple(*values)
+            return left > right if ascending else left < right
+        # Разные направления: (a > x) OR (a = x AND b < y) OR ...
+        conditions = []
+        for index, (name, desc) in enumerate(order):
+            field = self.columns[name]
+            ascending = (not desc) == forward
+            step = field > values[index] if ascending else field < values[index]
+            prefix = [fields[i] == values[i] for i in range(index)]
+            conditions.append(reduce(operator.and_, prefix + [step]))
+        return reduce(operator.or_, conditions)
+
+    def page(self, cursor: str = None, sort: list = None, filters: list = None) -> dict:
+        order = self._order(sort)
+        direction = "next"
+        query = self.query.select(*[field.alias(name) for name, field in self.columns.items()])
+        conditions = self._filters(filters)
+        if cursor:
+            values, direction = decode_cursor(cursor)
+            if len(values) != len(order):
+                raise ValueError("Cursor does not match sort order")
+            # Значения из курсора приводим к типам полей (UUID, datetime)
+            values = [self._python_value(name, value) for (name, _), value in zip(order, values)]
+            conditions.append(self._seek(order, values, forward=direction == "next"))
+        if conditions:
+            query = query.where(reduce(operator.and_, conditions))
+
+        forward = direction == "next"
+        ordering = []
+        for name, desc in order:
+            field = self.columns[name]
+            ordering.append(field.desc() if desc == forward else field.asc())
+        rows = list(query.order_by(*ordering).limit(self.page_size + 1).dicts())
+
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if not forward:
+            rows.reverse()
+
+        def row_cursor(row, cursor_direction):
+            return encode_cursor([row[name] for name, _ in order], cursor_direction)
+
+        has_next = has_more if forward else cursor is not None
+        has_prev = cursor is not None if forward else has_more
+        return {
+            "rows": [{name: json_value(row[name]) for name in self.columns} for row in rows],
+            "pages": {
+                "page_size": self.page_size,
+                "next": row_cursor(rows[-1], "next") if rows and has_next else None,
+                "prev": row_cursor(rows[0], "prev") if rows and has_prev else None,
+            }
+        }
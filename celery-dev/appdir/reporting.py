@@ -0,0 +1,243 @@
+
+import os
+import time
+import atexit
+import logging
+import threading
+from collections import deque
+
+from appdir import api
+from config import CeleryConfig
+config = CeleryConfig()
+
+logger = logging.getLogger(__name__)
+
+
+def encode_event(event_type: str, data: bytes) -> bytes:
+    return b'{"type":"' + event_type.encode() + b'","data":' + data + b'}'
+
+
+def event_keys(key) -> tuple:
+    # Ключ порядка события: строка или кортеж ключей
+    return key if isinstance(key, tuple) else (key,)
+
+
+class LifecycleReporter:
+    # Очередь переходов состояний (change_session_status, update_user_request,
+    # update_webhook_request), которую фоновый поток отправляет пачками на
+    # LIFECYCLE_BATCH_PATH:
+    #   {"events": [{"type": "update_user_request", "data": {...}}, ...]}
+    # События уходят строго в порядке постановки, пачки отправляются
+    # последовательно одним потоком, поэтому порядок по каждому
+    # user_request_guid/webhook_request_guid сохраняется. Событие с
+    # несколькими ключами упорядочено относительно каждого из них. Если пакетный
+    # эндпоинт недоступен, события отправляются по одному на их обычные пути.
+    # Не доставленные из-за ошибки соединения, 5xx или 429 события
+    # возвращаются в начало очереди (вместе с последующими событиями того же
+    # ключа) и повторяются с паузой до LIFECYCLE_RETRY_TOTAL раз.
+
+    def __init__(self,
+                 batch_path: str = config.LIFECYCLE_BATCH_PATH,
+                 batch_size: int = config.LIFECYCLE_BATCH_SIZE,
+                 flush_interval: float = config.LIFECYCLE_FLUSH_INTERVAL,
+                 enabled: bool = config.LIFECYCLE_BATCHING) -> None:
+        self.batch_path = batch_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        self._reset()
+
+    def _reset(self):
+        self._queue = deque()
+        self._in_flight = set()
+        # Ключи, которых ждёт send_sync: их события уходят первыми
+        self._urgent = set()
+        self._cond = threading.Condition()
+        self._pending = 0
+        self._flushing = False
+        self._thread = None
+        self._batch_supported = True
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run,
+                                            name='lifecycle-reporter',
+                                            daemon=True)
+            self._thread.start()
+
+    def submit(self, event_type: str, key: str, data: bytes, headers: dict = None):
+        if not self.enabled:
+            return self.send_one(event_type, data, headers)
+        with self._cond:
+            self._queue.append((event_type, event_keys(key), data, headers, 0))
+            self._pending += 1
+            self._ensure_thread()
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify_all()
+        return None
+
+    def send_sync(self, event_type: str, key: str, data: bytes, headers: dict = None):
+        # Переходы, которые должны быть подтверждены до запуска задачи.
+        # Сначала дожидаемся отправки уже поставленных событий того же ключа,
+        # чтобы не нарушить порядок; события других ключей не ждём.
+        if self.enabled:
+            self.flush_keys(event_keys(key))
+        return self.send_one(event_type, data, headers)
+
+    def send_batch_sync(self, events: list, headers: dict = None) -> list:
+        # Синхронная отправка пачки [(event_type, key, data)] с ответом на
+        # каждое событие. Пакетный эндпоинт должен вернуть {"data": [...]}
+        # в порядке событий, иначе события отправляются по одному.
+        if self.enabled:
+            self.flush_keys([key for _, event_key, _ in events for key in event_keys(event_key)])
+        if self._batch_supported and len(events) > 1:
+            body = b'{"events":[' + b','.join(encode_event(event_type, data)
+                                               for event_type, _, data in events) + b']}'
+            r = api.post(self.batch_path, data=body, headers=headers, timeout=config.API_TIMEOUT)
+            if r.status_code == 200:
+                try:
+                    results = r.json().get('data')
+                except ValueError:
+                    results = None
+                if isinstance(results, list) and len(results) == len(events):
+                    return results
+            elif r.status_code in (404, 405):
+                logger.warning("Batch endpoint %s is not supported, "
+                               "falling back to single requests", self.batch_path)
+                self._batch_supported = False
+            else:
+                logging.critical("API not working!")
+        return [self.send_one(event_type, data, headers) for event_type, _, data in events]
+
+    def flush(self, timeout: float = None) -> bool:
+        with self._cond:
+            if not self._pending:
+                return True
+            self._ensure_thread()
+            self._flushing = True
+            self._cond.notify_all()
+            done = self._cond.wait_for(lambda: self._pending == 0, timeout=timeout)
+            self._flushing = False
+            return done
+
+    def _has_keys(self, keys: set) -> bool:
+        return (not keys.isdisjoint(self._in_flight)
+                or any(not keys.isdisjoint(item[1]) for item in self._queue))
+
+    def flush_keys(self, keys, timeout: float = None) -> bool:
+        keys = set(keys)
+        with self._cond:
+            if not self._has_keys(keys):
+                return True
+            self._ensure_thread()
+            self._urgent |= keys
+            self._cond.notify_all()
+            done = self._cond.wait_for(lambda: not self._has_keys(keys), timeout=timeout)
+            self._urgent -= keys
+            return done
+
+    def _take_batch(self) -> list:
+        # События ключей из _urgent забираются вперёд остальных; порядок
+        # внутри каждого ключа при этом сохраняется
+        if self._urgent:
+            batch, rest = [], deque()
+            for item in self._queue:
+                if len(batch) < self.batch_size and not self._urgent.isdisjoint(item[1]):
+                    batch.append(item)
+                else:
+                    rest.append(item)
+            if batch:
+                self._queue = rest
+                return batch
+        return [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: (len(self._queue) >= self.batch_size
+                                             or ((self._flushing or self._urgent) and self._queue)),
+                                    timeout=self.flush_interval)
+                batch = self._take_batch()
+                self._in_flight = {key for item in batch for key in item[1]}
+            failed = []
+            if batch:
+                try:
+                    failed = self._send_batch(batch)
+                except Exception:
+                    logger.exception("Lifecycle batch failed")
+                    failed = batch
+            retry = [item[:4] + (item[4] + 1,) for item in failed
+                     if item[4] < config.LIFECYCLE_RETRY_TOTAL]
+            if len(retry) < len(failed):
+                logger.error("Lifecycle events dropped after %s attempts: %s",
+                             config.LIFECYCLE_RETRY_TOTAL + 1, len(failed) - len(retry))
+            with self._cond:
+                self._queue.extendleft(reversed(retry))
+                self._in_flight = set()
+                self._pending -= len(batch) - len(retry)
+                self._cond.notify_all()
+            if retry:
+                time.sleep(config.LIFECYCLE_RETRY_BACKOFF * 2 ** (retry[0][4] - 1))
+
+    def _send_batch(self, batch: list) -> list:
+        # -> события для повтора, в исходном порядке
+        if self._batch_supported and len(batch) > 1:
+            body = b'{"events":[' + b','.join(encode_event(event_type, data)
+                                               for event_type, _, data, _, _ in batch) + b']}'
+            try:
+                r = api.post(self.batch_path, data=body, timeout=config.API_TIMEOUT)
+            except Exception as e:
+                logger.warning("Lifecycle batch request failed, "
+                               "falling back to single requests: %r", e)
+            else:
+                if r.status_code == 200:
+                    return []
+                if r.status_code in (404, 405):
+                    logger.warning("Batch endpoint %s is not supported, "
+                                   "falling back to single requests", self.batch_path)
+                    self._batch_supported = False
+                else:
+                    logging.critical("API not working!")
+        failed = []
+        failed_keys = set()
+        for item in batch:
+            event_type, keys, data, headers, _ = item
+            # После неудачи события ключа не обгоняют его: уходят на повтор вместе
+            if not failed_keys.isdisjoint(keys) or not self._deliver(event_type, data, headers):
+                failed.append(item)
+                failed_keys.update(keys)
+        return failed
+
+    def _deliver(self, event_type: str, data: bytes, headers: dict = None) -> bool:
+        # False - стоит повторить; прочие ошибки API повтор не исправит
+        try:
+            request = self._post_one(event_type, data, headers)
+        except Exception as e:
+            logger.warning("Lifecycle event %s failed: %r", event_type, e)
+            return False
+        if request.status_code != 200:
+            logging.critical("API not working!")
+        return request.status_code < 500 and request.status_code != 429
+
+    def _post_one(self, event_type: str, data: bytes, headers: dict = None):
+        return api.post(f"/{event_type}",
+            data=data,
+            headers=headers,
+            timeout=config.API_TIMEOUT)
+
+    def send_one(self, event_type: str, data: bytes, headers: dict = None):
+        request = self._post_one(event_type, data, headers)
+        if request.status_code != 200:
+            logging.critical("API not working!")
+            return None
+        try:
+            return request.json().get('data')
+        except ValueError:
+            return None
+
+
+reporter = LifecycleReporter()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reporter._reset)
+atexit.register(reporter.flush, timeout=config.LIFECYCLE_SHUTDOWN_TIMEOUT)
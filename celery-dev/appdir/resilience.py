@@ -0,0 +1,240 @@
+
+import os
+import time
+import random
+import logging
+import threading
+
+import requests
+
+from config import CeleryConfig
+config = CeleryConfig()
+
+logger = logging.getLogger(__name__)
+
+# Защита воркера от деградации API, отдельно для каждого пути:
+# - таймаут по наблюдаемой задержке (как RTO в TCP: сглаженное среднее
+#   плюс четыре отклонения), не больше таймаута вызова и не меньше
+#   API_TIMEOUT_MIN; после таймаута следующий удваивается;
+# - автомат: после API_BREAKER_FAILURES отказов подряд (таймаут, ошибка
+#   соединения, 5xx) путь открыт на API_BREAKER_RESET секунд, вызовы
+#   сразу завершаются CircuitOpenError; затем один пробный вызов решает,
+#   закрыть автомат или открыть снова;
+# - бюджет повторов: каждый вызов добавляет API_RETRY_BUDGET_RATIO повтора,
+#   и ещё API_RETRY_BUDGET_MIN повторов в секунду, поэтому при отказе
+#   API повторов не больше доли от потока вызовов.
+# Повторяются ошибки соединения, таймауты и статусы API_RETRY_STATUS_FORCELIST,
+# не больше API_RETRY_TOTAL раз: вызовы API - чтения и установка состояний,
+# их повтор безопасен.
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    pass
+
+
+class AdaptiveTimeout:
+
+    def __init__(self, minimum: float = config.API_TIMEOUT_MIN, warmup: int = 20) -> None:
+        self.minimum = minimum
+        self.warmup = warmup
+        self.samples = 0
+        self.srtt = 0.0
+        self.rttvar = 0.0
+        self.backoff = 1
+
+    def get(self, ceiling: float) -> float:
+        if not config.API_TIMEOUT_ADAPTIVE or self.samples < self.warmup:
+            return ceiling
+        return min(ceiling, max(self.minimum, self.srtt + 4 * self.rttvar) * self.backoff)
+
+    def observe(self, seconds: float):
+        if self.samples == 0:
+            self.srtt = seconds
+            self.rttvar = seconds / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - seconds)
+            self.srtt = 0.875 * self.srtt + 0.125 * seconds
+        self.samples += 1
+        self.backoff = 1
+
+    def timed_out(self):
+        self.backoff = min(self.backoff * 2, 64)
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failures: int = config.API_BREAKER_FAILURES,
+                 reset: float = config.API_BREAKER_RESET) -> None:
+        self.failures = failures
+        self.reset = reset
+        self.state = self.CLOSED
+        self.consecutive = 0
+        self.opened = 0.0
+        self.probing = False
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened >= self.reset:
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def success(self):
+        self.state = self.CLOSED
+        self.consecutive = 0
+        self.probing = False
+
+    def failure(self) -> bool:
+        self.consecutive += 1
+        self.probing = False
+        if self.state == self.HALF_OPEN or self.consecutive >= self.failures:
+            # Повторное открытие после неудачной пробы не сообщается
+            opened = self.state == self.CLOSED
+            self.state = self.OPEN
+            self.opened = time.monotonic()
+            return opened
+        return False
+
+
+class RetryBudget:
+
+    def __init__(self, ratio: float = config.API_RETRY_BUDGET_RATIO,
+                 per_second: float = config.API_RETRY_BUDGET_MIN) -> None:
+        self.ratio = ratio
+        self.per_second = per_second
+        # Запас - десять секунд минимального бюджета
+        self.cap = 10 * max(1.0, per_second)
+        self.balance = per_second
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.balance = min(self.cap, self.balance + (now - self.updated) * self.per_second)
+        self.updated = now
+
+    def deposit(self):
+        self._refill()
+        self.balance = min(self.cap, self.balance + self.ratio)
+
+    def withdraw(self) -> bool:
+        self._refill()
+        if self.balance < 1:
+            return False
+        self.balance -= 1
+        return True
+
+
+class Endpoint:
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.timeout = AdaptiveTimeout()
+        self.breaker = CircuitBreaker()
+        self.budget = RetryBudget()
+        self.shed_breaker = 0
+        self.shed_retry = 0
+
+    def _acquire(self):
+        with self.lock:
+            if self.breaker.allow():
+                return
+            self.shed_breaker += 1
+        raise CircuitOpenError(f"API endpoint {self.path} is unavailable, circuit is open")
+
+    def _succeeded(self, seconds: float):
+        with self.lock:
+            self.timeout.observe(seconds)
+            self.breaker.success()
+
+    def _failed(self, timed_out: bool = False):
+        with self.lock:
+            if timed_out:
+                self.timeout.timed_out()
+            opened = self.breaker.failure()
+        if opened:
+            logger.warning("API endpoint %s is failing, circuit opened for %.0f s",
+                           self.path, self.breaker.reset)
+
+    def _retry(self, attempt: int) -> bool:
+        if attempt >= config.API_RETRY_TOTAL:
+            return False
+        with self.lock:
+            if self.breaker.state == CircuitBreaker.OPEN:
+                return False
+            if self.budget.withdraw():
+                return True
+            self.shed_retry += 1
+        return False
+
+    def call(self, send, timeout: float, **kwargs) -> requests.Response:
+        with self.lock:
+            self.budget.deposit()
+        attempt = 0
+        while True:
+            self._acquire()
+            with self.lock:
+                current_timeout = self.timeout.get(timeout)
+            started = time.perf_counter()
+            try:
+                response = send(timeout=current_timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self._failed(timed_out=isinstance(e, requests.exceptions.Timeout))
+                if not self._retry(attempt):
+                    raise
+            except BaseException:
+                # Ошибка не связана с API: пробный вызов не должен остаться занятым
+                with self.lock:
+                    self.breaker.probing = False
+                raise
+            else:
+                if response.status_code >= 500:
+                    self._failed()
+                else:
+                    self._succeeded(time.perf_counter() - started)
+                if (response.status_code not in config.API_RETRY_STATUS_FORCELIST
+                        or not self._retry(attempt)):
+                    return response
+                response.close()
+            time.sleep(config.API_RETRY_BACKOFF_FACTOR * 2 ** attempt * random.uniform(0.5, 1.5))
+            attempt += 1
+
+
+_lock = threading.Lock()
+_endpoints = {}
+
+
+def endpoint(path: str) -> Endpoint:
+    current = _endpoints.get(path)
+    if current is None:
+        with _lock:
+            current = _endpoints.setdefault(path, Endpoint(path))
+    return current
+
+
+def breaker_states() -> dict:
+    # {"<путь>:<состояние>": 1} - в сумме по процессам число процессов
+    # с автоматом пути в этом состоянии
+    return {f"{path}:{current.breaker.state}": 1 for path, current in list(_endpoints.items())}
+
+
+def shed_counts() -> dict:
+    counts = {}
+    for path, current in list(_endpoints.items()):
+        counts[f"{path}:circuit_open"] = current.shed_breaker
+        counts[f"{path}:retry_budget"] = current.shed_retry
+    return counts
+
+
+def _reset():
+    global _lock, _endpoints
+    _lock = threading.Lock()
+    _endpoints = {}
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset)
@@ -0,0 +1,133 @@
+
+import logging
+
+from celery import bootsteps
+from click import Option
+from kombu import Consumer, Producer
+
+from config import CeleryConfig
+config = CeleryConfig()
+
+logger = logging.getLogger(__name__)
+
+# Очереди по классам задержки. Действия виджета из TIER_INTERACTIVE_ACTIONS
+# (клик пользователя, ждущий ответа) идут в очередь interactive, действия
+# из TIER_BULK_ACTIONS - в bulk, вебхуки - в свою очередь. Маршрут
+# определяется по имени задачи при отправке через task_routes; для каждого
+# класса можно запустить отдельный воркер: python app.py --tier interactive
+# Платформа пока отправляет все действия в общую очередь
+# applications/{GUID}. Воркеры interactive запускаются с --route-legacy и
+# перекладывают каждое сообщение из неё в очередь его класса по task_tier,
+# не выполняя задачу: клик не ждёт за пачкой execute. Когда платформа
+# начнёт отправлять в очереди классов, общая очередь просто опустеет.
+
+TIERS = ('interactive', 'bulk', 'webhook')
+
+
+def action_type(task_name: str) -> str:
+    return task_name.split('.')[-1]
+
+
+def task_tier(task_name: str):
+    task_type = task_name.split('.')[0]
+    if task_type == 'webhooks':
+        return 'webhook'
+    if task_type != 'applications':
+        return None
+    action = action_type(task_name)
+    if action in config.TIER_INTERACTIVE_ACTIONS:
+        return 'interactive'
+    if action in config.TIER_BULK_ACTIONS:
+        return 'bulk'
+    return config.TIER_DEFAULT
+
+
+def tier_settings(tier: str) -> dict:
+    return {
+        'interactive': {
+            'queues': [config.INTERACTIVE_QUEUE],
+            'concurrency': config.TIER_INTERACTIVE_CONCURRENCY,
+            'prefetch': config.TIER_INTERACTIVE_PREFETCH,
+            'priority': config.TIER_INTERACTIVE_PRIORITY,
+        },
+        'bulk': {
+            'queues': [config.BULK_QUEUE],
+            'concurrency': config.TIER_BULK_CONCURRENCY,
+            'prefetch': config.TIER_BULK_PREFETCH,
+            'priority': config.TIER_BULK_PRIORITY,
+        },
+        'webhook': {
+            'queues': [config.WEBHOOK_QUEUE],
+            'concurrency': config.TIER_WEBHOOK_CONCURRENCY,
+            'prefetch': config.TIER_WEBHOOK_PREFETCH,
+            'priority': config.TIER_WEBHOOK_PRIORITY,
+        },
+    }[tier]
+
+
+def route_task(name, args, kwargs, options, task=None, **kw):
+    tier = task_tier(name)
+    if tier is None:
+        return None
+    settings = tier_settings(tier)
+    return {'queue': settings['queues'][0], 'priority': settings['priority']}
+
+
+def worker_argv(tier: str = None, pool: str = None, concurrency: int = None,
+                loglevel: str = 'INFO') -> list:
+    pool = pool or config.WORKER_POOL
+    argv = ["-A", "app", "worker", f"--loglevel={loglevel}", f"--pool={pool}"]
+    if tier is not None:
+        if tier not in TIERS:
+            raise ValueError(f"Unknown tier {tier!r}, expected one of {', '.join(TIERS)}")
+        settings = tier_settings(tier)
+        argv += ["-Q", ','.join(settings['queues']),
+                 "-n", f"{tier}@%h",
+                 f"--prefetch-multiplier={settings['prefetch']}",
+                 "-O", "fair"]
+        if tier == 'interactive':
+            argv.append("--route-legacy")
+        concurrency = concurrency or settings['concurrency']
+    concurrency = concurrency or config.WORKER_CONCURRENCY
+    if concurrency:
+        argv.append(f"--concurrency={concurrency}")
+    return argv
+
+
+route_legacy_option = Option(["--route-legacy"], is_flag=True, default=False,
+                             help="Move messages from the legacy applications queue to tier queues.")
+
+
+class LegacyRouter(bootsteps.ConsumerStep):
+    # Перекладывает сообщения из общей очереди в очереди классов. Тело
+    # и заголовки не разбираются и не пересериализуются
+
+    def __init__(self, parent, route_legacy=False, **kwargs):
+        self.enabled = route_legacy
+        self.app = parent.app
+        super().__init__(parent, **kwargs)
+
+    def get_consumers(self, channel):
+        self.queues = self.app.amqp.queues
+        self.producer = Producer(channel, auto_declare=False)
+        return [Consumer(channel, queues=[self.queues[config.APPLICATIONS_QUEUE]],
+                         on_message=self.on_message, prefetch_count=100)]
+
+    def on_message(self, message):
+        name = message.headers.get('task', '')
+        settings = tier_settings(task_tier(name) or config.TIER_DEFAULT)
+        queue = self.queues[settings['queues'][0]]
+        try:
+            self.producer.publish(message.body, exchange='', routing_key=queue.name,
+                                  declare=[queue], headers=message.headers,
+                                  content_type=message.content_type,
+                                  content_encoding=message.content_encoding,
+                                  priority=settings['priority'],
+                                  correlation_id=message.properties.get('correlation_id'),
+                                  reply_to=message.properties.get('reply_to'),
+                                  retry=True)
+        except Exception:
+            logger.exception("Legacy routing of %s failed", name)
+            message.requeue()
+            return
+        message.ack()
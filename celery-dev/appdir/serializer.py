@@ -0,0 +1,167 @@
+
+import json
+from json.encoder import encode_basestring_ascii
+
+from appdir.classes import _control_types, _raw_step_json, BaseControl, ItemsControl, WidgetSession
+
+# Сериализация WidgetSession сразу в JSON за один проход, без промежуточных
+# словарей get_json(). Для каждого типа контрола по его _fields/_json_attrs
+# генерируется функция, которая склеивает JSON-строку из атрибутов объекта.
+
+_encoder = json.JSONEncoder(separators=(',', ':'))
+_string = encode_basestring_ascii
+
+
+def _value(value) -> str:
+    if value is None:
+        return 'null'
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    value_type = type(value)
+    if value_type is str:
+        return _string(value)
+    if value_type is int:
+        return int.__repr__(value)
+    return _encoder.encode(value)
+
+
+def _compile(cls, nested: dict, exclude: tuple = (), close: bool = True, fields: tuple = None):
+    # nested: поле -> имя функции для элементов списка в этом поле;
+    # close=False оставляет объект открытым, чтобы дописать exclude-поля;
+    # fields - вместо cls._fields
+    attrs = getattr(cls, '_json_attrs', {})
+    computed = getattr(cls, '_json_computed', ())
+    template, exprs = [], []
+    for field in fields or cls._fields:
+        if field in exclude:
+            continue
+        template.append(_string(field).replace('%', '%%') + ':%s')
+        if field in nested:
+            exprs.append(f"'[' + ','.join(map({nested[field]}, o.{attrs.get(field, field)})) + ']'")
+        elif field in computed:
+            exprs.append(f"_value(o._delta_value({field!r}))")
+        else:
+            exprs.append(f"_value(o.{attrs.get(field, field)})")
+    template = '{' + ','.join(template) + ('}' if close else '')
+    source = f"def encode(o):\n    return {template!r} % ({', '.join(exprs)},)\n"
+    namespace = {'_value': _value}
+    exec(compile(source, f'<serializer {cls.__name__}>', 'exec'), namespace)
+    return namespace
+
+
+def _tree_encoder(cls):
+    # Дерево обходится со стеком: глубина не ограничена лимитом рекурсии,
+    # неподгруженные потомки ленивых узлов выводятся как пришли из API
+    plain = _compile(cls, {}, exclude=("children",), close=False)['encode']
+    lazy = _compile(cls, {}, exclude=("children",), close=False, fields=cls._lazy_fields)['encode']
+
+    def encode(root) -> str:
+        out = []
+        stack = [root]
+        while stack:
+            item = stack.pop()
+            if type(item) is str:
+                out.append(item)
+                continue
+            node = lazy if item._lazy else plain
+            if item._raw_children is not None:
+                out.append(node(item) + ',"children":' + _encoder.encode(item._raw_children) + '}')
+                continue
+            out.append(node(item) + ',"children":[')
+            stack.append(']}')
+            children = item._loaded_children()
+            for index in range(len(children) - 1, -1, -1):
+                stack.append(children[index])
+                if index:
+                    stack.append(',')
+        return ''.join(out)
+    return encode
+
+
+def _item_encoder(cls):
+    if "children" in cls._fields:
+        return _tree_encoder(cls)
+    return _compile(cls, {})['encode']
+
+
+def _control_encoder(cls):
+    # Классы, переопределившие get_json() без своих _fields, сериализуются
+    # через get_json(): спецификации полей для них нет
+    if 'get_json' in vars(cls) and '_fields' not in vars(cls):
+        return None
+    nested = {}
+    if issubclass(cls, ItemsControl) and "items" in cls._fields:
+        nested["items"] = "_item"
+    namespace = _compile(cls, nested)
+    if nested:
+        namespace['_item'] = _item_encoder(cls._item_class)
+    return namespace['encode']
+
+
+_control_encoders = {cls: _control_encoder(cls) for cls in set(_control_types.values())}
+
+
+def encode_control(control: BaseControl) -> str:
+    cls = type(control)
+    if cls not in _control_encoders:
+        _control_encoders[cls] = _control_encoder(cls) if hasattr(cls, '_fields') else None
+    encode = _control_encoders[cls]
+    if encode is None:
+        return _encoder.encode(control.get_json())
+    return encode(control)
+
+
+def _encode_step(out: list, guid: str, name: str, code: str, description, entries):
+    out.append('{"guid":' + _value(guid) + ',"name":' + _value(name)
+               + ',"code":' + _value(code) + ',"description":' + _value(description)
+               + ',"controls":{')
+    first = True
+    for control_guid, control, raw in entries:
+        out.append(('' if first else ',') + _string(control_guid) + ':')
+        out.append(encode_control(control) if control is not None else _encoder.encode(raw))
+        first = False
+    out.append('}}')
+
+
+def encode_widget_session(widget_session: WidgetSession) -> bytes:
+    ws = widget_session
+    out = ['{"widget":{"guid":' + _value(ws.guid)
+           + ',"current_step":' + _value(ws.current_step)
+           + ',"code":' + _value(ws.code)
+           + ',"name":' + _value(ws.name)
+           + ',"status":' + _value(ws.status)
+           + ',"description":' + _value(ws.description)
+           + ',"async_execute":' + _value(ws.async_execute)
+           + '},"steps":{']
+    first = True
+    for guid, step, raw in ws._steps.entries():
+        out.append(('' if first else ',') + _string(guid) + ':')
+        if step is not None:
+            _encode_step(out, step.guid, step.name, step.code, step.description,
+                         step._controls.entries())
+        else:
+            raw_step = _raw_step_json(raw)
+            _encode_step(out, raw_step['guid'], raw_step['name'], raw_step['code'],
+                         raw_step['description'],
+                         ((control_guid, None, control)
+                          for control_guid, control in raw_step['controls'].items()))
+        first = False
+    out.append('}}')
+    return ''.join(out).encode()
+
+
+def merge_json(document: bytes, **fragments: bytes) -> bytes:
+    # Добавляет в JSON-объект поля, уже закодированные в байты
+    body = document.rstrip()
+    if not body.endswith(b'}'):
+        raise ValueError("JSON object expected")
+    body = body[:-1].rstrip()
+    parts = [body]
+    separator = b'' if body.endswith(b'{') else b','
+    for key, fragment in fragments.items():
+        parts.append(separator + _string(key).encode() + b':' + fragment)
+        separator = b','
+    parts.append(b'}')
+    return b''.join(parts)
@@ -0,0 +1,237 @@
+
+# Генератор тестовых данных схемы sales без доступа в интернет: статусы,
+# товары, заказы и позиции заказов с правдоподобными распределениями,
+# воспроизводимые по seed. Загрузка через COPY ... FROM STDIN потоком,
+# транзакция на каждую пачку заказов.
+#   python -m applications.sales.datagen --orders 1000000 --products 5000 --seed 42
+
+import io
+import sys
+import time
+import uuid
+import random
+import argparse
+import datetime
+from itertools import accumulate
+
+STATUSES = (
+    # название, активный, доля заказов
+    ("Новый", True, 0.08),
+    ("Подтверждён", True, 0.07),
+    ("В сборке", True, 0.05),
+    ("Готов к выдаче", False, 0.10),
+    ("Выдан", False, 0.70),
+)
+
+STORES = (("Онлайн", 0.55), ("Точка 1", 0.2), ("Точка 2", 0.15), ("Точка 3", 0.1))
+
+COMMENTS = (
+    "Сборщики! Будьте аккуратны, товар хрупкий!",
+    "Позвонить перед выдачей",
+    "Упаковать в подарочную упаковку",
+    "Клиент заберёт после 18:00",
+)
+
+ADJECTIVES = ("Большой", "Малый", "Красный", "Синий", "Деревянный", "Металлический",
+              "Складной", "Детский", "Спортивный", "Классический", "Умный", "Компактный")
+NOUNS = ("стол", "стул", "рюкзак", "фонарь", "чайник", "коврик", "светильник",
+         "термос", "зонт", "набор", "органайзер", "плед", "мяч", "контейнер")
+
+# Часовой профиль заказов: ночью мало, пик днём и вечером
+HOURLY_WEIGHTS = (1, 1, 1, 1, 1, 2, 3, 5, 7, 8, 9, 9, 10, 9, 9, 9, 9, 10, 11, 11, 9, 6, 4, 2)
+
+
+class Generator:
+
+    def __init__(self, seed: int = 42, products: int = 1000, accounts: int = 1000,
+                 days: int = 365, now: datetime.datetime = None) -> None:
+        self.rng = random.Random(seed)
+        self.products = products
+        self.accounts = accounts
+        self.days = days
+        self.now = now or datetime.datetime(2024, 1, 1)
+        self.status_ids = [self.new_uuid() for _ in STATUSES]
+        self.product_ids = [self.new_uuid() for _ in range(products)]
+        self.account_ids = [self.new_uuid() for _ in range(accounts)]
+        # Популярность товаров и активность клиентов - по закону Ципфа
+        self._product_weights = list(accumulate(1 / (rank + 1) for rank in range(products)))
+        self._account_weights = list(accumulate(1 / (rank + 1) ** 0.8 for rank in range(accounts)))
+        self._status_weights = list(accumulate(share for _, _, share in STATUSES))
+        self._store_weights = list(accumulate(share for _, share in STORES))
+        self._hour_weights = list(accumulate(HOURLY_WEIGHTS))
+
+    def new_uuid(self) -> uuid.UUID:
+        return uuid.UUID(int=self.rng.getrandbits(128), version=4)
+
+    def statuses(self):
+        for status_id, (name, is_active, _) in zip(self.status_ids, STATUSES):
+            yield status_id, name, is_active
+
+    def product_names(self, count: int = None):
+        rng = random.Random(self.rng.random())
+        for index in range(count if count is not None else self.products):
+            yield (f"{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} "
+                   f"{rng.choice('АБВГДЕКМНПРСТ')}-{100 + index}")
+
+    def product_rows(self):
+        for product_id, name in zip(self.product_ids, self.product_names()):
+            yield product_id, name
+
+    def _created(self) -> datetime.datetime:
+        rng = self.rng
+        # Чем ближе к текущей дате, тем больше заказов
+        day = int(self.days * (1 - rng.random() ** 0.5))
+        hour = rng.choices(range(24), cum_weights=self._hour_weights)[0]
+        return (self.now - datetime.timedelta(days=day)).replace(
+            hour=hour, minute=rng.randrange(60), second=rng.randrange(60))
+
+    def order(self, code: int) -> tuple:
+        rng = self.rng
+        status_index = rng.choices(range(len(STATUSES)), cum_weights=self._status_weights)[0]
+        created = self._created()
+        collected = None
+        if not STATUSES[status_index][1]:
+            collected = created + datetime.timedelta(minutes=rng.randint(10, 60 * 48))
+        comment = rng.choice(COMMENTS) if rng.random() < 0.1 else ""
+        account_id = rng.choices(self.account_ids, cum_weights=self._account_weights)[0]
+        store = rng.choices(STORES, cum_weights=self._store_weights)[0][0]
+        return (self.new_uuid(), self.status_ids[status_index], code, created, collected,
+                comment, account_id, store)
+
+    def order_products(self, order_id: uuid.UUID):
+        rng = self.rng
+        # Чаще всего 1-3 позиции, изредка до 10
+        count = min(10, 1 + int(rng.expovariate(0.6)))
+        product_ids = set(rng.choices(self.product_ids, cum_weights=self._product_weights, k=count))
+        for product_id in product_ids:
+            quantity = min(10, 1 + int(rng.expovariate(1.2)))
+            yield product_id, order_id, quantity
+
+    def orders(self, count: int, start: int = 0):
+        # (заказ, [позиции]) - позиции генерируются вместе с заказом
+        for code in range(start + 1, start + count + 1):
+            order = self.order(code)
+            yield order, list(self.order_products(order[0]))
+
+
+def _copy_value(value) -> str:
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    value = str(value)
+    if '\\' in value or '\t' in value or '\n' in value or '\r' in value:
+        value = (value.replace('\\', '\\\\').replace('\t', '\\t')
+                 .replace('\n', '\\n').replace('\r', '\\r'))
+    return value
+
+
+class CopyStream(io.RawIOBase):
+    # Файлоподобный поток строк в текстовом формате COPY: строки
+    # формируются по мере чтения, весь набор в памяти не держится
+
+    def __init__(self, rows) -> None:
+        self._rows = iter(rows)
+        self._buffer = b''
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, target) -> int:
+        while len(self._buffer) < len(target):
+            chunk = []
+            for row in self._rows:
+                chunk.append('\t'.join(map(_copy_value, row)) + '\n')
+                if len(chunk) >= 1000:
+                    break
+            if not chunk:
+                break
+            self._buffer += ''.join(chunk).encode()
+        size = min(len(target), len(self._buffer))
+        target[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+def copy_rows(cursor, table: str, columns: tuple, rows, buffer_size: int = 1 << 16) -> int:
+    stream = CopyStream(rows)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", stream, size=buffer_size)
+    return cursor.rowcount
+
+
+def load(db, orders: int, products: int = 1000, accounts: int = 1000, seed: int = 42,
+         batch: int = 50000, days: int = 365, keep_triggers: bool = False, log=None):
+    from applications.sales.models import create_all_tables, refresh_active_sales
+
+    generator = Generator(seed=seed, products=products, accounts=accounts, days=days)
+    create_all_tables()
+    db.connect(reuse_if_open=True)
+    try:
+        with db.atomic():
+            cursor = db.cursor()
+            copy_rows(cursor, 'sales.status', ('id', 'name', 'is_active'), generator.statuses())
+            copy_rows(cursor, 'sales.product', ('id', 'name'), generator.product_rows())
+
+        # Триггер active_sales на каждую строку COPY замедляет загрузку:
+        # по умолчанию он отключается, а таблица пересобирается в конце
+        if not keep_triggers:
+            db.execute_sql('ALTER TABLE sales.retaildemand DISABLE TRIGGER active_sales_sync')
+        try:
+            loaded = 0
+            while loaded < orders:
+                size = min(batch, orders - loaded)
+                order_rows, product_rows = [], []
+                for order, positions in generator.orders(size, start=loaded):
+                    order_rows.append(order)
+                    product_rows.extend(positions)
+                with db.atomic():
+                    cursor = db.cursor()
+                    copy_rows(cursor, 'sales.retaildemand',
+                              ('id', 'status_id', 'code', 'created', 'collected', 'comment',
+                               'account_id', 'retail_store'), order_rows)
+                    copy_rows(cursor, 'retaildemand_product',
+                              ('product_id', 'retaildemand_id', 'quantity'), product_rows)
+                loaded += size
+                if log is not None:
+                    log(loaded, orders)
+        finally:
+            if not keep_triggers:
+                db.execute_sql('ALTER TABLE sales.retaildemand ENABLE TRIGGER active_sales_sync')
+        if not keep_triggers:
+            refresh_active_sales()
+        for table in ('sales.status', 'sales.product', 'sales.retaildemand',
+                      'retaildemand_product', 'sales.active_sales'):
+            db.execute_sql(f'ANALYZE {table}')
+    finally:
+        db.close()
+    return generator
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--orders', type=int, default=100000)
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--accounts', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--batch', type=int, default=50000)
+    parser.add_argument('--keep-triggers', action='store_true')
+    args = parser.parse_args()
+
+    from database import db
+
+    started = time.perf_counter()
+
+    def log(loaded: int, total: int):
+        elapsed = time.perf_counter() - started
+        print(f'    {loaded} / {total} заказов, {loaded / elapsed:.0f} в секунду', file=sys.stderr)
+
+    load(db, args.orders, products=args.products, accounts=args.accounts, seed=args.seed,
+         batch=args.batch, days=args.days, keep_triggers=args.keep_triggers, log=log)
+    print(f'Загружено {args.orders} заказов за {time.perf_counter() - started:.1f} с')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,27 +12,100 @@ import inspect
 # db = PostgresqlDatabase(DB_NAME, user=USER, password=PASSWORD, port=PORT, host=HOST)
 
 from database import db, db_user
+from refcache import install_triggers, reference_models
+
+ACTIVE_STATUSES = ("Новый", "Подтверждён", "В сборке")
 
 def create_views():
+    # sales.active_sales - таблица активных заказов, которую поддерживают
+    # триггеры на retaildemand и status (раньше - представление с фильтром
+    # по названиям статусов и сортировкой при каждом чтении)
+    column_exists = db.execute_sql('''
+    SELECT 1 FROM information_schema.columns
+    WHERE table_schema = 'sales' AND table_name = 'status' AND column_name = 'is_active'
+    ''').fetchone()
+    if not column_exists:
+        db.execute_sql('''
+        ALTER TABLE sales.status ADD COLUMN is_active boolean NOT NULL DEFAULT false''')
+        db.execute_sql('''
+        UPDATE sales.status SET is_active = true WHERE name = ANY(%s)''', (list(ACTIVE_STATUSES),))
+
+    db.execute_sql('''
+    CREATE OR REPLACE FUNCTION sales.active_sales_retaildemand() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM sales.status WHERE id = NEW.status_id AND is_active) THEN
+            INSERT INTO sales.active_sales (id, value, description, status_id, account_id, created)
+            SELECT NEW.id, 'Заказ ' || NEW.code::text, status.name, status.id, NEW.account_id, NEW.created
+            FROM sales.status WHERE status.id = NEW.status_id
+            ON CONFLICT (id) DO UPDATE
+            SET value = EXCLUDED.value, description = EXCLUDED.description,
+                status_id = EXCLUDED.status_id, account_id = EXCLUDED.account_id,
+                created = EXCLUDED.created;
+        ELSIF TG_OP = 'UPDATE' THEN
+            DELETE FROM sales.active_sales WHERE id = NEW.id;
+        END IF;
+        RETURN NULL;
+    END $$''')
+    db.execute_sql('''
+    CREATE OR REPLACE FUNCTION sales.active_sales_status() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        DELETE FROM sales.active_sales WHERE status_id = NEW.id;
+        IF NEW.is_active THEN
+            INSERT INTO sales.active_sales (id, value, description, status_id, account_id, created)
+            SELECT retaildemand.id, 'Заказ ' || retaildemand.code::text, NEW.name, NEW.id,
+                   retaildemand.account_id, retaildemand.created
+            FROM sales.retaildemand WHERE retaildemand.status_id = NEW.id;
+        END IF;
+        RETURN NULL;
+    END $$''')
+    db.execute_sql('''
+    DROP TRIGGER IF EXISTS active_sales_sync ON sales.retaildemand''')
+    db.execute_sql('''
+    CREATE TRIGGER active_sales_sync
+        AFTER INSERT OR UPDATE OF status_id, code, account_id, created ON sales.retaildemand
+        FOR EACH ROW EXECUTE FUNCTION sales.active_sales_retaildemand()''')
     db.execute_sql('''
-    CREATE OR REPLACE VIEW sales.active_sales 
-        AS SELECT retaildemand.id,
-            'Заказ '::text || retaildemand.code::text AS value,
-             status.name AS description
+    DROP TRIGGER IF EXISTS active_sales_sync ON sales.status''')
+    db.execute_sql('''
+    CREATE TRIGGER active_sales_sync
+        AFTER UPDATE OF name, is_active ON sales.status
+        FOR EACH ROW EXECUTE FUNCTION sales.active_sales_status()''')
+    refresh_active_sales()
+
+def refresh_active_sales():
+    # Полная пересборка, например после загрузки данных в обход триггеров
+    with db.atomic():
+        db.execute_sql('''DELETE FROM sales.active_sales''')
+        db.execute_sql('''
+        INSERT INTO sales.active_sales (id, value, description, status_id, account_id, created)
+        SELECT retaildemand.id, 'Заказ ' || retaildemand.code::text, status.name, status.id,
+               retaildemand.account_id, retaildemand.created
         FROM sales.retaildemand
         INNER JOIN sales.status ON sales.status.id = sales.retaildemand.status_id
-        WHERE status.name::text = ANY (ARRAY['Новый'::character varying::text, 
-            'Подтверждён'::character varying::text, 'В сборке'::character varying::text])
-        ORDER BY status.name''')
+        WHERE status.is_active''')
 
 def create_all_tables():
     db.connect(reuse_if_open=True)
     db.execute_sql(f'CREATE SCHEMA IF NOT EXISTS sales AUTHORIZATION {db_user}')
+    # Раньше active_sales было представлением; таблицу, созданную
+    # позже, DROP VIEW не трогает, а упал бы на ней с ошибкой
+    db.execute_sql('''
+    DO $$ BEGIN
+        IF EXISTS (SELECT 1 FROM pg_class
+                   WHERE oid = to_regclass('sales.active_sales') AND relkind = 'v') THEN
+            DROP VIEW sales.active_sales;
+        END IF;
+    END $$''')
     for cls in sys.modules[__name__].__dict__.values():
         if hasattr(cls, '__bases__') and inspect.isclass(cls) and issubclass(cls, Model):
             if cls is not Base and cls is not Model:
                 cls.create_table()
     create_views()
+    install_triggers(db, reference_models(
+        cls for cls in sys.modules[__name__].__dict__.values()
+        if inspect.isclass(cls) and issubclass(cls, Model) and cls is not Base and cls is not Model))
     db.close()
 
 class Base(Model):
@@ -43,7 +116,12 @@ class Base(Model):
 
 class Status(Base):
     id = UUIDField(primary_key=True, null=False)
-    name = CharField(max_length=255, null=False)
+    name = CharField(max_length=255, null=False, unique=True)
+    is_active = BooleanField(null=False, default=False, constraints=[SQL('DEFAULT false')])
+
+    class Meta:
+        # Справочник: кэшируется в процессе, см. refcache
+        reference_keys = ('name',)
 
 
 class Retaildemand(Base):
@@ -56,11 +134,20 @@ class Retaildemand(Base):
     account_id = UUIDField(null=False)
     retail_store = CharField(max_length=255, null=False)
 
+    class Meta:
+        indexes = (
+            (('account_id', 'created'), False),
+            (('created',), False),
+        )
+
 
 class Product(Base):
     id = UUIDField(primary_key=True, null=False)
     name = CharField(max_length=255, null=False)
 
+    class Meta:
+        reference_keys = ()
+
 
 class RetaildemandProduct(Model):
     product = ForeignKeyField(Product, on_delete="RESTRICT")
@@ -73,12 +160,31 @@ class RetaildemandProduct(Model):
         primary_key = CompositeKey("product", "retaildemand")
 
 
+class ActiveSale(Base):
+    # Заполняется триггерами, см. create_views()
+    id = UUIDField(primary_key=True, null=False,
+                   constraints=[SQL('REFERENCES sales.retaildemand (id) ON DELETE CASCADE')])
+    value = TextField(null=False)
+    description = CharField(max_length=255, null=False)
+    status = ForeignKeyField(Status, on_delete="CASCADE")
+    account_id = UUIDField(null=False)
+    created = DateTimeField(null=False)
+
+    class Meta:
+        table_name = "active_sales"
+        indexes = (
+            (('description', 'id'), False),
+            (('account_id', 'created'), False),
+        )
+
+
 def create_statuses():
     from uuid import uuid4
 
     statuses = ("Новый", "Подтверждён", "В сборке", "Готов к выдаче", "Выдан")
     uuids = [uuid4() for _ in range(len(statuses))]
-    return Status.insert_many(zip(uuids, statuses), [Status.id, Status.name]).execute()
+    rows = [(uuid, name, name in ACTIVE_STATUSES) for uuid, name in zip(uuids, statuses)]
+    return Status.insert_many(rows, [Status.id, Status.name, Status.is_active]).execute()
 
 
 def create_retaildemand():
@@ -125,14 +231,12 @@ def create_retaildemand():
     ).execute()
 
 
-def create_products():
-    import requests
+def create_products(count: int = 50):
     from uuid import uuid4
+    from random import randrange
+    from applications.sales.datagen import Generator
 
-    names = [
-        d["title"]
-        for d in requests.get("https://api.escuelajs.co/api/v1/products").json()
-    ]
+    names = list(Generator(seed=randrange(2 ** 32)).product_names(count))
     uuids = [uuid4() for _ in range(len(names))]
     return Product.insert_many(zip(names, uuids), [Product.name, Product.id]).execute()
 
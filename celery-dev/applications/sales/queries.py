@@ -0,0 +1,82 @@
+
+# Выборки заказов вместе с позициями для виджетов. Позиции собираются
+# в Postgres через json_agg в коррелированном подзапросе, поэтому страница
+# заказов любого размера - это один запрос, без запроса на каждый заказ.
+
+from peewee import fn, SQL
+
+from applications.sales.models import ActiveSale, Product, Retaildemand, RetaildemandProduct, Status
+from refcache import references
+
+
+def _lines(order_id_field):
+    return (RetaildemandProduct
+            .select(fn.COALESCE(
+                fn.json_agg(fn.json_build_object('product_id', Product.id,
+                                                 'name', Product.name,
+                                                 'quantity', RetaildemandProduct.quantity))
+                .order_by(Product.name),
+                SQL("'[]'::json")))
+            .join(Product)
+            .where(RetaildemandProduct.retaildemand == order_id_field))
+
+
+def active_orders(account_id=None, limit: int = 100) -> list:
+    # Активные заказы из sales.active_sales, новые первыми
+    query = (ActiveSale
+             .select(ActiveSale.id, ActiveSale.value, ActiveSale.description.alias('status'),
+                     ActiveSale.created, _lines(ActiveSale.id).alias('lines'))
+             .order_by(ActiveSale.created.desc(), ActiveSale.id)
+             .limit(limit))
+    if account_id is not None:
+        query = query.where(ActiveSale.account_id == account_id)
+    return list(query.dicts())
+
+
+def orders(order_ids: list) -> list:
+    # Произвольные заказы по id, в порядке order_ids; название статуса -
+    # из кэша справочников
+    if not order_ids:
+        return []
+    query = (Retaildemand
+             .select(Retaildemand.id,
+                     fn.CONCAT('Заказ ', Retaildemand.code).alias('value'),
+                     Retaildemand.status.alias('status_id'),
+                     Retaildemand.created,
+                     _lines(Retaildemand.id).alias('lines'))
+             .where(Retaildemand.id.in_(order_ids)))
+    rows = {}
+    for row in query.dicts():
+        status = references.get(Status, row.pop("status_id"))
+        row["status"] = status.name if status is not None else ""
+        rows[row["id"]] = row
+    return [rows[order_id] for order_id in order_ids if order_id in rows]
+
+
+def order_items(rows: list, checked: bool = False, style: str = 'primary') -> list:
+    # Аргументы для Item: заказ - элемент CheckBoxList/DropDownList
+    return [{"id": str(row["id"]),
+             "value": row["value"],
+             "checked": checked,
+             "style": style,
+             "description": row["status"],
+             "describe": {"count": sum(line["quantity"] for line in row["lines"]),
+                          "uom": "шт.",
+                          "lines": row["lines"]}}
+            for row in rows]
+
+
+def order_tree_items(rows: list, expand: bool = False, style: str = 'primary') -> list:
+    # Аргументы для TreeItem: заказ - узел, позиции - его потомки
+    return [{"id": str(row["id"]),
+             "value": row["value"],
+             "checked": False,
+             "style": style,
+             "expand": expand,
+             "has_children": bool(row["lines"]),
+             "children": [{"id": f"{row['id']}:{line['product_id']}",
+                           "value": f"{line['name']} x {line['quantity']}",
+                           "checked": False,
+                           "style": style}
+                          for line in row["lines"]]}
+            for row in rows]
@@ -0,0 +1,147 @@
+
+# Задержка чтения активных заказов: прежнее представление (фильтр по
+# названиям статусов, сортировка при каждом чтении) против таблицы
+# sales.active_sales, которую поддерживают триггеры. Заполняет схему sales
+# миллионами заказов - запускать на отдельной базе (DB_APPS_NAME).
+#   python -m benchmarks.active_sales --orders 2000000
+
+import os
+import sys
+import time
+import argparse
+from pathlib import Path
+
+from benchmarks.fake_api import FakeAPI
+
+os.environ.setdefault('CODE_ROOT', str(Path(__file__).resolve().parents[1]))
+
+LEGACY_ACTIVE_SALES = '''
+    SELECT retaildemand.id,
+        'Заказ '::text || retaildemand.code::text AS value,
+         status.name AS description
+    FROM sales.retaildemand
+    INNER JOIN sales.status ON sales.status.id = sales.retaildemand.status_id
+    WHERE status.name::text = ANY (ARRAY['Новый'::character varying::text,
+        'Подтверждён'::character varying::text, 'В сборке'::character varying::text])
+    ORDER BY status.name'''
+
+QUERIES = {
+    "first page": (
+        f'SELECT * FROM ({LEGACY_ACTIVE_SALES}) AS active_sales LIMIT 50',
+        'SELECT id, value, description FROM sales.active_sales ORDER BY description, id LIMIT 50',
+    ),
+    "account page": (
+        f'''SELECT active_sales.* FROM ({LEGACY_ACTIVE_SALES}) AS active_sales
+            INNER JOIN sales.retaildemand ON retaildemand.id = active_sales.id
+            WHERE retaildemand.account_id = %(account)s
+            ORDER BY retaildemand.created DESC LIMIT 50''',
+        '''SELECT id, value, description FROM sales.active_sales
+            WHERE account_id = %(account)s ORDER BY created DESC LIMIT 50''',
+    ),
+    "count": (
+        f'SELECT count(*) FROM ({LEGACY_ACTIVE_SALES}) AS active_sales',
+        'SELECT count(*) FROM sales.active_sales',
+    ),
+}
+
+
+def fill(db, orders: int, accounts: int, batch: int):
+    # Загрузка в обход триггера, затем одна пересборка active_sales
+    from applications.sales.models import create_statuses, refresh_active_sales
+
+    if not db.execute_sql('SELECT 1 FROM sales.status LIMIT 1').fetchone():
+        create_statuses()
+    db.execute_sql('ALTER TABLE sales.retaildemand DISABLE TRIGGER active_sales_sync')
+    try:
+        for start in range(0, orders, batch):
+            stop = min(orders, start + batch)
+            db.execute_sql('''
+            INSERT INTO sales.retaildemand
+                (id, status_id, code, created, collected, comment, account_id, retail_store)
+            SELECT md5('order' || i::text)::uuid,
+                   statuses.ids[1 + (i * 7919) %% array_length(statuses.ids, 1)],
+                   1 + i %% 100000,
+                   now() - make_interval(mins => (i * 31) %% 525600),
+                   NULL, '',
+                   md5('account' || (i %% %(accounts)s)::text)::uuid,
+                   'Точка ' || (i %% 4)::text
+            FROM generate_series(%(start)s, %(stop)s - 1) AS i,
+                 (SELECT array_agg(id ORDER BY name) AS ids FROM sales.status) AS statuses
+            ON CONFLICT (id) DO NOTHING''', {"start": start, "stop": stop, "accounts": accounts})
+            print(f'    {stop} / {orders}', file=sys.stderr)
+    finally:
+        db.execute_sql('ALTER TABLE sales.retaildemand ENABLE TRIGGER active_sales_sync')
+    refresh_active_sales()
+    db.execute_sql('ANALYZE sales.retaildemand')
+    db.execute_sql('ANALYZE sales.active_sales')
+
+
+def measure(db, sql: str, params: dict, repeat: int) -> list:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        db.execute_sql(sql, params).fetchall()
+        timings.append((time.perf_counter() - started) * 1000)
+    return sorted(timings)
+
+
+def measure_status_change(db, repeat: int) -> list:
+    # Стоимость поддержки active_sales триггером при смене статуса заказа
+    timings = []
+    for _ in range(repeat):
+        with db.atomic() as transaction:
+            started = time.perf_counter()
+            db.execute_sql('''
+            UPDATE sales.retaildemand
+            SET status_id = (SELECT id FROM sales.status ORDER BY random() LIMIT 1)
+            WHERE id = (SELECT id FROM sales.retaildemand LIMIT 1)''')
+            timings.append((time.perf_counter() - started) * 1000)
+            transaction.rollback()
+    return sorted(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--orders', type=int, default=1000000)
+    parser.add_argument('--accounts', type=int, default=1000)
+    parser.add_argument('--batch', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--append', action='store_true',
+                        help='дозаписать заказы в непустую схему sales')
+    args = parser.parse_args()
+
+    # appdir при импорте регистрирует задачи - API подменяется заглушкой
+    fake = FakeAPI().start()
+    os.environ['API_URL'] = fake.url
+    import appdir
+    from applications.sales.models import db, create_all_tables
+
+    create_all_tables()
+    db.connect(reuse_if_open=True)
+    existing = db.execute_sql('SELECT count(*) FROM sales.retaildemand').fetchone()[0]
+    if existing and not args.append:
+        print(f'sales.retaildemand уже содержит {existing} заказов, '
+              f'используйте отдельную базу или --append', file=sys.stderr)
+        return 1
+    if existing < args.orders:
+        fill(db, args.orders, args.accounts, args.batch)
+    total = db.execute_sql('SELECT count(*) FROM sales.retaildemand').fetchone()[0]
+    active = db.execute_sql('SELECT count(*) FROM sales.active_sales').fetchone()[0]
+    account = db.execute_sql('SELECT account_id FROM sales.retaildemand LIMIT 1').fetchone()[0]
+
+    print(f'Заказов: {total}, активных: {active}')
+    print(f"{'query':<16}{'view p50':>10}{'view p95':>10}{'table p50':>11}{'table p95':>11}")
+    for name, (legacy, read_model) in QUERIES.items():
+        params = {"account": account}
+        before = measure(db, legacy, params, args.repeat)
+        after = measure(db, read_model, params, args.repeat)
+        print(f'{name:<16}{before[len(before) // 2]:>10.2f}{before[int(len(before) * 0.95)]:>10.2f}'
+              f'{after[len(after) // 2]:>11.2f}{after[int(len(after) * 0.95)]:>11.2f}')
+    change = measure_status_change(db, args.repeat)
+    print(f"Смена статуса заказа с триггером: p50 {change[len(change) // 2]:.2f} ms, "
+          f"p95 {change[int(len(change) * 0.95)]:.2f} ms")
+    db.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
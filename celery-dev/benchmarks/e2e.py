@@ -0,0 +1,187 @@
+
+# Сквозной замер накладных расходов на задачу: задачи init/validate/execute
+# и order_handler выполняются через task.apply() с настоящими обработчиками
+# task_prerun/task_postrun против заглушки API (benchmarks.fake_api).
+# Время разбито на API (запросы в потоке задачи и ожидание предзагруженного
+# ответа), гидратацию WidgetSession, сериализацию, тело задачи и остаток
+# (трассировка celery, сигналы).
+# Запуск из каталога с .env:
+#   python -m benchmarks.e2e --runs 200 --latency 0.002 --items 500
+
+import os
+import sys
+import time
+import argparse
+import functools
+import threading
+import contextlib
+from pathlib import Path
+from collections import defaultdict
+
+from benchmarks.fake_api import FakeAPI
+
+PHASES = ("api", "hydration", "serialization", "body")
+
+APPLICATION_PREFIX = "applications.sales.active-sales-offline.action"
+WEBHOOK_TASK = "webhooks.sales.order_handler.action.order_handler"
+
+
+class _Recorder(threading.local):
+    # Исключительное время по фазам: время вложенной фазы не входит во внешнюю
+
+    def __init__(self) -> None:
+        self.stack = []
+        self.totals = None
+
+
+_recorder = _Recorder()
+
+
+def timed(phase: str, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        recorder = _recorder
+        if recorder.totals is None:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        recorder.stack.append(0.0)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            inner = recorder.stack.pop()
+            recorder.totals[phase] += elapsed - inner
+            if recorder.stack:
+                recorder.stack[-1] += elapsed
+    return wrapper
+
+
+def timed_prefetch(take):
+    # Предзагруженный запрос выполняется в фоновом потоке: в задаче к API
+    # относится ожидание его результата
+    @functools.wraps(take)
+    def wrapper(guid: str):
+        future = take(guid)
+        if future is not None:
+            future.result = timed("api", future.result)
+        return future
+    return staticmethod(wrapper)
+
+
+def instrument(appdir, tasks: list):
+    from appdir import api
+    from appdir.classes import WidgetSession, StepSession
+
+    api.post = timed("api", api.post)
+    api.post_background = timed("api", api.post_background)
+    WidgetSession._take_prefetched = timed_prefetch(WidgetSession._take_prefetched)
+    WidgetSession._receive = timed("hydration", WidgetSession._receive)
+    WidgetSession._make_step = timed("hydration", WidgetSession._make_step)
+    StepSession._make_control = timed("hydration", StepSession._make_control)
+    WidgetSession.get_delta = timed("serialization", WidgetSession.get_delta)
+    appdir.encode_widget_session = timed("serialization", appdir.encode_widget_session)
+    for task in tasks:
+        task.run = timed("body", task.run)
+
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def run_task(task, kwargs: dict) -> dict:
+    _recorder.totals = totals = defaultdict(float)
+    _recorder.stack = []
+    start = time.perf_counter()
+    try:
+        result = task.apply(kwargs=kwargs)
+    finally:
+        _recorder.totals = None
+    totals["total"] = time.perf_counter() - start
+    if result.failed():
+        raise result.result
+    return totals
+
+
+def report(name: str, samples: list, elapsed: float):
+    totals = [sample["total"] * 1000 for sample in samples]
+    print(f"{name:<14}{len(samples):>6}{len(samples) / elapsed:>10.1f}"
+          f"{percentile(totals, 50):>9.2f}{percentile(totals, 95):>9.2f}{percentile(totals, 99):>9.2f}",
+          end='')
+    for phase in PHASES + ("other",):
+        if phase == "other":
+            values = [(sample["total"] - sum(sample[p] for p in PHASES)) * 1000 for sample in samples]
+        else:
+            values = [sample[phase] * 1000 for sample in samples]
+        print(f"{sum(values) / len(values):.2f}/{percentile(values, 95):.2f}".rjust(26), end='')
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка API, с')
+    parser.add_argument('--widget-latency', type=float, default=None,
+                        help='задержка /celery/get_widget_session, с')
+    parser.add_argument('--steps', type=int, default=2)
+    parser.add_argument('--items', type=int, default=50)
+    parser.add_argument('--tree', type=int, default=50)
+    args = parser.parse_args()
+
+    latencies = {}
+    if args.widget_latency is not None:
+        latencies['/celery/get_widget_session'] = args.widget_latency
+    fake = FakeAPI(latency=args.latency, latencies=latencies,
+                   steps=args.steps, items=args.items, tree=args.tree).start()
+    os.environ['API_URL'] = fake.url
+    os.environ.setdefault('CODE_ROOT', str(Path(__file__).resolve().parents[1]))
+
+    import appdir
+    from appdir.reporting import reporter
+
+    names = [f"{APPLICATION_PREFIX}.{name}" for name in ("init", "validate", "execute")]
+    names.append(WEBHOOK_TASK)
+    tasks = [appdir.app.tasks[name] for name in names]
+    instrument(appdir, tasks)
+
+    def task_kwargs(task, index: int) -> dict:
+        if task.name == WEBHOOK_TASK:
+            return {"webhook_request_guid": f"webhook-{index}"}
+        return {"widget_session_guid": f"session-{index}", "user_request_guid": f"request-{index}"}
+
+    samples = defaultdict(list)
+    elapsed = defaultdict(float)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for index in range(args.warmup):
+            for task in tasks:
+                run_task(task, task_kwargs(task, index))
+        reporter.flush()
+        for index in range(args.runs):
+            for task in tasks:
+                sample = run_task(task, task_kwargs(task, index))
+                samples[task.name].append(sample)
+                elapsed[task.name] += sample["total"]
+        flush_start = time.perf_counter()
+        reporter.flush()
+        flush_time = time.perf_counter() - flush_start
+
+    print(f"API {fake.url}: latency {args.latency * 1000:.1f} ms, "
+          f"steps {args.steps}, items {args.items}, tree {args.tree}")
+    print(f"{'task':<14}{'runs':>6}{'tasks/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}",
+          end='')
+    for phase in PHASES + ("other",):
+        print(f"{phase + ' avg/p95 ms':>26}", end='')
+    print()
+    for task in tasks:
+        report(task.name.rsplit('.', 1)[-1], samples[task.name], elapsed[task.name])
+    print(f"Отправка очереди событий после прогона: {flush_time * 1000:.1f} ms")
+    print("Запросы к API: " + ", ".join(f"{path} {count}" for path, count in sorted(fake.calls.items())))
+    fake.stop()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
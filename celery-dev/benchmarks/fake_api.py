@@ -0,0 +1,164 @@
+
+# Заглушка API платформы в том же процессе: отвечает на запросы воркера
+# с настраиваемой задержкой и размером виджет-сессии.
+#   api = FakeAPI(latency=0.005, items=200).start()
+#   os.environ['API_URL'] = api.url   # до импорта appdir
+
+import sys
+import json
+import time
+import threading
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+def control(guid: str, code: str, order: int, type: str, **fields) -> dict:
+    data = {"guid": guid, "name": code, "code": code, "description": None, "describe": None,
+            "alert": None, "alert_style": None, "order": order, "type": type,
+            "hide": False, "disabled": False, "style": "primary"}
+    data.update(fields)
+    return data
+
+
+def items(count: int) -> list:
+    return [{"id": i, "value": f"Товар {i}", "checked": False, "style": "primary",
+             "description": None, "describe": {"count": i % 10, "uom": "шт."}}
+            for i in range(count)]
+
+
+def tree(count: int, width: int = 10) -> list:
+    # Дерево из count узлов: у каждого узла до width потомков
+    nodes = [{"id": i, "value": f"Узел {i}", "checked": False, "style": "primary",
+              "expand": i < width, "children": []} for i in range(count)]
+    for i in range(1, count):
+        nodes[(i - 1) // width]["children"].append(nodes[i])
+    return nodes[:1]
+
+
+def widget_session(steps: int = 2, items_count: int = 50, tree_count: int = 50) -> dict:
+    # Первый шаг совпадает с тем, что ожидает active-sales-offline: main-step
+    # с контролами order-name и order-products
+    steps_data = []
+    for index in range(steps):
+        guid = f"step-{index}"
+        controls = [
+            control(f"{guid}-alert", "order-name", 1, "alert", value="Заказ", default_value=None),
+            control(f"{guid}-list", "order-products", 2, "check_box_list",
+                    describe={"show_filter": True}, value=None, default_value=None,
+                    items=items(items_count)),
+            control(f"{guid}-tree", "tree", 3, "tree_view", items=tree(tree_count)),
+            control(f"{guid}-calendar", "date", 4, "calendar", value="2024-01-01", default_value=None),
+            control(f"{guid}-text", "comment", 5, "text_box", value="", default_value=None),
+        ]
+        steps_data.append({"guid": guid, "name": f"Шаг {index}",
+                           "code": "main-step" if index == 0 else f"step{index + 1}",
+                           "description": None, "controls": controls})
+    return {
+        "code": 0,
+        "msg": "",
+        "data": {
+            "widget": {"current_step": "step-0", "code": "widget", "name": "Виджет",
+                       "status": "new", "description": None, "async_execute": False,
+                       "expand_data": {}},
+            "steps": steps_data
+        }
+    }
+
+
+class FakeAPI:
+
+    def __init__(self, latency: float = 0.0, latencies: dict = None, statuses: dict = None,
+                 steps: int = 2, items: int = 50, tree: int = 50,
+                 host: str = '127.0.0.1', port: int = 0) -> None:
+        # latencies: путь -> задержка в секундах, перекрывает latency
+        # statuses: путь -> код ответа вместо 200 (отказ API)
+        self.latency = latency
+        self.latencies = latencies or {}
+        self.statuses = statuses or {}
+        self.host = host
+        self.port = port
+        self.calls = defaultdict(int)
+        # События жизненного цикла по типу, отправленные и по одному, и пачкой
+        self.events = defaultdict(int)
+        self.bytes_received = defaultdict(int)
+        self._lock = threading.Lock()
+        self._widget_session = json.dumps(widget_session(steps, items, tree)).encode()
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}/api"
+
+    def response(self, path: str, body: bytes) -> bytes:
+        if path in ('/change_session_status', '/update_user_request', '/update_webhook_request'):
+            with self._lock:
+                self.events[path] += 1
+        if path == '/celery/get_widget_session':
+            return self._widget_session
+        if path == '/celery/get_settings':
+            data = {"settings": {"token": "secret"}}
+        elif path == '/register_tasks':
+            data = {"widget_not_found": [], "webhooks_not_found": []}
+        elif path == '/update_webhook_request':
+            request = json.loads(body)
+            data = {"guid": request["webhook_request_guid"], "requestId": "request",
+                    "app_guid": "app", "account_guid": "account", "status": request["state"],
+                    "data": {"order": {"id": 1}}}
+        elif path == '/celery/lifecycle_batch':
+            # Ответ на каждое событие пачки, в порядке событий
+            data = [json.loads(self.response(f"/{event['type']}", json.dumps(event['data']).encode()))['data']
+                    for event in json.loads(body)['events']]
+        elif path in ('/change_session_status', '/update_user_request'):
+            data = {}
+        else:
+            return None
+        return json.dumps({"code": 0, "msg": "", "data": data}).encode()
+
+    def start(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Заголовки и тело пишутся раздельно: без этого Nagle и delayed ACK
+            # добавляют ~40 мс к ответу на keep-alive соединении
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                path = self.path[len('/api'):] if self.path.startswith('/api') else self.path
+                with api._lock:
+                    api.calls[path] += 1
+                    api.bytes_received[path] += len(body)
+                delay = api.latencies.get(path, api.latency)
+                if delay:
+                    time.sleep(delay)
+                status = api.statuses.get(path)
+                out = api.response(path, body) if status is None else None
+                self.send_response(status or (200 if out is not None else 404))
+                out = out or b'{}'
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+        class Server(ThreadingHTTPServer):
+
+            def handle_error(self, request, client_address):
+                # Клиент не дождался ответа и закрыл соединение (таймаут)
+                if not isinstance(sys.exc_info()[1], ConnectionError):
+                    super().handle_error(request, client_address)
+
+        self._server = Server((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, name='fake-api', daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,90 @@
+
+# Сравнение памяти элементов списков: Item/TreeItem со __slots__
+# против прежнего представления на __dict__. Время построения меряется
+# отдельно от памяти (tracemalloc замедляет выделения в разы), классы
+# чередуются по кругам, берётся лучший круг: иначе результат зависит от
+# порядка и моментов сборки мусора.
+#   python -m benchmarks.item_memory --items 50000
+
+import os
+import argparse
+import gc
+import time
+import tracemalloc
+
+from benchmarks.fake_api import FakeAPI
+
+
+class DictItem:
+    # Прежняя реализация Item, оставлена как эталон для сравнения
+
+    def __init__(self, **kwargs) -> None:
+        self.id = kwargs.get('id', None)
+        self.value = kwargs['value']
+        self.checked = kwargs['checked']
+        self.style = kwargs['style']
+        self.description = kwargs.get('description', None)
+        self.describe = kwargs.get('describe', None)
+
+
+class DictTreeItem(DictItem):
+
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.expand = kwargs.get("expand", False)
+        self.children = ([DictTreeItem(**kwd) for kwd in kwargs.get("children")]
+                         if isinstance(kwargs.get("children"), list) else [])
+
+
+def raw_items(count: int) -> list:
+    return [{"id": i, "value": f"Товар {i}", "checked": bool(i % 2), "style": "primary",
+             "description": None, "describe": {"count": i % 10, "uom": "шт."}}
+            for i in range(count)]
+
+
+def memory(cls, raw: list) -> int:
+    gc.collect()
+    tracemalloc.start()
+    items = [cls(**kwargs) for kwargs in raw]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del items
+    return size
+
+
+def build_time(cls, raw: list) -> float:
+    gc.collect()
+    started = time.perf_counter()
+    items = [cls(**kwargs) for kwargs in raw]
+    elapsed = time.perf_counter() - started
+    del items
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    # Импорт appdir регистрирует задачи в API: нужна заглушка
+    fake = FakeAPI().start()
+    os.environ['API_URL'] = fake.url
+    from appdir.classes import Item, TreeItem
+
+    raw = raw_items(args.items)
+    print(f"{'class':<14}{'bytes/item':>12}{'total MiB':>12}{'build ms':>10}")
+    classes = (DictItem, Item, DictTreeItem, TreeItem)
+    elapsed = {cls: float('inf') for cls in classes}
+    for _ in range(args.repeat):
+        for cls in classes:
+            elapsed[cls] = min(elapsed[cls], build_time(cls, raw))
+    for cls in classes:
+        size = memory(cls, raw)
+        print(f"{cls.__name__:<14}{size / args.items:>12.1f}"
+              f"{size / 2 ** 20:>12.2f}{elapsed[cls] * 1000:>10.1f}")
+    fake.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+
+# Пропускная способность воркера в пулах prefork, threads и gevent:
+# задачи init (запросы к API с задержкой, без БД) отправляются через
+# брокер filesystem:// в настоящий воркер в отдельном процессе. Считаются
+# задачи в секунду и задачи на секунду процессорного времени воркера со
+# всеми дочерними процессами (Linux, /proc). Запуск из каталога с .env:
+#   python -m benchmarks.pools --tasks 2000 --latency 0.02 --concurrency 4 32
+
+import os
+import sys
+import time
+import signal
+import tempfile
+import argparse
+import subprocess
+from pathlib import Path
+
+from benchmarks.fake_api import FakeAPI
+
+TASK = "applications.sales.active-sales-offline.action.init"
+QUEUE = "benchmark"
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def broker_options(folder: str) -> dict:
+    return {'data_folder_in': folder, 'data_folder_out': folder, 'processed_folder': folder,
+            'store_processed': False}
+
+
+def cpu_seconds(root: int) -> float:
+    # Процессорное время процесса и всех его потомков
+    parents = {}
+    times = {}
+    for entry in Path('/proc').iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            fields = (entry / 'stat').read_text().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        pid = int(entry.name)
+        parents[pid] = int(fields[1])
+        times[pid] = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    total = 0.0
+    for pid, seconds in times.items():
+        current = pid
+        while current and current != root:
+            current = parents.get(current)
+        if current == root:
+            total += seconds
+    return total
+
+
+def worker(args):
+    # Отдельный процесс воркера: gevent подменяет модули до импорта приложения
+    if args.pool == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+        import database
+        database.use_gevent()
+
+    from appdir import app
+    app.conf.broker_url = 'filesystem://'
+    app.conf.broker_transport_options = broker_options(args.broker_dir)
+    app.conf.task_store_errors_even_if_ignored = False
+    app.conf.worker_redirect_stdouts = False
+    # Без цикла событий (threads, gevent) воркер забирает сообщения из
+    # filesystem:// раз в 2 секунды, когда окно предвыборки заполнено:
+    # окно задаётся с запасом, чтобы мерить пул, а не брокер
+    app.worker_main(["worker", f"--pool={args.pool}", f"--concurrency={args.concurrency}",
+                     "-Q", QUEUE, "--loglevel=WARNING", "--without-heartbeat",
+                     "--without-mingle", "--without-gossip", "-O", "fair",
+                     "--prefetch-multiplier=64"])
+
+
+def run(fake: FakeAPI, pool: str, concurrency: int, tasks: int, timeout: float) -> tuple:
+    from celery import Celery
+
+    with tempfile.TemporaryDirectory() as folder:
+        producer = Celery(broker='filesystem://')
+        producer.conf.broker_transport_options = broker_options(folder)
+        for index in range(tasks):
+            producer.send_task(TASK, kwargs={"widget_session_guid": f"session-{index}",
+                                             "user_request_guid": f"request-{index}"},
+                               queue=QUEUE)
+
+        fake.events.clear()
+        fake.calls.clear()
+        env = dict(os.environ, REFCACHE_ENABLED='false', DB_POOL_PREWARM='0',
+                   METRICS_PORT='0', METRICS_FILE='', TASK_REGISTRATION_MODE='async')
+        process = subprocess.Popen([sys.executable, '-m', 'benchmarks.pools', '--worker',
+                                    '--pool', pool, '--concurrency', str(concurrency),
+                                    '--broker-dir', folder],
+                                   env=env, stdout=subprocess.DEVNULL)
+        try:
+            deadline = time.monotonic() + timeout
+            # Отсчёт - с первого запроса задачи, запуск воркера не учитывается
+            while not fake.calls.get('/celery/get_widget_session'):
+                if time.monotonic() > deadline or process.poll() is not None:
+                    raise RuntimeError(f"{pool}: worker did not start")
+                time.sleep(0.005)
+            started = time.perf_counter()
+            cpu_started = cpu_seconds(process.pid)
+            while fake.events.get('/change_session_status', 0) < tasks:
+                if time.monotonic() > deadline or process.poll() is not None:
+                    raise RuntimeError(f"{pool}: {fake.events.get('/change_session_status', 0)} "
+                                       f"of {tasks} tasks finished")
+                time.sleep(0.005)
+            elapsed = time.perf_counter() - started
+            cpu = cpu_seconds(process.pid) - cpu_started
+        finally:
+            process.send_signal(signal.SIGTERM)
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+    return elapsed, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pools', nargs='+', default=['prefork', 'threads', 'gevent'])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[4, 32])
+    parser.add_argument('--tasks', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.02, help='задержка API, с')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--pool', help=argparse.SUPPRESS)
+    parser.add_argument('--broker-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    os.environ.setdefault('CODE_ROOT', str(Path(__file__).resolve().parents[1]))
+    if args.worker:
+        args.concurrency = args.concurrency[0]
+        return worker(args)
+
+    fake = FakeAPI(latency=args.latency).start()
+    os.environ['API_URL'] = fake.url
+
+    print(f"API {fake.url}: latency {args.latency * 1000:.1f} ms, {args.tasks} tasks")
+    print(f"{'pool':<10}{'concurrency':>12}{'tasks/s':>10}{'cpu s':>8}{'tasks/cpu s':>13}")
+    for concurrency in args.concurrency:
+        for pool in args.pools:
+            try:
+                elapsed, cpu = run(fake, pool, concurrency, args.tasks, args.timeout)
+            except RuntimeError as e:
+                print(f"{pool:<10}{concurrency:>12}  {e}")
+                continue
+            print(f"{pool:<10}{concurrency:>12}{args.tasks / elapsed:>10.1f}{cpu:>8.2f}"
+                  f"{args.tasks / cpu if cpu else float('inf'):>13.1f}")
+    fake.stop()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
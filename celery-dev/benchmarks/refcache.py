@@ -0,0 +1,59 @@
+
+# Поиск статуса по названию и товара по id: запрос в БД на каждый поиск
+# против кэша справочников refcache. Нужна база с данными, например после
+# applications.sales.datagen.
+#   python -m benchmarks.refcache --lookups 10000
+
+import sys
+import time
+import random
+import argparse
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lookups', type=int, default=10000)
+    args = parser.parse_args()
+
+    from database import db
+    from refcache import references
+    from applications.sales.models import Product, Status
+
+    db.connect(reuse_if_open=True)
+    names = [status.name for status in Status.select()]
+    product_ids = [product.id for product in Product.select(Product.id)]
+    db.close()
+    if not names or not product_ids:
+        print('sales.status пуста: загрузите данные applications.sales.datagen', file=sys.stderr)
+        return 1
+    if not references.start():
+        print('Слушатель LISTEN/NOTIFY не подключился', file=sys.stderr)
+        return 1
+
+    rng = random.Random(42)
+    keys = [(rng.choice(names), rng.choice(product_ids)) for _ in range(args.lookups)]
+
+    def direct():
+        db.connect(reuse_if_open=True)
+        try:
+            for name, product_id in keys:
+                Status.get(Status.name == name)
+                Product.get_by_id(product_id)
+        finally:
+            db.close()
+
+    def cached():
+        for name, product_id in keys:
+            references.get(Status, name=name)
+            references.get(Product, product_id)
+
+    for title, func in (('БД', direct), ('кэш', cached)):
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        print(f'{title:>6}: {elapsed * 1e6 / (2 * args.lookups):.1f} мкс на поиск')
+    print(references.stats())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+
+# Вызовы API из нескольких слотов воркера (потоков), пока путь
+# get_widget_session здоров, зависает дольше таймаута, отвечает 503 и
+# снова здоров. Сравнение с appdir.resilience и без него (таймаут вызова,
+# без автомата и повторов): время слота на вызов и запросы, дошедшие до API.
+#   python -m benchmarks.resilience --slots 8 --phase 5
+
+import os
+import sys
+import time
+import argparse
+import threading
+import subprocess
+
+from benchmarks.fake_api import FakeAPI
+
+PATH = '/celery/get_widget_session'
+BASELINE = {'API_TIMEOUT_ADAPTIVE': 'false', 'API_BREAKER_FAILURES': '1000000000', 'API_RETRY_TOTAL': '0'}
+
+
+def phases() -> list:
+    return [('healthy', {}, {}),
+            ('stalled', {PATH: 3.0}, {}),
+            ('503', {}, {PATH: 503}),
+            ('recovered', {}, {})]
+
+
+def measure(args):
+    fake = FakeAPI(latency=args.latency).start()
+    os.environ['API_URL'] = fake.url
+    import requests
+    from appdir import api, resilience
+
+    print(f"{'phase':<10}{'calls':>7}{'ok':>7}{'failed':>8}{'shed':>7}{'api hits':>10}{'ms/call':>9}")
+    for name, latencies, statuses in phases():
+        fake.latencies = latencies
+        fake.statuses = statuses
+        fake.calls.clear()
+        stats = {'calls': 0, 'ok': 0, 'failed': 0, 'shed': 0, 'busy': 0.0}
+        lock = threading.Lock()
+        deadline = time.monotonic() + args.phase
+
+        def slot():
+            while time.monotonic() < deadline:
+                started = time.perf_counter()
+                result = 'failed'
+                try:
+                    if api.post(PATH, json={"guid": "session"}, timeout=1).status_code == 200:
+                        result = 'ok'
+                except resilience.CircuitOpenError:
+                    result = 'shed'
+                except requests.RequestException:
+                    pass
+                elapsed = time.perf_counter() - started
+                with lock:
+                    stats['calls'] += 1
+                    stats[result] += 1
+                    stats['busy'] += elapsed
+                # Задача, получившая отказ, освобождает слот под следующую
+                time.sleep(args.work)
+
+        threads = [threading.Thread(target=slot) for _ in range(args.slots)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print(f"{name:<10}{stats['calls']:>7}{stats['ok']:>7}{stats['failed']:>8}{stats['shed']:>7}"
+              f"{fake.calls.get(PATH, 0):>10}{stats['busy'] / max(1, stats['calls']) * 1000:>9.1f}")
+    fake.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--slots', type=int, default=8)
+    parser.add_argument('--phase', type=float, default=5, help='длительность фазы, с')
+    parser.add_argument('--latency', type=float, default=0.01, help='задержка здорового API, с')
+    parser.add_argument('--work', type=float, default=0.005, help='работа задачи между вызовами, с')
+    parser.add_argument('--reset', type=float, default=1, help='API_BREAKER_RESET, с')
+    parser.add_argument('--measure', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        return measure(args)
+    # Конфигурация читается при импорте, поэтому каждый режим - в своём процессе
+    argv = [sys.executable, '-m', 'benchmarks.resilience', '--measure', '--slots', str(args.slots),
+            '--phase', str(args.phase), '--latency', str(args.latency), '--work', str(args.work)]
+    common = {'TASK_REGISTRATION_MODE': 'async', 'REFCACHE_ENABLED': 'false',
+              'API_BREAKER_RESET': str(args.reset)}
+    for title, env in (('without resilience', BASELINE), ('with resilience', {})):
+        print(f"*** {title} ***", flush=True)
+        subprocess.run(argv, env=dict(os.environ, **common, **env), check=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+
+# Страница активных заказов с позициями: обход RetaildemandProduct по
+# каждому заказу (N+1) против applications.sales.queries (один запрос).
+# Нужна база с данными, например после applications.sales.datagen.
+#   python -m benchmarks.sales_queries --limit 50 200 1000
+
+import sys
+import time
+import logging
+import argparse
+
+
+class QueryCounter(logging.Handler):
+    # peewee пишет каждый запрос в логгер "peewee" на уровне DEBUG
+
+    def __init__(self) -> None:
+        super().__init__(logging.DEBUG)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+def naive_active_orders(account_id, limit: int) -> list:
+    from applications.sales.models import ActiveSale, RetaildemandProduct
+
+    rows = []
+    for sale in (ActiveSale.select()
+                 .where(ActiveSale.account_id == account_id)
+                 .order_by(ActiveSale.created.desc(), ActiveSale.id)
+                 .limit(limit)):
+        lines = [{"product_id": str(line.product.id), "name": line.product.name,
+                  "quantity": line.quantity}
+                 for line in RetaildemandProduct.select()
+                 .where(RetaildemandProduct.retaildemand == sale.id)]
+        rows.append({"id": sale.id, "value": sale.value, "status": sale.description,
+                     "created": sale.created, "lines": sorted(lines, key=lambda line: line["name"])})
+    return rows
+
+
+def measure(func, repeat: int, counter: QueryCounter) -> tuple:
+    timings = []
+    for _ in range(repeat):
+        counter.count = 0
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2], timings[int(len(timings) * 0.95)], counter.count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--limit', type=int, nargs='+', default=[50, 200, 1000])
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    from database import db
+    from applications.sales import queries
+    from applications.sales.models import ActiveSale
+
+    counter = QueryCounter()
+    logger = logging.getLogger('peewee')
+    logger.addHandler(counter)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+
+    db.connect(reuse_if_open=True)
+    account = (ActiveSale.select(ActiveSale.account_id)
+               .group_by(ActiveSale.account_id)
+               .order_by(ActiveSale.id.count().desc())
+               .limit(1).scalar())
+    if account is None:
+        print('sales.active_sales пуста: загрузите данные applications.sales.datagen', file=sys.stderr)
+        return 1
+
+    print(f"{'limit':>6}{'orders':>8}{'naive p50':>11}{'naive p95':>11}{'queries':>9}"
+          f"{'json p50':>10}{'json p95':>10}{'queries':>9}")
+    for limit in args.limit:
+        orders = len(queries.active_orders(account, limit))
+        naive = measure(lambda: naive_active_orders(account, limit), args.repeat, counter)
+        aggregated = measure(lambda: queries.order_items(queries.active_orders(account, limit)),
+                             args.repeat, counter)
+        print(f"{limit:>6}{orders:>8}{naive[0]:>11.2f}{naive[1]:>11.2f}{naive[2]:>9}"
+              f"{aggregated[0]:>10.2f}{aggregated[1]:>10.2f}{aggregated[2]:>9}")
+    db.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
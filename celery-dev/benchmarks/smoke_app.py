@@ -0,0 +1,67 @@
+
+# Проверка запуска воркера через app.py, как в эксплуатации: для каждого
+# пула python app.py --pool ... должен загрузить приложение по -A app и
+# дойти до worker_ready (асинхронная регистрация задач на заглушке API).
+# Брокер - memory://, Redis не нужен. Запуск из каталога с .env:
+#   python -m benchmarks.smoke_app --pools prefork threads gevent
+
+import os
+import sys
+import time
+import signal
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+from benchmarks.fake_api import FakeAPI
+
+CODE_ROOT = Path(__file__).resolve().parents[1]
+
+
+def start(fake: FakeAPI, pool: str, timeout: float) -> str:
+    fake.calls.clear()
+    with tempfile.TemporaryDirectory() as folder:
+        env = dict(os.environ, API_URL=fake.url, CODE_ROOT=str(CODE_ROOT),
+                   CELERY_BROKER_URL='memory://', TASK_REGISTRATION_MODE='async',
+                   TASK_MANIFEST_PATH=str(Path(folder) / 'manifest.json'),
+                   REFCACHE_ENABLED='false', DB_POOL_PREWARM='0', METRICS_DIR=folder)
+        process = subprocess.Popen([sys.executable, str(CODE_ROOT / 'app.py'),
+                                    '--pool', pool, '--concurrency', '2'],
+                                   env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   text=True)
+        try:
+            deadline = time.monotonic() + timeout
+            while not fake.calls.get('/register_tasks'):
+                if process.poll() is not None:
+                    return f"exited with {process.returncode}:\n{process.stdout.read()[-2000:]}"
+                if time.monotonic() > deadline:
+                    return "worker did not become ready"
+                time.sleep(0.05)
+            return None
+        finally:
+            process.send_signal(signal.SIGTERM)
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pools', nargs='+', default=['prefork', 'threads', 'gevent'])
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    fake = FakeAPI().start()
+    failed = 0
+    for pool in args.pools:
+        error = start(fake, pool, args.timeout)
+        print(f"{pool:<10}{'ok' if error is None else error}")
+        failed += error is not None
+    fake.stop()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -23,6 +23,16 @@ class CeleryConfig:
     DB_APPS_USER = getenv("DB_APPS_USER", default='postgres')
     DB_APPS_PASSWORD = getenv("DB_APPS_PASSWORD", default='secret')
 
+    DB_POOL_MAX_CONNECTIONS = int(getenv("DB_POOL_MAX_CONNECTIONS", default='32'))
+    DB_POOL_OVERFLOW = int(getenv("DB_POOL_OVERFLOW", default='1'))
+    DB_POOL_PREWARM = int(getenv("DB_POOL_PREWARM", default='1'))
+    DB_POOL_TIMEOUT = float(getenv("DB_POOL_TIMEOUT", default='10'))
+    DB_HEALTH_CHECK_INTERVAL = float(getenv("DB_HEALTH_CHECK_INTERVAL", default='30'))
+
+    REFCACHE_ENABLED = getenv("REFCACHE_ENABLED", default='true').lower() == 'true'
+    REFCACHE_CONNECT_TIMEOUT = float(getenv("REFCACHE_CONNECT_TIMEOUT", default='2'))
+    REFCACHE_KEEPALIVE = float(getenv("REFCACHE_KEEPALIVE", default='30'))
+
     @property
     def DB_APPS_CONFIG(self):
         db_config = {
@@ -31,8 +41,9 @@ class CeleryConfig:
             'password': self.DB_APPS_PASSWORD,
             'host': self.DB_APPS_HOST,
             'port': self.DB_APPS_PORT,
-            'max_connections': 32,
+            'max_connections': self.DB_POOL_MAX_CONNECTIONS,
             'stale_timeout': 300,
+            'timeout': self.DB_POOL_TIMEOUT,
             'register_hstore': False,
             'autocommit': True,
             'autorollback': True,
@@ -44,16 +55,108 @@ class CeleryConfig:
     API_URL = getenv("API_URL", default='http://127.0.0.1/api')
     APPLICATION_GUID = getenv("APPLICATION_GUID", default='')
 
+    API_TIMEOUT = float(getenv("API_TIMEOUT", default='5'))
+    API_POOL_CONNECTIONS = int(getenv("API_POOL_CONNECTIONS", default='4'))
+    API_POOL_MAXSIZE = int(getenv("API_POOL_MAXSIZE", default='16'))
+    API_POOL_BLOCK = getenv("API_POOL_BLOCK", default='false').lower() == 'true'
+    API_RETRY_TOTAL = int(getenv("API_RETRY_TOTAL", default='5'))
+    API_RETRY_BACKOFF_FACTOR = float(getenv("API_RETRY_BACKOFF_FACTOR", default='0.1'))
+    API_RETRY_STATUS_FORCELIST = [500, 502, 503, 504]
+    # Адаптивный таймаут, автомат и бюджет повторов по путям API, см. appdir.resilience
+    API_TIMEOUT_ADAPTIVE = getenv("API_TIMEOUT_ADAPTIVE", default='true').lower() == 'true'
+    API_TIMEOUT_MIN = float(getenv("API_TIMEOUT_MIN", default='0.2'))
+    API_BREAKER_FAILURES = int(getenv("API_BREAKER_FAILURES", default='5'))
+    API_BREAKER_RESET = float(getenv("API_BREAKER_RESET", default='10'))
+    API_RETRY_BUDGET_RATIO = float(getenv("API_RETRY_BUDGET_RATIO", default='0.1'))
+    API_RETRY_BUDGET_MIN = float(getenv("API_RETRY_BUDGET_MIN", default='3'))
+
+    CODE_ROOT = getenv("CODE_ROOT", default='/code')
+    TASK_REGISTRATION_MODE = getenv("TASK_REGISTRATION_MODE", default='sync')
+    TASK_REGISTRATION_RETRIES = int(getenv("TASK_REGISTRATION_RETRIES", default='5'))
+    TASK_REGISTRATION_BACKOFF = float(getenv("TASK_REGISTRATION_BACKOFF", default='2'))
+    TASK_MANIFEST_PATH = getenv("TASK_MANIFEST_PATH", default='/tmp/celery_task_manifest.json')
+    IMPORT_REPORT = getenv("IMPORT_REPORT", default='false').lower() == 'true'
+
+    WEBHOOK_SETTINGS_TTL = float(getenv("WEBHOOK_SETTINGS_TTL", default='60'))
+    WEBHOOK_SETTINGS_CACHE_SIZE = int(getenv("WEBHOOK_SETTINGS_CACHE_SIZE", default='1024'))
+    WEBHOOK_BATCHING = getenv("WEBHOOK_BATCHING", default='false').lower() == 'true'
+    WEBHOOK_BATCH_SIZE = int(getenv("WEBHOOK_BATCH_SIZE", default='100'))
+    WEBHOOK_BATCH_INTERVAL = float(getenv("WEBHOOK_BATCH_INTERVAL", default='0.05'))
+
+    IDEMPOTENCY_ENABLED = getenv("IDEMPOTENCY_ENABLED", default='false').lower() == 'true'
+    IDEMPOTENCY_TTL = float(getenv("IDEMPOTENCY_TTL", default='86400'))
+    # Аренда ключа на время обработки: больше самой долгой обработки пачки
+    IDEMPOTENCY_LEASE = float(getenv("IDEMPOTENCY_LEASE", default='300'))
+    IDEMPOTENCY_BLOOM_CAPACITY = int(getenv("IDEMPOTENCY_BLOOM_CAPACITY", default='1000000'))
+    IDEMPOTENCY_BLOOM_ERROR_RATE = float(getenv("IDEMPOTENCY_BLOOM_ERROR_RATE", default='0.001'))
+    IDEMPOTENCY_RECENT_SIZE = int(getenv("IDEMPOTENCY_RECENT_SIZE", default='100000'))
+    IDEMPOTENCY_CLEANUP_INTERVAL = float(getenv("IDEMPOTENCY_CLEANUP_INTERVAL", default='300'))
+
+    TREE_VIEW_LAZY = getenv("TREE_VIEW_LAZY", default='false').lower() == 'true'
+    DATA_VIEW_PAGE_SIZE = int(getenv("DATA_VIEW_PAGE_SIZE", default='50'))
+
+    WIDGET_SESSION_DELTA = getenv("WIDGET_SESSION_DELTA", default='false').lower() == 'true'
+    # Сессия виджета запрашивается в task_prerun параллельно с "started"
+    WIDGET_SESSION_PREFETCH = getenv("WIDGET_SESSION_PREFETCH", default='true').lower() == 'true'
+
+    LIFECYCLE_BATCHING = getenv("LIFECYCLE_BATCHING", default='true').lower() == 'true'
+    LIFECYCLE_BATCH_PATH = getenv("LIFECYCLE_BATCH_PATH", default='/celery/lifecycle_batch')
+    LIFECYCLE_BATCH_SIZE = int(getenv("LIFECYCLE_BATCH_SIZE", default='50'))
+    LIFECYCLE_FLUSH_INTERVAL = float(getenv("LIFECYCLE_FLUSH_INTERVAL", default='0.05'))
+    LIFECYCLE_SHUTDOWN_TIMEOUT = float(getenv("LIFECYCLE_SHUTDOWN_TIMEOUT", default='10'))
+    LIFECYCLE_RETRY_TOTAL = int(getenv("LIFECYCLE_RETRY_TOTAL", default='5'))
+    LIFECYCLE_RETRY_BACKOFF = float(getenv("LIFECYCLE_RETRY_BACKOFF", default='0.5'))
+
+    METRICS_ENABLED = getenv("METRICS_ENABLED", default='true').lower() == 'true'
+    METRICS_DIR = getenv("METRICS_DIR", default='/tmp/celery_metrics')
+    METRICS_PORT = int(getenv("METRICS_PORT", default='0'))
+    METRICS_FILE = getenv("METRICS_FILE", default='')
+    METRICS_INTERVAL = float(getenv("METRICS_INTERVAL", default='10'))
+
     result_expires=3600
     broker_connection_retry_on_startup = True
     task_ignore_result = True
     task_store_errors_even_if_ignored = True
 
+    # prefork, threads или gevent; 0 - число по умолчанию для пула
+    WORKER_POOL = getenv("WORKER_POOL", default='prefork')
+    WORKER_CONCURRENCY = int(getenv("WORKER_CONCURRENCY", default='0'))
+    # Потоки для блокирующего ввода-вывода задач async def, на цикл событий
+    ASYNC_IO_THREADS = int(getenv("ASYNC_IO_THREADS", default='8'))
+
+    # Классы очередей, см. appdir.routing. Приоритет в Redis: 0 - высший
+    TIER_INTERACTIVE_ACTIONS = getenv("TIER_INTERACTIVE_ACTIONS", default='init,validate').split(',')
+    TIER_BULK_ACTIONS = getenv("TIER_BULK_ACTIONS", default='execute').split(',')
+    TIER_DEFAULT = getenv("TIER_DEFAULT", default='interactive')
+    TIER_INTERACTIVE_CONCURRENCY = int(getenv("TIER_INTERACTIVE_CONCURRENCY", default='0'))
+    TIER_INTERACTIVE_PREFETCH = int(getenv("TIER_INTERACTIVE_PREFETCH", default='1'))
+    TIER_INTERACTIVE_PRIORITY = int(getenv("TIER_INTERACTIVE_PRIORITY", default='0'))
+    TIER_BULK_CONCURRENCY = int(getenv("TIER_BULK_CONCURRENCY", default='0'))
+    TIER_BULK_PREFETCH = int(getenv("TIER_BULK_PREFETCH", default='4'))
+    TIER_BULK_PRIORITY = int(getenv("TIER_BULK_PRIORITY", default='6'))
+    TIER_WEBHOOK_CONCURRENCY = int(getenv("TIER_WEBHOOK_CONCURRENCY", default='0'))
+    TIER_WEBHOOK_PREFETCH = int(getenv("TIER_WEBHOOK_PREFETCH", default='4'))
+    TIER_WEBHOOK_PRIORITY = int(getenv("TIER_WEBHOOK_PRIORITY", default='3'))
+
+    INTERACTIVE_QUEUE = f"applications/{APPLICATION_GUID}/interactive"
+    BULK_QUEUE = f"applications/{APPLICATION_GUID}/bulk"
+    APPLICATIONS_QUEUE = f"applications/{APPLICATION_GUID}"
+    WEBHOOK_QUEUE = f"webhook/{APPLICATION_GUID}"
+
     task_queues = (
+        Queue(INTERACTIVE_QUEUE),
+        Queue(APPLICATIONS_QUEUE),
         Queue('default',    routing_key='default'),
-        Queue(f"webhook/{APPLICATION_GUID}"),
-        Queue(f"applications/{APPLICATION_GUID}")
+        Queue(WEBHOOK_QUEUE),
+        Queue(BULK_QUEUE),
     )
+    task_routes = ('appdir.routing.route_task',)
+    # priority опрашивает очереди строго по порядку и при нагрузке морит
+    # последние голодом
+    broker_transport_options = {
+        'queue_order_strategy': getenv("BROKER_QUEUE_ORDER", default='round_robin'),
+        'priority_steps': list(range(10)),
+    }
 
     task_default_queue = 'default'
     task_default_exchange = task_default_queue
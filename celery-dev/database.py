@@ -1,12 +1,230 @@
-
 import os
 import sys
+import time
+import heapq
+import random
 import inspect
+import logging
+import threading
+from contextlib import contextmanager
 from peewee import *
-from playhouse.pool import PooledPostgresqlExtDatabase
+from playhouse.pool import MaxConnectionsExceeded, PooledDatabase, PooledPostgresqlExtDatabase
 
 from config import CeleryConfig
 config = CeleryConfig()
 
+logger = logging.getLogger(__name__)
+
 db_user = config.DB_APPS_USER
-db = PooledPostgresqlExtDatabase(config.DB_APPS_CONFIG)
+
+
+def _span(name: str):
+    # Метрики берутся, только если appdir уже загружен: импорт appdir
+    # регистрирует задачи, а модели используются и вне воркера (datagen,
+    # бенчмарки)
+    metrics = sys.modules.get('appdir.metrics')
+    return metrics.span(name) if metrics is not None else _noop
+
+
+class _Noop:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_noop = _Noop()
+
+
+class InstrumentedPostgresqlExtDatabase(PooledPostgresqlExtDatabase):
+    # Пул с учётом prefork: после fork соединения родителя сбрасываются без
+    # закрытия (сокеты общие с родителем), пул прогревается, размер пула
+    # считается от числа потоков в процессе. Внутри задачи соединение берётся
+    # из пула при первом запросе и возвращается по её завершении. Соединение,
+    # простоявшее в пуле дольше DB_HEALTH_CHECK_INTERVAL, проверяется SELECT 1.
+
+    def __init__(self, *args, health_check_interval: float = 0, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._health_check_interval = health_check_interval
+        self._checked_in = {}
+        self._task_local = threading.local()
+        # Ожидающие свободного соединения будятся при его возврате в пул
+        self._released = threading.Condition(self._lock)
+        self.wait_count = 0
+        self.wait_time = 0.0
+
+    def reset_after_fork(self):
+        self._state = type(self._state)()
+        self._lock = threading.RLock()
+        self._released = threading.Condition(self._lock)
+        self._connections = []
+        self._in_use = {}
+        self._checked_in = {}
+        self._task_local = threading.local()
+        self.wait_count = 0
+        self.wait_time = 0.0
+
+    def configure_pool(self, threads: int):
+        # Одному потоку нужно одно соединение; DB_POOL_MAX_CONNECTIONS -
+        # верхняя граница на процесс
+        size = max(1, min(config.DB_POOL_MAX_CONNECTIONS, threads + config.DB_POOL_OVERFLOW))
+        self._max_connections = size
+        return size
+
+    def prewarm(self, count: int = None) -> int:
+        count = min(count if count is not None else config.DB_POOL_PREWARM, self._max_connections)
+        opened = 0
+        with self._lock:
+            missing = count - len(self._connections) - len(self._in_use)
+        for _ in range(max(0, missing)):
+            try:
+                conn = super(PooledDatabase, self)._connect()
+            except Exception:
+                logger.warning("Database pool prewarm failed", exc_info=True)
+                break
+            with self._lock:
+                # Как в PooledDatabase: без сдвига у соединений с равным
+                # временем heapq начнёт сравнивать сами соединения
+                heapq.heappush(self._connections, (time.time() - random.random() / 1000, conn))
+            opened += 1
+        return opened
+
+    def connect(self, reuse_if_open=False):
+        # Ожидание свободного соединения - здесь, а не в PooledDatabase.connect,
+        # чтобы учитывать время ожидания
+        started = time.perf_counter()
+        expires = time.time() + (self._wait_timeout or 0)
+        waited = False
+        with _span("db_checkout"):
+            try:
+                while True:
+                    try:
+                        return super(PooledDatabase, self).connect(reuse_if_open)
+                    except MaxConnectionsExceeded:
+                        remaining = expires - time.time()
+                        if not self._wait_timeout or remaining <= 0:
+                            raise
+                        waited = True
+                        with self._lock:
+                            if len(self._in_use) >= self._max_connections:
+                                self._released.wait(remaining)
+            finally:
+                if waited:
+                    with self._lock:
+                        self.wait_count += 1
+                        self.wait_time += time.perf_counter() - started
+
+    def _connect(self):
+        while True:
+            conn = super()._connect()
+            key = self.conn_key(conn)
+            checked_in = self._checked_in.pop(key, None)
+            if len(self._checked_in) > len(self._connections):
+                # PooledDatabase выбросил закрытые соединения из пула, не
+                # вызывая _close: их отметки больше не нужны
+                pooled = {self.conn_key(pooled_conn) for _, pooled_conn in self._connections}
+                self._checked_in = {k: v for k, v in self._checked_in.items() if k in pooled}
+            if (not self._health_check_interval or checked_in is None
+                    or time.monotonic() - checked_in < self._health_check_interval):
+                return conn
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                return conn
+            except Exception:
+                logger.info("Dropping broken pooled connection %s", key)
+                self._in_use.pop(key, None)
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
+    def _close(self, conn, close_conn=False):
+        key = self.conn_key(conn)
+        pooled = len(self._connections)
+        super()._close(conn, close_conn)
+        # Отметка нужна только соединению, которое вернулось в пул; у
+        # закрытого (устаревшего, непригодного) она удаляется, иначе её
+        # унаследует новое соединение с тем же ключом
+        if len(self._connections) > pooled:
+            self._checked_in[key] = time.monotonic()
+        else:
+            self._checked_in.pop(key, None)
+        with self._lock:
+            self._released.notify()
+
+    def cursor(self, *args, **kwargs):
+        if self.is_closed() and getattr(self._task_local, 'active', False):
+            self.connect()
+        return super().cursor(*args, **kwargs)
+
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        with _span("db"):
+            return super().execute_sql(sql, params, *args, **kwargs)
+
+    def task_started(self):
+        self._task_local.active = True
+
+    def task_finished(self):
+        self._task_local.active = False
+        if self.is_closed():
+            return
+        if self.in_transaction():
+            # Транзакция не завершена: соединение закрывается, а не возвращается в пул
+            logger.warning("Task finished inside a transaction, closing connection")
+            conn = self._state.conn
+            with self._lock:
+                self._in_use.pop(self.conn_key(conn), None)
+                self._state.reset()
+                self._close(conn, close_conn=True)
+        else:
+            self.close()
+
+    @contextmanager
+    def task_scope(self):
+        self.task_started()
+        try:
+            yield self
+        finally:
+            self.task_finished()
+
+    def pool_stats(self) -> dict:
+        with self._lock:
+            return {
+                "in_use": len(self._in_use),
+                "idle": len(self._connections),
+                "max": self._max_connections,
+                "wait_count": self.wait_count,
+                "wait_seconds": self.wait_time,
+            }
+
+
+def use_gevent():
+    # Пул gevent: psycopg2 ждёт ответа сервера через цикл gevent, а не
+    # блокирует весь процесс. COPY в этом режиме не поддерживается.
+    import psycopg2
+    from psycopg2 import extensions
+    from gevent.socket import wait_read, wait_write
+
+    def wait_callback(conn, timeout=None):
+        while True:
+            state = conn.poll()
+            if state == extensions.POLL_OK:
+                break
+            elif state == extensions.POLL_READ:
+                wait_read(conn.fileno(), timeout=timeout)
+            elif state == extensions.POLL_WRITE:
+                wait_write(conn.fileno(), timeout=timeout)
+            else:
+                raise psycopg2.OperationalError(f"Bad result from poll: {state!r}")
+
+    extensions.set_wait_callback(wait_callback)
+
+
+db = InstrumentedPostgresqlExtDatabase(health_check_interval=config.DB_HEALTH_CHECK_INTERVAL,
+                                       **config.DB_APPS_CONFIG)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=db.reset_after_fork)
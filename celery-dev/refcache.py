@@ -0,0 +1,290 @@
+import os
+import copy
+import time
+import select
+import logging
+import threading
+
+import psycopg2
+
+from database import db
+from config import CeleryConfig
+config = CeleryConfig()
+
+logger = logging.getLogger(__name__)
+
+# Кэш справочников процесса. Справочник - модель с Meta.reference_keys
+# (уникальные поля кроме первичного ключа, по которым ищут записи).
+# Таблица справочника читается целиком при первом обращении и дальше
+# отдаётся из памяти. Триггер на таблице шлёт NOTIFY после каждой
+# изменяющей команды, уведомление приходит при фиксации транзакции;
+# отдельное соединение процесса слушает канал и сбрасывает таблицу.
+# Перед чтением накопившиеся уведомления разбираются без обращения к БД.
+# Пока слушатель не подключён, кэш не используется и запросы идут в БД.
+# get() и all() отдают копии записей: изменение записи в задаче не
+# попадает в кэш и в другие задачи.
+
+CHANNEL = 'reference_changed'
+
+
+def reference_models(models) -> list:
+    return [model for model in models if getattr(model._meta, 'reference_keys', None) is not None]
+
+
+def table_key(model) -> str:
+    return f"{model._meta.schema or 'public'}.{model._meta.table_name}"
+
+
+def install_triggers(db, models):
+    for schema in sorted({model._meta.schema or 'public' for model in models}):
+        db.execute_sql(f'''
+        CREATE OR REPLACE FUNCTION {schema}.notify_reference_changed() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            PERFORM pg_notify('{CHANNEL}', TG_TABLE_SCHEMA || '.' || TG_TABLE_NAME);
+            RETURN NULL;
+        END $$''')
+    for model in models:
+        schema, table = model._meta.schema or 'public', table_key(model)
+        db.execute_sql(f'''
+        DROP TRIGGER IF EXISTS reference_changed ON {table}''')
+        db.execute_sql(f'''
+        CREATE TRIGGER reference_changed
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION {schema}.notify_reference_changed()''')
+
+
+class _Table:
+    __slots__ = ("model", "keys", "lock", "generation", "index")
+
+    def __init__(self, model) -> None:
+        self.model = model
+        self.keys = (model._meta.primary_key.name,) + tuple(model._meta.reference_keys)
+        self.lock = threading.Lock()
+        self.generation = 0
+        # поле -> {значение: запись}
+        self.index = None
+
+
+class ReferenceCache:
+
+    def __init__(self, db) -> None:
+        self.db = db
+        # Соединения слушателя, унаследованные при fork: сокет общий с
+        # родителем, поэтому они не закрываются и не собираются сборщиком
+        self._inherited = []
+        self._reset()
+
+    def _reset(self):
+        self._lock = threading.RLock()
+        self._tables = {}
+        self._listener = None
+        self._conn = None
+        self._connected = threading.Event()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.loads = 0
+        self.invalidations = 0
+
+    def reset_after_fork(self):
+        if self._conn is not None:
+            self._inherited.append(self._conn)
+        self._reset()
+
+    def _table(self, model) -> _Table:
+        key = table_key(model)
+        table = self._tables.get(key)
+        if table is None:
+            if getattr(model._meta, 'reference_keys', None) is None:
+                raise TypeError(f"{model.__name__} is not a reference model")
+            with self._lock:
+                table = self._tables.setdefault(key, _Table(model))
+        return table
+
+    # Слушатель
+
+    def start(self, timeout: float = None) -> bool:
+        if not config.REFCACHE_ENABLED:
+            return False
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, name='refcache-listener',
+                                                  daemon=True)
+                self._listener.start()
+        return self._connected.wait(config.REFCACHE_CONNECT_TIMEOUT if timeout is None else timeout)
+
+    def _listen(self):
+        delay = 0.5
+        while True:
+            try:
+                conn = psycopg2.connect(database=self.db.database, **self.db.connect_params)
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f'LISTEN {CHANNEL}')
+            except Exception:
+                logger.warning("Reference cache listener cannot connect", exc_info=True)
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+                continue
+            delay = 0.5
+            with self._lock:
+                # Изменения до LISTEN не отслеживались
+                self._invalidate_all()
+                self._conn = conn
+                self._connected.set()
+            try:
+                while self._conn is conn:
+                    readable, _, _ = select.select([conn], [], [], config.REFCACHE_KEEPALIVE)
+                    with self._lock:
+                        if self._conn is not conn:
+                            break
+                        if not readable:
+                            # Обрыв без входящих данных select не покажет
+                            with conn.cursor() as cursor:
+                                cursor.execute('SELECT 1')
+                        self._poll(conn)
+            except Exception:
+                logger.warning("Reference cache listener disconnected", exc_info=True)
+                self._disconnect(conn)
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def _poll(self, conn):
+        conn.poll()
+        while conn.notifies:
+            self._invalidate(conn.notifies.pop(0).payload)
+
+    def _disconnect(self, conn):
+        with self._lock:
+            if self._conn is conn:
+                self._conn = None
+                self._connected.clear()
+                self._invalidate_all()
+
+    def _drain(self) -> bool:
+        # Уведомления, уже пришедшие в сокет, разбираются до чтения из кэша
+        conn = self._conn
+        if conn is None:
+            return False
+        with self._lock:
+            if self._conn is not conn:
+                return False
+            try:
+                self._poll(conn)
+            except Exception:
+                logger.warning("Reference cache listener disconnected", exc_info=True)
+                self._disconnect(conn)
+                return False
+        return True
+
+    def _listening(self) -> bool:
+        if self._listener is None and not self.start():
+            return False
+        return self._drain()
+
+    # Сброс
+
+    def _invalidate(self, key: str):
+        table = self._tables.get(key)
+        if table is not None:
+            table.generation += 1
+            if table.index is not None:
+                table.index = None
+                self.invalidations += 1
+
+    def _invalidate_all(self):
+        for key in list(self._tables):
+            self._invalidate(key)
+
+    def invalidate(self, model=None):
+        with self._lock:
+            if model is None:
+                self._invalidate_all()
+            else:
+                self._invalidate(table_key(model))
+
+    # Чтение
+
+    def _query(self, query) -> list:
+        # В задаче соединение берётся из пула автоматически, вне задачи
+        # открывается только на время запроса
+        opened = self.db.is_closed() and not getattr(self.db._task_local, 'active', False)
+        if opened:
+            self.db.connect()
+        try:
+            return list(query)
+        finally:
+            if opened:
+                self.db.close()
+
+    def _load(self, table: _Table) -> dict:
+        index = table.index
+        if index is not None:
+            self.hits += 1
+            return index
+        with table.lock:
+            index = table.index
+            if index is not None:
+                self.hits += 1
+                return index
+            self.misses += 1
+            generation = table.generation
+            rows = self._query(table.model.select())
+            index = {key: {} for key in table.keys}
+            for row in rows:
+                for key in table.keys:
+                    index[key][getattr(row, key)] = row
+            with self._lock:
+                self.loads += 1
+                # Уведомление во время чтения - данные могли устареть
+                if table.generation == generation:
+                    table.index = index
+            return index
+
+    def _normalize(self, model, field: str, value):
+        field = model._meta.fields[field]
+        return field.python_value(field.db_value(value))
+
+    def get(self, model, pk=None, **key):
+        # get(Status, status_id) или get(Status, name="Новый"); None, если нет
+        table = self._table(model)
+        if pk is not None:
+            key = {table.keys[0]: pk}
+        if len(key) != 1:
+            raise ValueError("Exactly one lookup key is required")
+        (field, value), = key.items()
+        if field not in table.keys:
+            raise ValueError(f"{model.__name__}.{field} is not a reference key")
+        value = self._normalize(model, field, value)
+        if not self._listening():
+            self.bypassed += 1
+            rows = self._query(model.select().where(getattr(model, field) == value).limit(1))
+            return rows[0] if rows else None
+        row = self._load(table)[field].get(value)
+        return copy.deepcopy(row) if row is not None else None
+
+    def all(self, model) -> list:
+        table = self._table(model)
+        if not self._listening():
+            self.bypassed += 1
+            return self._query(model.select())
+        index = self._load(table)
+        return [copy.deepcopy(row) for row in index[table.keys[0]].values()]
+
+    def stats(self) -> dict:
+        return {
+            "hit": self.hits,
+            "miss": self.misses,
+            "bypass": self.bypassed,
+            "load": self.loads,
+            "invalidation": self.invalidations,
+        }
+
+
+references = ReferenceCache(db)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=references.reset_after_fork)
@@ -1,12 +1,12 @@
 
-from celery import shared_task
-from appdir.classes import Webhook
+from appdir.batching import webhook_batch
 
-@shared_task
-def order_handler(**kwargs):
+@webhook_batch()
+def order_handler(webhooks: list) -> list:
 
-    webhook_request = Webhook(**kwargs['webhook_request'])
-    data = kwargs['webhook_request']
-    print("======================")
-    print(webhook_request.data)
-    return data
+    results = []
+    for webhook_request in webhooks:
+        print("======================")
+        print(webhook_request.data)
+        results.append(webhook_request.data)
+    return results